@@ -0,0 +1,90 @@
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Set
+
+
+class CostModel:
+    """
+    Predicts how long a request takes from the work units its service estimates for it.
+    Seconds per unit start at the service's guess and then follow measured runs.
+    """
+
+    def __init__(self, seconds_per_unit: float = 1.0, smoothing: float = 0.2):
+        self.seconds_per_unit = seconds_per_unit
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def predict(self, units: float) -> float:
+        return units * self.seconds_per_unit
+
+    def observe(self, units: float, seconds: float):
+        if units <= 0:
+            return
+        with self._lock:
+            self.seconds_per_unit += self.smoothing * (seconds / units - self.seconds_per_unit)
+
+
+@dataclass(eq=False)
+class Admission:
+    units: float
+    predicted_s: float
+    started_at: Optional[float] = None
+
+    def remaining_s(self, now: float) -> float:
+        if self.started_at is None:
+            return self.predicted_s
+        return max(0.0, self.predicted_s - (now - self.started_at))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, predicted_wait: float, predicted_s: float, latency_budget_s: float):
+        self.predicted_wait = predicted_wait
+        self.retry_after = max(1, math.ceil(predicted_wait + predicted_s - latency_budget_s))
+        super().__init__(
+            f"Predicted wait of {predicted_wait:.1f}s plus {predicted_s:.1f}s of work exceeds the "
+            f"{latency_budget_s:.0f}s latency budget. Retry after {self.retry_after}s."
+        )
+
+
+class AdmissionController:
+    """
+    Tracks the predicted seconds of work a worker has committed to, queued or running, and turns away
+    requests that would finish later than `latency_budget_s`. An idle worker accepts any request, so
+    oversized ones still run somewhere. Without a budget it only keeps the wait prediction.
+    """
+
+    def __init__(self, cost_model: CostModel, latency_budget_s: Optional[float] = None):
+        self.cost_model = cost_model
+        self.latency_budget_s = latency_budget_s
+        self._admitted: Set[Admission] = set()
+        self._lock = threading.Lock()
+
+    def predicted_wait(self) -> float:
+        """Seconds until the work committed so far is expected to drain."""
+        now = time.monotonic()
+        with self._lock:
+            return sum(admission.remaining_s(now) for admission in self._admitted)
+
+    def admit(self, units: float) -> Admission:
+        """Commit to a request of `units` work, or raise `AdmissionRejected` if it would blow the budget."""
+        predicted_s = self.cost_model.predict(units)
+        now = time.monotonic()
+        with self._lock:
+            wait = sum(admission.remaining_s(now) for admission in self._admitted)
+            if self.latency_budget_s is not None and self._admitted and wait + predicted_s > self.latency_budget_s:
+                raise AdmissionRejected(wait, predicted_s, self.latency_budget_s)
+            admission = Admission(units=units, predicted_s=predicted_s)
+            self._admitted.add(admission)
+        return admission
+
+    def start(self, admission: Admission):
+        admission.started_at = time.monotonic()
+
+    def release(self, admission: Admission, seconds: Optional[float] = None):
+        """Forget finished or dropped work. `seconds` is its measured runtime, used to calibrate the cost model."""
+        with self._lock:
+            self._admitted.discard(admission)
+        if seconds is not None:
+            self.cost_model.observe(admission.units, seconds)
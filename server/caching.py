@@ -0,0 +1,238 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+import torch
+from ez_diffusion_client import ImageGenerationParams
+from metrics import metrics
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _canonical(v) for (k, v) in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_canonical(v) for v in value]
+    # 7 and 7.0 are the same guidance scale.
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def canonical_hash(params: ImageGenerationParams) -> str:
+    """Hash of the request's parameters that is equal for requests that produce the same image."""
+    canonical = json.dumps(_canonical(params.to_dict()), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def sizeof_tensors(value: Any) -> int:
+    """Bytes held by the tensors in `value`, which may nest them in lists, tuples and dicts."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof_tensors(v) for v in value)
+    if isinstance(value, dict):
+        return sum(sizeof_tensors(v) for v in value.values())
+    return 0
+
+
+def sizeof_image(img) -> int:
+    """Bytes of a decoded PIL image."""
+    return img.width * img.height * len(img.getbands())
+
+
+class BoundedCache:
+    """
+    Thread-safe LRU cache bounded by the summed size of its values, as measured by `sizeof`. Entries older
+    than `ttl_s` are treated as missing. Hits, misses and evictions are counted in `metrics` as
+    `<name>_cache_hits`, `<name>_cache_misses` and `<name>_cache_evictions`, and `<name>_cache_bytes`
+    follows the bytes held.
+    """
+
+    def __init__(self, name: str, max_bytes: int, sizeof: Callable[[Any], int], ttl_s: Optional[float] = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl_s = ttl_s
+        self.bytes = 0
+        # key -> (value, size, stored_at), least recently used first.
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether `get(key)` would hit, without counting it or refreshing the entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (self.ttl_s is None or time.monotonic() - entry[2] <= self.ttl_s)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_s is not None and time.monotonic() - entry[2] > self.ttl_s:
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                metrics.increment(f"{self.name}_cache_misses")
+                return None
+            self._entries.move_to_end(key)
+        metrics.increment(f"{self.name}_cache_hits")
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """Store `value`, evicting least recently used entries to make room. Values larger than the whole cache are not stored."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+            while self._entries and self.bytes + size > self.max_bytes:
+                self.__remove(next(iter(self._entries)))
+                metrics.increment(f"{self.name}_cache_evictions")
+            self._entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+        metrics.increment(f"{self.name}_cache_bytes", size)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self.__remove(key)
+
+    def __remove(self, key: Hashable):
+        (_, size, _) = self._entries.pop(key)
+        self.bytes -= size
+        metrics.increment(f"{self.name}_cache_bytes", -size)
+
+
+def _reads_urls(value: Any) -> bool:
+    if isinstance(value, dict):
+        return any(_reads_urls(v) for v in value.values())
+    if isinstance(value, list):
+        return any(_reads_urls(v) for v in value)
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+
+def result_cache_namespace(base_model: str, revision: str, **config: Any) -> Dict[str, Any]:
+    """A `ResultCache` namespace: the model snapshot, the pipeline `config` and the versions of the libraries running it."""
+    import diffusers
+    return {"base_model": base_model, "revision": revision, "diffusers": diffusers.__version__, "torch": torch.__version__, **config}
+
+
+class ResultCache:
+    """
+    Responses of seeded requests, by a hash of their params and of `namespace`, which must hold everything
+    else that decides the image: model revision, pipeline config and library versions. Recent responses
+    are kept in memory and, with a `disk_dir`, as files that outlive the process and are shared by the
+    workers of a host. Both tiers evict least recently used responses beyond their byte bounds.
+    """
+
+    def __init__(self, namespace: Dict[str, Any], memory_bytes: int, disk_dir: Optional[str] = None, disk_bytes: int = 0):
+        self.namespace = hashlib.sha256(json.dumps(namespace, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        # Entries are (response, size), so the size of a response is only measured once.
+        self.memory = BoundedCache("result", memory_bytes, lambda entry: entry[1])
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        # key -> file size, least recently used first.
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_used = 0
+        self._disk_lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            files = [entry for entry in os.scandir(disk_dir) if entry.name.endswith(".json")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self._disk[entry.name[:-len(".json")]] = entry.stat().st_size
+                self._disk_used += entry.stat().st_size
+
+    def key(self, params: ImageGenerationParams) -> Optional[str]:
+        """
+        None for requests whose result can't be reused: unseeded ones, and ones reading input images from
+        URLs, whose content may change behind the same params.
+        """
+        if params.seed is None or _reads_urls(params.to_dict()):
+            return None
+        return hashlib.sha256(f"{self.namespace}:{canonical_hash(params)}".encode("utf-8")).hexdigest()
+
+    def submit(self, key: Optional[str], start: Callable[[], Future]) -> Future:
+        """The cached response under `key`, or else `start()`, whose response is cached once it succeeds."""
+        if key is None:
+            return start()
+        response = self.get(key)
+        if response is not None:
+            future: Future = Future()
+            future.set_result(response)
+            return future
+        future = start()
+        future.add_done_callback(lambda future: self.__store(key, future))
+        return future
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.memory.get(key)
+        if entry is None and self.disk_dir is not None:
+            entry = self.__read(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        # Callers get their own copy to add to.
+        return copy.deepcopy(entry[0]) if entry is not None else None
+
+    def put(self, key: str, response: Dict[str, Any]):
+        encoded = json.dumps(response).encode("utf-8")
+        self.memory.put(key, (response, len(encoded)))
+        if self.disk_dir is not None:
+            self.__write(key, encoded)
+
+    def __store(self, key: str, future: Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        # Warnings mark results that aren't the plain output of the params, e.g. degraded under load or without a LoRA that failed to load.
+        if response.get("warnings"):
+            return
+        self.put(key, copy.deepcopy(response))
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def __read(self, key: str) -> Optional[tuple]:
+        try:
+            with open(self.__path(key), "rb") as file:
+                encoded = file.read()
+            os.utime(self.__path(key))
+        except FileNotFoundError:
+            metrics.increment("result_cache_disk_misses")
+            return None
+        with self._disk_lock:
+            # Other workers sharing the directory may have written it.
+            self._disk_used += len(encoded) - self._disk.pop(key, 0)
+            self._disk[key] = len(encoded)
+        metrics.increment("result_cache_disk_hits")
+        return (json.loads(encoded), len(encoded))
+
+    def __write(self, key: str, encoded: bytes):
+        if len(encoded) > self.disk_bytes:
+            return
+        # Written under another name and renamed, so readers never see a partial file.
+        temporary = os.path.join(self.disk_dir, f".{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary, "wb") as file:
+            file.write(encoded)
+        os.replace(temporary, self.__path(key))
+        with self._disk_lock:
+            self._disk_used += len(encoded) - self._disk.pop(key, 0)
+            self._disk[key] = len(encoded)
+            evicted = []
+            while self._disk_used > self.disk_bytes:
+                (evicted_key, size) = self._disk.popitem(last=False)
+                self._disk_used -= size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self.__path(evicted_key))
+            except FileNotFoundError:
+                pass
+            metrics.increment("result_cache_disk_evictions")
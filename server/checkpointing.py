@@ -0,0 +1,165 @@
+import contextlib
+import os
+import re
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Optional
+import torch
+from metrics import metrics
+from step_hooks import StepObserver
+
+
+class CheckpointStore(ABC):
+    """Keeps in-flight denoising state by key, so another worker can pick a job up where it stopped."""
+
+    @abstractmethod
+    def save(self, key: str, state: Dict[str, Any]):
+        pass
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+
+class FilesystemCheckpointStore(CheckpointStore):
+    """
+    One `torch.save` file per key under `root`, typically a network volume shared by the workers.
+    Checkpoints are unpickled on load, so only point this at storage the deployment owns.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".pt")
+
+    def save(self, key: str, state: Dict[str, Any]):
+        path = self.__path(key)
+        # Write next to the target and rename, so a worker killed mid-write leaves the previous checkpoint intact.
+        torch.save(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return torch.load(self.__path(key), map_location="cpu", weights_only=False)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.__path(key))
+
+
+def _map_tensors(value: Any, fn: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    if isinstance(value, dict):
+        return {k: _map_tensors(v, fn) for (k, v) in value.items()}
+    return value
+
+
+# Scheduler attributes that `Checkpointer.resuming` trims by the steps that already ran.
+CUT_SCHEDULE = ("timesteps", "sigmas")
+
+
+class Checkpointer(StepObserver):
+    """
+    Saves a request's latents, scheduler state and seed to `store` every `every_n_steps` denoising steps
+    under `key`, and resumes a request with the same `inputs` from the last checkpoint it finds there.
+    """
+
+    def __init__(self, store: CheckpointStore, key: str, inputs: Dict[str, Any], every_n_steps: int = 5):
+        self.store = store
+        self.key = key
+        self.inputs = inputs
+        self.every_n_steps = every_n_steps
+        self.seed: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+        self._loaded = False
+
+    def resume_state(self) -> Optional[Dict[str, Any]]:
+        """The last checkpoint of this request, if any. Checkpoints of different inputs under the same key are ignored."""
+        if not self._loaded:
+            self._loaded = True
+            state = self.store.load(self.key)
+            if state is not None and state.get("inputs") == self.inputs:
+                self._resume = state
+        return self._resume
+
+    @property
+    def completed_steps(self) -> int:
+        state = self.resume_state()
+        return state["step"] if state is not None else 0
+
+    def resuming(self, scheduler):
+        """
+        Context for the pipeline call that resumes the request. The scheduler gets its saved state back
+        right after the pipeline sets its timesteps, minus the steps that already ran. Pass the saved
+        `latents` to the pipeline along with it.
+        """
+        state = self.resume_state()
+        if state is None:
+            return contextlib.nullcontext()
+        return self.__resumed_timesteps(scheduler, state)
+
+    @contextlib.contextmanager
+    def __resumed_timesteps(self, scheduler, state: Dict[str, Any]):
+        set_timesteps = scheduler.set_timesteps
+
+        def resume_set_timesteps(*args, **kwargs):
+            set_timesteps(*args, **kwargs)
+            fresh = vars(scheduler)
+            for (name, value) in state["scheduler"].items():
+                # The fresh schedule is cut below. Checkpoints only hold step indices into the full one.
+                if name in CUT_SCHEDULE:
+                    continue
+                like = fresh.get(name)
+                device = like.device if isinstance(like, torch.Tensor) else scheduler.timesteps.device
+                fresh[name] = _map_tensors(value, lambda t: t.to(device))
+            # Index based schedulers look sigmas up by step index, so both move to the trimmed timesteps.
+            skipped = state["step"] * scheduler.order
+            scheduler.timesteps = scheduler.timesteps[skipped:]
+            if isinstance(getattr(scheduler, "sigmas", None), torch.Tensor):
+                scheduler.sigmas = scheduler.sigmas[skipped:]
+            if getattr(scheduler, "_step_index", None) is not None:
+                scheduler._step_index -= skipped
+
+        print(f"Resuming {self.key} from step {state['step']}")
+        metrics.increment("checkpoint_resumes")
+        metrics.increment("checkpoint_steps_resumed", state["step"])
+        scheduler.set_timesteps = resume_set_timesteps
+        try:
+            yield
+        finally:
+            del scheduler.set_timesteps
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        completed = self.completed_steps + step + 1
+        if completed % self.every_n_steps or completed >= self.completed_steps + total_steps:
+            return
+        scheduler = {
+            name: _map_tensors(value, lambda t: t.detach().cpu())
+            # Leaves out the config, the `set_timesteps` override of a resumed call and the schedule a resumed call cut.
+            for (name, value) in vars(pipe.scheduler).items() if name != "_internal_dict" and name not in CUT_SCHEDULE and not callable(value)
+        }
+        if scheduler.get("_step_index") is not None:
+            # A resumed call counts from its cut schedule, checkpoints from the full one.
+            scheduler["_step_index"] += self.completed_steps * pipe.scheduler.order
+        self.store.save(self.key, {
+            "inputs": self.inputs,
+            "seed": self.seed,
+            "step": completed,
+            "latents": latents.detach().cpu(),
+            "scheduler": scheduler,
+        })
+        metrics.increment("checkpoints_saved")
+
+    def complete(self):
+        """Drop the checkpoint once the request has produced its result."""
+        self.store.delete(self.key)
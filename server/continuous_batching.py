@@ -0,0 +1,296 @@
+import random
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+import torch
+from diffusers import DDIMScheduler
+from diffusers.utils.torch_utils import randn_tensor
+from ez_diffusion_client import ImageGenerationParams
+from admission import AdmissionController
+from imagegen_service import ImageGenService
+from pipeline_factory import SDImagePipelineFactory
+from inference_executor import InferenceExecutor, WorkItem
+from scheduling import SchedulingPolicy
+from step_hooks import JobCancelledError, StepObserver, record_interrupt
+
+
+@dataclass
+class DenoiseSlot:
+    """Per-request denoising state. Each slot owns its scheduler so requests with different step counts can share a UNet batch."""
+    request: WorkItem
+    seed: int
+    generator: torch.Generator
+    scheduler: DDIMScheduler
+    latents: torch.Tensor
+    # Negative and positive embeddings concatenated for classifier free guidance.
+    prompt_embeds: torch.Tensor
+    added_cond_kwargs: Optional[Dict[str, torch.Tensor]]
+    step: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def done(self) -> bool:
+        return self.step >= len(self.scheduler.timesteps)
+
+    @property
+    def timestep(self) -> torch.Tensor:
+        return self.scheduler.timesteps[self.step]
+
+
+class ContinuousBatchingEngine(InferenceExecutor):
+    """
+    Step-granular batching for the SD/SDXL text-to-image UNet path built by `SDImagePipelineFactory`.
+
+    New requests join the running denoise batch at step boundaries and finished requests leave it
+    right away for VAE decode, so a 4-step job never waits behind a 50-step one. Requests the engine
+    can't denoise itself (image inputs, ControlNets, LoRAs, DeepCache) run through `ImageGenService.generate`
+    on the engine thread once the running batch has drained, never with its slots frozen mid-denoise.
+    `policy` picks the request to start a batch with and the ones that join it.
+    """
+
+    def __init__(
+        self,
+        service: ImageGenService,
+        max_batch_size: int = 8,
+        max_queue_size: int = 16,
+        admission: Optional[AdmissionController] = None,
+        policy: Optional[SchedulingPolicy] = None,
+    ):
+        if not isinstance(service.pipeline_factory, SDImagePipelineFactory):
+            raise ValueError(f"{self.__class__.__name__} requires an SDImagePipelineFactory")
+        self.service = service
+        self.pipeline_factory: SDImagePipelineFactory = service.pipeline_factory
+        self.pipe = self.pipeline_factory.base_pipeline
+        self.is_sdxl = hasattr(self.pipe, "text_encoder_2")
+        self.max_batch_size = max_batch_size
+        self._active: List[DenoiseSlot] = []
+        super().__init__(max_queue_size=max_queue_size, name="continuous-batching", admission=admission, policy=policy)
+
+    def accepts(self, params: ImageGenerationParams) -> bool:
+        """Whether the request can join a shared denoise batch."""
+        optimizations = params.pipeline_optimizations
+        return not (
+            params.image_to_image
+            or params.inpaint
+            or params.controlnets
+            or params.loras
+            or (optimizations and optimizations.deepcache_branch_id and optimizations.deepcache_interval)
+        )
+
+    def submit(
+        self,
+        params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        tenant: Optional[str] = None,
+    ) -> "Future[Dict[str, Any]]":
+        key = (params.dimensions.width, params.dimensions.height) if self.accepts(params) else None
+        return self._enqueue(WorkItem(
+            fn=self.service.generate,
+            args=(params,),
+            kwargs={"observer": observer},
+            key=key,
+            work=self.service.estimate_work(params.to_dict()),
+            tenant=tenant
+        ))
+
+    def _take_admissible(self) -> List[WorkItem]:
+        with self._cond:
+            while not self._pending and not self._active:
+                self._cond.wait()
+
+            admitted = []
+            if not self._active:
+                head = self._pending.pop(self.policy.select(self._pending))
+                if head.key is None:
+                    # Unbatchable requests get the pipeline to themselves, there is no batch to freeze.
+                    return [head]
+                admitted.append(head)
+
+            # Latents of different resolutions can't be concatenated, so the running batch pins the resolution.
+            resolution = (self._active[0].request if self._active else head).key
+            if self._pending and self._pending[0].key != resolution:
+                # Let the running batch drain so an older unbatchable request or one at another resolution isn't starved.
+                return admitted
+
+            while len(self._active) + len(admitted) < self.max_batch_size:
+                joining = [request for request in self._pending if request.key == resolution]
+                if not joining:
+                    break
+                request = joining[self.policy.select(joining)]
+                self._pending.remove(request)
+                admitted.append(request)
+            return admitted
+
+    def _run(self):
+        while True:
+            self._in_flight = len(self._active)
+            for request in self._take_admissible():
+                if not self._begin(request):
+                    continue
+                if request.key is None:
+                    self._run_alone(request)
+                    continue
+                try:
+                    # Batched slots denoise on the plain base pipeline.
+                    self.pipeline_factory.cleanup()
+                    self._active.append(self._start(request))
+                except Exception as e:
+                    request.future.set_exception(e)
+                    self._release([request])
+
+            if not self._active:
+                continue
+
+            step_start = time.monotonic()
+            try:
+                self._step()
+            except Exception as e:
+                for slot in self._active:
+                    slot.request.future.set_exception(e)
+                self._release([slot.request for slot in self._active])
+                self._active = []
+                continue
+            self._drop_stopped(time.monotonic() - step_start)
+
+            for slot in [s for s in self._active if s.done]:
+                # The slot shared its steps with the rest of the batch, so it is charged its share of the wall time.
+                share = (time.monotonic() - slot.started_at) / len(self._active)
+                self._record_duration(share, 1)
+                self._active.remove(slot)
+                self._finish(slot)
+                self._release([slot.request], share)
+
+    def _drop_stopped(self, step_seconds: float):
+        """Take cancelled and expired requests out of the running batch right away, without decoding them."""
+        per_slot_seconds = step_seconds / len(self._active)
+        for slot in list(self._active):
+            observer = slot.request.kwargs.get("observer")
+            reason = observer.stop_reason() if observer is not None else None
+            if reason and not slot.done:
+                print(f"{self.__class__.__name__}: stopping request after step {slot.step}/{len(slot.scheduler.timesteps)}: {reason}")
+                record_interrupt(len(slot.scheduler.timesteps) - slot.step, per_slot_seconds)
+                self._active.remove(slot)
+                slot.request.future.set_exception(JobCancelledError(reason))
+                self._release([slot.request])
+
+    def _run_alone(self, request: WorkItem):
+        start = time.monotonic()
+        try:
+            request.future.set_result(self.service.generate(*request.args, **request.kwargs))
+        except Exception as e:
+            request.future.set_exception(e)
+        finally:
+            self._record_duration(time.monotonic() - start, 1)
+            self._release([request], time.monotonic() - start)
+
+    @torch.no_grad()
+    def _start(self, request: WorkItem) -> DenoiseSlot:
+        params = request.args[0]
+        device = self.pipeline_factory.device
+        seed = params.seed if params.seed is not None else random.getrandbits(64)
+        generator = torch.Generator(device=device).manual_seed(seed)
+
+        added_cond_kwargs = None
+        if self.is_sdxl:
+            (prompt_embeds, negative_embeds, pooled, negative_pooled) = self.pipe.encode_prompt(
+                prompt=params.prompt,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=params.negative_prompt,
+            )
+            (width, height) = request.key
+            time_ids = self.pipe._get_add_time_ids(
+                (height, width),
+                (0, 0),
+                (height, width),
+                dtype=prompt_embeds.dtype,
+                text_encoder_projection_dim=self.pipe.text_encoder_2.config.projection_dim,
+            ).to(device)
+            added_cond_kwargs = {
+                "text_embeds": torch.cat([negative_pooled, pooled]),
+                "time_ids": torch.cat([time_ids, time_ids]),
+            }
+        else:
+            (prompt_embeds, negative_embeds) = self.pipe.encode_prompt(
+                params.prompt,
+                device,
+                1,
+                True,
+                negative_prompt=params.negative_prompt,
+            )
+
+        scheduler = DDIMScheduler.from_config(self.pipe.scheduler.config)
+        scheduler.set_timesteps(params.inference_steps, device=device)
+
+        (width, height) = request.key
+        shape = (
+            1,
+            self.pipe.unet.config.in_channels,
+            height // self.pipe.vae_scale_factor,
+            width // self.pipe.vae_scale_factor,
+        )
+        latents = randn_tensor(shape, generator=generator, device=torch.device(device), dtype=prompt_embeds.dtype)
+
+        return DenoiseSlot(
+            request=request,
+            seed=seed,
+            generator=generator,
+            scheduler=scheduler,
+            latents=latents * scheduler.init_noise_sigma,
+            prompt_embeds=torch.cat([negative_embeds, prompt_embeds]),
+            added_cond_kwargs=added_cond_kwargs,
+        )
+
+    @torch.no_grad()
+    def _step(self):
+        """Run one UNet forward for every active slot, each at its own timestep."""
+        latent_input = torch.cat([
+            slot.scheduler.scale_model_input(torch.cat([slot.latents] * 2), slot.timestep)
+            for slot in self._active
+        ])
+        timesteps = torch.cat([slot.timestep.reshape(1).expand(2) for slot in self._active])
+        unet_kwargs = {}
+        if self.is_sdxl:
+            unet_kwargs["added_cond_kwargs"] = {
+                name: torch.cat([slot.added_cond_kwargs[name] for slot in self._active])
+                for name in ("text_embeds", "time_ids")
+            }
+
+        noise_pred = self.pipe.unet(
+            latent_input,
+            timesteps,
+            encoder_hidden_states=torch.cat([slot.prompt_embeds for slot in self._active]),
+            return_dict=False,
+            **unet_kwargs,
+        )[0]
+
+        for (i, slot) in enumerate(self._active):
+            (noise_uncond, noise_text) = noise_pred[2 * i:2 * i + 2].chunk(2)
+            guided = noise_uncond + slot.request.args[0].guidance_scale * (noise_text - noise_uncond)
+            slot.latents = slot.scheduler.step(guided, slot.timestep, slot.latents, generator=slot.generator, return_dict=False)[0]
+            slot.step += 1
+
+            observer = slot.request.kwargs.get("observer")
+            if observer is not None:
+                observer.on_step_end(self.pipe, slot.step - 1, len(slot.scheduler.timesteps), slot.latents)
+
+    @torch.no_grad()
+    def _finish(self, slot: DenoiseSlot):
+        try:
+            vae = self.pipe.vae
+            needs_upcasting = vae.dtype == torch.float16 and getattr(vae.config, "force_upcast", False)
+            if needs_upcasting:
+                self.pipe.upcast_vae()
+            latents = slot.latents.to(vae.dtype) / vae.config.scaling_factor
+            image = vae.decode(latents, return_dict=False)[0]
+            if needs_upcasting:
+                vae.to(dtype=torch.float16)
+            image = self.pipe.image_processor.postprocess(image, output_type="pil")[0]
+
+            params = slot.request.args[0]
+            response = {"prompt": params.prompt, "seed": slot.seed, "warnings": []}
+            slot.request.future.set_result(self.service.build_response(image, response, {}))
+        except Exception as e:
+            slot.request.future.set_exception(e)
@@ -1,19 +1,85 @@
 from abc import ABC, abstractmethod
+import os
+import threading
 from functools import lru_cache
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from PIL import Image as PILImage
 from PIL.Image import Image
+import torch
+from diffusers.image_processor import VaeImageProcessor
 
-from controlnet_aux.processor import Processor
+from controlnet_aux.processor import MODELS, MODEL_PARAMS
 from ez_diffusion_client import ImageGenerationParams,  CNProcessorType
 from paramiko import PasswordRequiredException
 from models import OpResult, OpStatus, CNUnionControlMode
-from utils import load_image_from_base64_or_url
+from caching import BoundedCache, sizeof_image, sizeof_tensors
+from utils import fetch_input_image, load_image_from_base64_or_url
 
 class ImageProcessor(ABC):
     @abstractmethod
     def process_image(self, image: str, kwargs) -> Image:
         pass
 
+# Processors that are another processor with other settings.
+ANNOTATOR_ALIASES = {
+    "openpose_hand_body": ("openpose", {"include_body": True, "include_hand": True, "include_face": False}),
+}
+
+def load_annotator(processor_id: str):
+    """Load the detector behind a controlnet_aux processor, downloading its weights if needed."""
+    if processor_id not in MODELS:
+        raise ValueError(f"Processor {processor_id} not found")
+    detector = MODELS[processor_id]["class"]
+    return detector.from_pretrained("lllyasviel/Annotators") if MODELS[processor_id]["checkpoint"] else detector()
+
+def sizeof_annotator(detector: Any, depth: int = 3) -> int:
+    """Bytes of the torch weights a detector holds, in modules up to `depth` attributes down."""
+    if isinstance(detector, torch.nn.Module):
+        return sum(t.element_size() * t.nelement() for t in [*detector.parameters(), *detector.buffers()])
+    if depth == 0 or not hasattr(detector, "__dict__"):
+        return 0
+    return sum(sizeof_annotator(value, depth - 1) for value in vars(detector).values())
+
+class AnnotatorPool:
+    """
+    Annotators by processor and resolution. Each processor's weights are loaded once and shared by all its
+    resolutions, which only change the settings it is called with. Loaded weights are bounded by
+    `max_bytes`, least recently used processors unloaded first.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.detectors = BoundedCache("annotator", max_bytes, sizeof_annotator)
+        self._load_lock = threading.Lock()
+
+    def get(self, processor: str, resolution: int) -> Callable[[Image], Image]:
+        (processor_id, settings) = ANNOTATOR_ALIASES.get(processor, (processor, {}))
+        detector = self.detectors.get(processor_id)
+        if detector is None:
+            # One load per processor, also when several requests need it at once.
+            with self._load_lock:
+                detector = self.detectors.get(processor_id)
+                if detector is None:
+                    print(f"'{processor_id}' annotator not loaded. Loading.")
+                    detector = load_annotator(processor_id)
+                    self.detectors.put(processor_id, detector)
+        # Copied, controlnet_aux keeps the defaults in a shared dict.
+        params = {**MODEL_PARAMS[processor_id], **settings, "detect_resolution": resolution, "image_resolution": resolution}
+        return lambda image: detector(image, **params)
+
+    def preload(self, annotators: List[Dict[str, Any]]):
+        """
+        Load and warm the annotators of a manifest's `annotators` section, entries like
+        `{processor: openpose, resolutions: [512, 1024]}`, so first requests don't pay for it.
+        """
+        for entry in annotators:
+            processor = entry.get("processor")
+            for resolution in entry.get("resolutions") or [512]:
+                try:
+                    print(f"Warming '{processor}' annotator at {resolution}")
+                    self.get(processor, resolution)(PILImage.new("RGB", (resolution, resolution)))
+                except Exception as e:
+                    print(f"Failed to warm '{processor}' annotator at {resolution}: {e}")
+
 class ControlnetGuideImagePreprocessor(ImageProcessor): 
     processor_list = [
         "canny", "depth_leres", "depth_leres++", "depth_midas",
@@ -28,38 +94,40 @@ class ControlnetGuideImagePreprocessor(ImageProcessor):
         'openpose_hand_body'
     ]
 
-    processor_cache = {} 
+    # Shared by every preprocessor of the process, like the weights it holds.
+    annotator_pool = AnnotatorPool(int(os.getenv("ANNOTATOR_POOL_MB", "4096")) * 1024 ** 2)
+    # Annotator outputs by guide image content, processor and resolution. Iterating on a prompt keeps the guide image.
+    output_cache = BoundedCache("annotator_output", int(os.getenv("ANNOTATOR_CACHE_MB", "256")) * 1024 ** 2, sizeof_image)
     
     def process_image(self, image: str, kwargs) -> Image: 
-        img = load_image_from_base64_or_url(image)
+        preprocessor_type = kwargs["processor_to_use"].value
+        desired_width = kwargs["desired_width"]
+        fetched = kwargs.get("fetched") or fetch_input_image(image, lambda image_key: (image_key, preprocessor_type, desired_width) in self.output_cache)
+        image_key = fetched[0]
+        key = (image_key, preprocessor_type, desired_width)
+        cached = self.output_cache.get(key) if image_key is not None else None
+        if cached is not None:
+            return cached.copy()
+
+        img = load_image_from_base64_or_url(image, fetched=fetched)
         (w, h) = img.size
         # scale image to nearest multiple of 64 in both width and height
         img = img.resize((w // 64 * 64, h // 64 * 64))
-        preprocessor_type = kwargs.processor_to_use.value
-        desired_width = kwargs.desired_width
-        if preprocessor_type not in self.processor_cache:
-            print(f"'{preprocessor_type}' processor not initialized. Initializing and saving.")
-            if preprocessor_type == "openpose_hand_body":
-                processor = Processor('openpose', {'detect_resolution': desired_width, 'image_resolution': desired_width, 'include_body': True, 'include_hand': True, 'include_face': False})
-            else: 
-                processor = Processor(preprocessor_type, {'detect_resolution': desired_width, 'image_resolution': desired_width})
-            self.processor_cache[preprocessor_type] = processor
-        
-        selected_processor = self.processor_cache[preprocessor_type]
-        print(f"Processing image using ControlNet processor: {preprocessor_type}")
-        if selected_processor is not None:
-            try:
-                processed_img = selected_processor(img, to_pil=True)
-                print(f"Preprocess with '{preprocessor_type}' succeeded: {processed_img}")
-                return processed_img
-            except Exception as e:
-                raise e
-        else:
-            raise ValueError(f"Processor {preprocessor_type} not found")
+        annotator = self.annotator_pool.get(preprocessor_type, desired_width)
+        processed_img = annotator(img)
+        if image_key is not None:
+            self.output_cache.put(key, processed_img.copy())
+        return processed_img
         
 
         
 class ControlnetParamsFactory(ABC):
+    # Whether guide images of several requests can be nested into a single batched pipeline call.
+    supports_batching = True
+    # Guide images as the tensors pipelines make of them, by content, preprocessing, size, device and dtype.
+    # Repeated guide images skip the conversion and the copy to the device.
+    control_tensors = BoundedCache("control_tensor", int(os.getenv("CONTROL_TENSOR_CACHE_MB", "128")) * 1024 ** 2, sizeof_tensors)
+
     def __init__(
             self, 
             image_preprocessor: ImageProcessor = ControlnetGuideImagePreprocessor()
@@ -71,39 +139,72 @@ class ControlnetParamsFactory(ABC):
         if do_preprocess:
             img = self.image_preprocessor.process_image(guide_image, kwargs)
         else:
-            img = load_image_from_base64_or_url(guide_image)
+            img = load_image_from_base64_or_url(guide_image, fetched=kwargs["fetched"])
         return img
 
-    def preprocess_images(self, input: ImageGenerationParams):
+    def __control_image(self, cn, input: ImageGenerationParams, target: Optional[tuple]):
+        """A guide image as the pipeline takes it: the tensor it would make of it for `target`, or the image without one."""
+        (width, height) = (input.dimensions.width, input.dimensions.height)
+        processor = cn.processor_type.value if cn.needs_preprocess else None
+        cache_key = lambda image_key: (image_key, processor, width, height, *target)
+        fetched = fetch_input_image(cn.guide_image.source, lambda image_key: target is not None and cache_key(image_key) in self.control_tensors)
+        cached = self.control_tensors.get(cache_key(fetched[0])) if target is not None and fetched[0] is not None else None
+        if cached is not None:
+            return cached
+
+        img = self.__load_image(
+            cn.needs_preprocess or False,
+            cn.guide_image.source,
+            { "processor_to_use": cn.processor_type, "desired_width": width, "fetched": fetched }
+        )
+        if target is None:
+            return img
+        (device, dtype, vae_scale_factor) = target
+        # What the ControlNet pipelines do with an image in `prepare_image`, given a tensor they only repeat it.
+        image_processor = VaeImageProcessor(vae_scale_factor=vae_scale_factor, do_convert_rgb=True, do_normalize=False)
+        tensor = image_processor.preprocess(img, height=height, width=width).to(device=device, dtype=dtype)
+        if fetched[0] is not None:
+            self.control_tensors.put(cache_key(fetched[0]), tensor)
+        return tensor
+
+    def preprocess_images(self, input: ImageGenerationParams, target: Optional[tuple] = None):
         if not input.controlnets:
             raise ValueError(f"No controlnets in {input}")
-    
-        images = [self.__load_image(
-            cn.needs_preprocess or False, 
-            cn.guide_image.source, 
-            { "processor_to_use": cn.processor_type, "desired_width": input.dimensions.width }
-        ) for cn in input.controlnets]
 
-        return images
+        return [self.__control_image(cn, input, target) for cn in input.controlnets]
 
-    def get_pipeline_controlnet_params(self, input: ImageGenerationParams, pipekwargs, response) -> Tuple[dict, dict]:
+    def get_pipeline_controlnet_params(self, input: ImageGenerationParams, pipekwargs, response, target: Optional[tuple] = None) -> Tuple[dict, dict]:
+        return self.get_batch_pipeline_controlnet_params([input], pipekwargs, response, target)
+
+    def get_batch_pipeline_controlnet_params(self, batch: List[ImageGenerationParams], pipekwargs, response, target: Optional[tuple] = None) -> Tuple[dict, dict]:
+        """
+        Resolve controlnet kwargs for requests sharing one pipeline call. Guide images are nested per sample when batched,
+        and are tensors on the pipeline's device when `target`, see `PipelineFactory.control_image_target`, is given.
+        """
+        input = batch[0]
         if not input.controlnets or len(input.controlnets) <= 0:
             return (pipekwargs, response)
 
-        try:    
-            kwargs = {**pipekwargs, **self._resolve_kwargs(input, self.preprocess_images(input))}
+        try:
+            if len(batch) == 1:
+                images = self.preprocess_images(input, target)
+            else:
+                images = [self.preprocess_images(params, target) for params in batch]
+            kwargs = {**pipekwargs, **self._resolve_kwargs(input, images)}
             return (kwargs, response)
         except Exception as e:
             print(f" {self.__class__}: Failed to resolve controlnet kwargs")
-            res = {**response, "warnings": [*response.warnings, "There was an error loading some controlnets"]}
+            res = {**response, "warnings": [*response["warnings"], "There was an error loading some controlnets"]}
             return (pipekwargs, res)
 
     @abstractmethod
-    def _resolve_kwargs(self, input: ImageGenerationParams, images: list[Image]) -> dict:
+    def _resolve_kwargs(self, input: ImageGenerationParams, images: list) -> dict:
         pass
 
 
 class ControlnetUnionParamsFactory(ControlnetParamsFactory):
+    supports_batching = False
+
     def map_processor_to_control_mode(self, processor_type: CNProcessorType) -> CNUnionControlMode:
         if processor_type in {CNProcessorType.OPENPOSE, CNProcessorType.OPENPOSE_FACE,
                           CNProcessorType.OPENPOSE_FACEONLY, CNProcessorType.OPENPOSE_FULL,
@@ -145,7 +246,7 @@ class ControlnetUnionParamsFactory(ControlnetParamsFactory):
 
 
 class MultiModelControlnetParamsFactory(ControlnetParamsFactory):
-    def _resolve_kwargs(self, input: ImageGenerationParams, images: list[Image]) -> dict:
+    def _resolve_kwargs(self, input: ImageGenerationParams, images: list) -> dict:
         if not input.controlnets or len(input.controlnets) <= 0:
             return {}
         
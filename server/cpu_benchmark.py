@@ -0,0 +1,105 @@
+import multiprocessing
+import queue
+import time
+from typing import Dict, List
+from ez_diffusion_client import ImageGenerationParams
+from imagegen_service import ImageGenService
+from prefork import partition_cores, pin_to_cores
+
+
+def _run_instance(service: ImageGenService, params: ImageGenerationParams, requests: int, cores: List[int], go, results):
+    pin_to_cores(cores)
+    service.generate(params)
+    results.put("ready")
+    go.wait()
+    start = time.monotonic()
+    for _ in range(requests):
+        service.generate(params)
+    results.put(time.monotonic() - start)
+
+
+def benchmark_instances(service: ImageGenService, params: ImageGenerationParams, num_instances: int, requests: int = 3) -> float:
+    """
+    Images per second of `num_instances` forked instances of `service`, each pinned to its own cores as in
+    `prefork`, all generating `requests` images of `params` at once after one untimed warmup image.
+    """
+    # Forked like the `prefork` workers, so the instances share the already loaded weights.
+    context = multiprocessing.get_context("fork")
+    (go, results) = (context.Event(), context.Queue())
+    processes = [
+        context.Process(target=_run_instance, args=(service, params, requests, cores, go, results), daemon=True)
+        for cores in partition_cores(num_instances)
+    ]
+    for process in processes:
+        process.start()
+
+    def collect() -> list:
+        collected = []
+        while len(collected) < len(processes):
+            try:
+                collected.append(results.get(timeout=1.0))
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError("A benchmark instance failed")
+        return collected
+
+    try:
+        collect()
+        go.set()
+        elapsed = collect()
+    finally:
+        for process in processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+    return num_instances * requests / max(elapsed)
+
+
+def default_candidates() -> List[int]:
+    """Powers of two up to the number of usable cores."""
+    cores = len(partition_cores(1)[0])
+    candidates = [1]
+    while candidates[-1] * 2 <= cores:
+        candidates.append(candidates[-1] * 2)
+    return candidates
+
+
+if __name__ == "__main__":
+    import argparse
+    from controlnet_params_factory import ControlnetUnionParamsFactory, MultiModelControlnetParamsFactory
+    from controlnet_factory import SDXLFp16ControlNetUnionGetter
+    from pipeline_factory import SDImagePipelineFactory
+    from prefork import pipeline_modules, share_weights
+
+    parser = argparse.ArgumentParser(description="Find the number of `--prefork` CPU workers with the highest throughput on this host")
+    parser.add_argument("--diffusion_base_model", default="sd15")
+    parser.add_argument("--model", default="stable-diffusion-v1-5/stable-diffusion-v1-5", help="Base model path or identifier")
+    parser.add_argument("--instances", default=None, help="Comma separated worker counts to try. Defaults to powers of two up to the core count.")
+    parser.add_argument("--requests", default=3, type=int, help="Timed images per worker and worker count.")
+    parser.add_argument("--inference_steps", default=20, type=int)
+    parser.add_argument("--width", default=512, type=int)
+    parser.add_argument("--height", default=512, type=int)
+    args = parser.parse_args()
+
+    if args.diffusion_base_model == "sdxl":
+        factory = SDImagePipelineFactory(base_model=args.model, use_fp16=False, get_controlnet=SDXLFp16ControlNetUnionGetter(), device="cpu")
+        service = ImageGenService(factory, ControlnetUnionParamsFactory())
+    else:
+        factory = SDImagePipelineFactory(base_model=args.model, use_fp16=False, device="cpu")
+        service = ImageGenService(factory, MultiModelControlnetParamsFactory())
+    share_weights(pipeline_modules(factory.base_pipeline))
+
+    params = ImageGenerationParams(
+        prompt="a lighthouse on a cliff at sunset",
+        dimensions={"width": args.width, "height": args.height},
+        inference_steps=args.inference_steps,
+        seed=0,
+    )
+    candidates = [int(n) for n in args.instances.split(",")] if args.instances else default_candidates()
+    results: Dict[int, float] = {}
+    for n in candidates:
+        results[n] = benchmark_instances(service, params, n, args.requests)
+        print(f"{n} workers: {results[n]:.3f} images/s, {n / results[n]:.1f}s per image")
+
+    best = max(results, key=results.get)
+    print(f"Best: --prefork {best} ({results[best]:.3f} images/s)")
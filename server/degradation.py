@@ -0,0 +1,107 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+from ez_diffusion_client import ImageGenerationParams, ImageGenerationParamsDimensions, ImageGenerationParamsPipelineOptimizations
+from metrics import metrics
+
+
+@dataclass
+class DegradationLevel:
+    """Quality caps for requests that start while the worker is at least this loaded. Unset thresholds never trigger."""
+    queue_depth: Optional[int] = None
+    wait_s: Optional[float] = None
+    max_inference_steps: Optional[int] = None
+    # Turns DeepCache on for requests that don't use it. The branch id must be at least 1 for `setup` to apply it.
+    deepcache_interval: Optional[int] = None
+    deepcache_branch_id: int = 1
+    # Generate at this fraction of the requested size and upscale the result.
+    resolution_scale: float = 1.0
+
+    def triggered(self, queue_depth: int, wait_s: float) -> bool:
+        return (
+            (self.queue_depth is not None and queue_depth >= self.queue_depth)
+            or (self.wait_s is not None and wait_s >= self.wait_s)
+        )
+
+
+def default_degradation_levels(queue_depth: Optional[int] = None, wait_s: Optional[float] = None) -> List[DegradationLevel]:
+    """Three levels of growing savings, entered at one, two and three times the given thresholds."""
+    at = lambda factor: dict(
+        queue_depth=queue_depth * factor if queue_depth is not None else None,
+        wait_s=wait_s * factor if wait_s is not None else None,
+    )
+    return [
+        DegradationLevel(**at(1), max_inference_steps=30),
+        DegradationLevel(**at(2), max_inference_steps=20, deepcache_interval=3),
+        DegradationLevel(**at(3), max_inference_steps=15, deepcache_interval=3, resolution_scale=0.75),
+    ]
+
+
+class QualityDegradation:
+    """
+    Trades image quality for throughput while the worker is overloaded, instead of letting requests time out.
+    `load` returns the current queue depth and predicted queue wait in seconds. Each batch gets the last of
+    `levels` that the load triggers, so levels should be ordered from mildest to strictest. A level stays on
+    until the load has stayed below it for `hold_s` seconds, so quality doesn't flap with every request, and
+    full quality returns by itself once the backlog drains.
+    """
+
+    def __init__(self, levels: List[DegradationLevel], load: Callable[[], Tuple[int, float]], hold_s: float = 10.0):
+        self.levels = levels
+        self.load = load
+        self.hold_s = hold_s
+        self._last_triggered: List[Optional[float]] = [None for _ in levels]
+        self._lock = threading.Lock()
+
+    def current_level(self) -> Optional[int]:
+        """Index into `levels` of the level in force, None at full quality."""
+        (queue_depth, wait_s) = self.load()
+        now = time.monotonic()
+        with self._lock:
+            for (i, level) in enumerate(self.levels):
+                if level.triggered(queue_depth, wait_s):
+                    self._last_triggered[i] = now
+            held = [i for (i, last) in enumerate(self._last_triggered) if last is not None and now - last < self.hold_s]
+        return max(held) if held else None
+
+    def degrade(self, batch: List[ImageGenerationParams]) -> Tuple[List[ImageGenerationParams], List[str], Optional[Tuple[int, int]]]:
+        """
+        The batch as it should run under the current load, with a warning per adjustment and the size to
+        upscale results to when the resolution was reduced. Requests of one batch are adjusted alike.
+        """
+        index = self.current_level()
+        if index is None:
+            return (batch, [], None)
+        level = self.levels[index]
+        params = batch[0]
+        update = {}
+        warnings = []
+
+        if level.max_inference_steps is not None and params.inference_steps > level.max_inference_steps:
+            update["inference_steps"] = level.max_inference_steps
+            warnings.append(f"Server under load: inference_steps reduced from {params.inference_steps} to {level.max_inference_steps}.")
+
+        optimizations = params.pipeline_optimizations
+        if level.deepcache_interval is not None and not (optimizations and optimizations.deepcache_interval and optimizations.deepcache_branch_id):
+            update["pipeline_optimizations"] = ImageGenerationParamsPipelineOptimizations(
+                use_deepcache=True,
+                deepcache_interval=level.deepcache_interval,
+                deepcache_branch_id=level.deepcache_branch_id,
+            )
+            warnings.append(f"Server under load: DeepCache enabled with interval {level.deepcache_interval}.")
+
+        upscale_to = None
+        if level.resolution_scale < 1 and not params.inpaint:
+            (width, height) = (params.dimensions.width, params.dimensions.height)
+            # Latents are an eighth of the image size, so dimensions stay multiples of 8.
+            scaled = (max(64, int(width * level.resolution_scale) // 8 * 8), max(64, int(height * level.resolution_scale) // 8 * 8))
+            if scaled != (width, height):
+                update["dimensions"] = ImageGenerationParamsDimensions(width=scaled[0], height=scaled[1])
+                upscale_to = (width, height)
+                warnings.append(f"Server under load: generated at {scaled[0]}x{scaled[1]} and upscaled to {width}x{height}.")
+
+        if not update:
+            return (batch, [], None)
+        metrics.increment(f"degraded_requests.level{index + 1}", len(batch))
+        return ([params.model_copy(update=update) for params in batch], warnings, upscale_to)
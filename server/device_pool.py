@@ -0,0 +1,213 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import torch
+from inference_executor import InferenceExecutor, QueueFullError
+from metrics import metrics
+from prefork import partition_cores, pin_to_cores
+from step_hooks import CancellationToken, JobCancelledError, StepObserver
+
+
+def _serve_device(build_service: Callable, device: str, cores: Optional[List[int]], requests, responses):
+    """Entry point of a device worker process: one service replica behind its own GPU thread."""
+    if cores:
+        pin_to_cores(cores)
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    service = build_service(device)
+    service.warmup()
+    executor = InferenceExecutor(max_queue_size=1 << 16, name=f"device-{device}")
+    tokens: Dict[int, CancellationToken] = {}
+    futures: Dict[int, Future] = {}
+
+    def finished(key: int, future: Future):
+        tokens.pop(key, None)
+        futures.pop(key, None)
+        try:
+            responses.put(("done", key, future.result()))
+        except JobCancelledError as e:
+            responses.put(("cancelled", key, e.reason))
+        except Exception as e:
+            responses.put(("error", key, f"{e.__class__.__name__}: {e}"))
+
+    responses.put(("ready", None, None))
+    while (message := requests.get()) is not None:
+        (kind, key, payload) = message
+        if kind == "job":
+            tokens[key] = CancellationToken()
+            job_input = payload.get("input", {})
+            future = executor.submit(
+                service.rp_worker_generate,
+                payload,
+                observer=tokens[key],
+                work=service.estimate_work(job_input),
+                affinity=service.affinity_key(job_input),
+            )
+            futures[key] = future
+            future.add_done_callback(lambda f, key=key: finished(key, f))
+        elif kind == "cancel" and key in tokens:
+            tokens[key].cancel(payload)
+    wait(list(futures.values()))
+
+
+@dataclass(eq=False)
+class DeviceWorker:
+    device: str
+    process: Any
+    requests: Any
+    responses: Any
+    ready: threading.Event = field(default_factory=threading.Event)
+    # Dispatched jobs that haven't finished, with the observer to poll for cancellation.
+    in_flight: Dict[int, Tuple[Future, Optional[StepObserver]]] = field(default_factory=dict)
+    cancelled: set = field(default_factory=set)
+    # Affinity of the last job sent here. Jobs run in dispatch order, so it's what the replica will have loaded.
+    last_affinity: Optional[tuple] = None
+    alive: bool = True
+
+
+class DevicePool:
+    """
+    One worker process per device, each holding its own service replica built by `build_service(device)`.
+    Jobs go to the worker with the shortest queue, counting a worker whose pipeline and adapters aren't
+    warm for the job as `cold_penalty` jobs deeper. Cancellation and deadlines of a job's observer are
+    relayed to its worker; progress events are not.
+    """
+
+    def __init__(
+        self,
+        build_service: Callable[[str], Any],
+        devices: List[str],
+        affinity_key: Optional[Callable[[Dict[str, Any]], Optional[tuple]]] = None,
+        max_queue_size: int = 16,
+        cold_penalty: float = 0.5,
+        poll_interval_s: float = 0.25,
+    ):
+        self.affinity_key = affinity_key or (lambda job_input: None)
+        self.max_queue_size = max_queue_size
+        self.cold_penalty = cold_penalty
+        self.poll_interval_s = poll_interval_s
+        self._next_key = 0
+        self._avg_job_s: Optional[float] = None
+        self._lock = threading.Lock()
+
+        # CUDA can't be initialised in a forked child.
+        context = multiprocessing.get_context("spawn")
+        cpu_workers = sum(1 for device in devices if device == "cpu")
+        # Replicas sharing the CPU each get their own cores instead of all of them contending for every core.
+        partitions = iter(partition_cores(cpu_workers) if cpu_workers > 1 else [])
+        self.workers: List[DeviceWorker] = []
+        for device in devices:
+            (requests, responses) = (context.Queue(), context.Queue())
+            process = context.Process(
+                target=_serve_device,
+                args=(build_service, device, next(partitions, None) if device == "cpu" else None, requests, responses),
+                name=f"device-{device}",
+                daemon=True,
+            )
+            process.start()
+            worker = DeviceWorker(device=device, process=process, requests=requests, responses=responses)
+            threading.Thread(target=self.__collect, args=(worker,), name=f"collect-{device}", daemon=True).start()
+            self.workers.append(worker)
+        threading.Thread(target=self.__relay_cancellations, name="device-pool-cancel", daemon=True).start()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until every replica has loaded its models."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        return all(worker.ready.wait(None if deadline is None else max(0, deadline - time.monotonic())) for worker in self.workers)
+
+    def close(self, timeout: float = 30.0):
+        """Let every replica finish its queued jobs and exit."""
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(worker.in_flight) for worker in self.workers)
+
+    def __score(self, worker: DeviceWorker, affinity: Optional[tuple]) -> float:
+        return len(worker.in_flight) + (0 if worker.last_affinity == affinity else self.cold_penalty)
+
+    def submit(self, job: Dict[str, Any], observer: Optional[StepObserver] = None) -> Future:
+        """Send a RunPod style job to the least loaded replica."""
+        affinity = self.affinity_key(job.get("input", {}))
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            candidates = [worker for worker in self.workers if worker.alive and worker.ready.is_set()]
+            candidates = candidates or [worker for worker in self.workers if worker.alive]
+            if not candidates:
+                raise RuntimeError("No device workers are running")
+            # Like `InferenceExecutor`, a replica holds at most `max_queue_size` jobs.
+            open_workers = [worker for worker in candidates if len(worker.in_flight) < self.max_queue_size]
+            if not open_workers:
+                raise QueueFullError(max(1, int(self.max_queue_size * (self._avg_job_s or 1.0))))
+            worker = min(open_workers, key=lambda worker: (self.__score(worker, affinity), len(worker.in_flight)))
+
+            if worker.last_affinity != affinity:
+                metrics.increment("device_pool_cold_dispatches")
+            (key, self._next_key) = (self._next_key, self._next_key + 1)
+            worker.in_flight[key] = (future, observer)
+            worker.last_affinity = affinity
+        metrics.increment(f"device_pool_jobs.{worker.device}")
+
+        started = time.monotonic()
+        future.add_done_callback(lambda _: self.__record_duration(time.monotonic() - started))
+        worker.requests.put(("job", key, job))
+        return future
+
+    def __record_duration(self, seconds: float):
+        self._avg_job_s = seconds if self._avg_job_s is None else 0.8 * self._avg_job_s + 0.2 * seconds
+
+    def __collect(self, worker: DeviceWorker):
+        while True:
+            try:
+                (kind, key, payload) = worker.responses.get(timeout=1.0)
+            except queue.Empty:
+                if not worker.process.is_alive():
+                    self.__fail_worker(worker)
+                    return
+                continue
+
+            if kind == "ready":
+                print(f"{self.__class__.__name__}: replica on {worker.device} is ready")
+                worker.ready.set()
+                continue
+            with self._lock:
+                (future, _) = worker.in_flight.pop(key)
+                worker.cancelled.discard(key)
+            if kind == "done":
+                future.set_result(payload)
+            elif kind == "cancelled":
+                future.set_exception(JobCancelledError(payload))
+            else:
+                future.set_exception(RuntimeError(payload))
+
+    def __fail_worker(self, worker: DeviceWorker):
+        print(f"{self.__class__.__name__}: replica on {worker.device} exited with code {worker.process.exitcode}")
+        with self._lock:
+            worker.alive = False
+            lost = list(worker.in_flight.values())
+            worker.in_flight.clear()
+        for (future, _) in lost:
+            future.set_exception(RuntimeError(f"Device worker on {worker.device} exited"))
+
+    def __relay_cancellations(self):
+        while True:
+            time.sleep(self.poll_interval_s)
+            with self._lock:
+                stopping = [
+                    (worker, key, reason)
+                    for worker in self.workers
+                    for (key, (_, observer)) in worker.in_flight.items()
+                    if key not in worker.cancelled and observer is not None and (reason := observer.stop_reason())
+                ]
+                for (worker, key, _) in stopping:
+                    worker.cancelled.add(key)
+            for (worker, key, reason) in stopping:
+                worker.requests.put(("cancel", key, reason))
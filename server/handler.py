@@ -1,12 +1,29 @@
 import runpod
 import asyncio
-from typing import Any, List
+import functools
+from concurrent.futures import Future
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
 from pydantic import ValidationError
 from ez_diffusion_client import ImageGenerateRequest, ImageGenerationParams
-from imagegen_service import ImageGenService
-from pipeline_factory import SDImagePipelineFactory
+from imagegen_service import ImageGenService, image_affinity_key
+from admission import AdmissionController, CostModel
+from caching import ResultCache, result_cache_namespace
+from checkpointing import Checkpointer, FilesystemCheckpointStore
+from degradation import QualityDegradation, default_degradation_levels
+from device_pool import DevicePool
+from inference_executor import InferenceExecutor, submit_with_deferral
+from preemption import PreemptiveExecutor
+from scheduling import build_scheduling_policy, parse_tenant_weights
+from singleflight import SingleFlight, coalescing_key
+from request_batcher import ImageGenBatcher
+from staged_pipeline import StagedImagePipeline
+from worker_concurrency import VramConcurrencyController
+from utils import list_devices
+from step_hooks import CancellationToken, ObserverGroup, ProgressReporter
+from models import RequestOptions
+from pipeline_factory import SDImagePipelineFactory, model_revision
 from controlnet_factory import SD15Fp16ControlNetGetter, SDXLFp16ControlNetUnionGetter
-from controlnet_params_factory import MultiModelControlnetParamsFactory, ControlnetUnionParamsFactory
+from controlnet_params_factory import ControlnetGuideImagePreprocessor, MultiModelControlnetParamsFactory, ControlnetUnionParamsFactory
 from ltxv_service import LTXVideoService
 from wan_videogen_service import WanVideoGenService
 
@@ -17,19 +34,24 @@ def get_handler_type_from_manifest(manifest):
         handler_type = manifest.get("base_model_type", None)
     return handler_type
 
-def get_service_params_from_manifest(manifest):
-    handler_type = get_handler_type_from_manifest(manifest)
+def get_base_model_from_manifest(manifest) -> str:
     base_model = "Lykon/dreamshaper-8"
     if manifest: 
         pipes: List[Any] = manifest.get("pipelines", [])
         base_model = next((p.get("hf_repo") for p in pipes if p.get("hf_repo")), base_model)
+    return base_model
+
+def get_service_params_from_manifest(manifest, device: Optional[str] = None):
+    handler_type = get_handler_type_from_manifest(manifest)
+    base_model = get_base_model_from_manifest(manifest)
 
     if handler_type == "sdxl":
         return { 
             "base_model": base_model,
             "pipeline_factory": SDImagePipelineFactory(
                 base_model=base_model,
-                get_controlnet=SDXLFp16ControlNetUnionGetter()
+                get_controlnet=SDXLFp16ControlNetUnionGetter(),
+                device=device
             ),
             "controlnet_params_factory": ControlnetUnionParamsFactory()
         }
@@ -38,13 +60,16 @@ def get_service_params_from_manifest(manifest):
             "base_model": base_model,
             "pipeline_factory": SDImagePipelineFactory(
                 base_model=base_model,
-                get_controlnet=SD15Fp16ControlNetGetter()
+                get_controlnet=SD15Fp16ControlNetGetter(),
+                device=device
             ),
             "controlnet_params_factory": MultiModelControlnetParamsFactory()
         }
     
-def get_service_from_manifest(manifest):
-    params = get_service_params_from_manifest(manifest)
+def get_service_from_manifest(manifest, device: Optional[str] = None):
+    params = get_service_params_from_manifest(manifest, device)
+    if manifest:
+        ControlnetGuideImagePreprocessor.annotator_pool.preload(manifest.get("annotators") or [])
     try:
         return ImageGenService(
             pipeline_factory=params.pop("pipeline_factory"),
@@ -53,7 +78,187 @@ def get_service_from_manifest(manifest):
     except KeyError as e:
         return None
 
+def get_service(manifest, device: Optional[str] = None):
+    """Build the service the manifest asks for on `device`, the default device when None."""
+    handler_type = get_handler_type_from_manifest(manifest)
+    if handler_type == "wan22":
+        return WanVideoGenService(device=device)
+    elif handler_type == "ltxv":
+        return LTXVideoService(device=device)
+    return get_service_from_manifest(manifest, device)
+
+
+def get_checkpointer_factory(args) -> Callable[[Dict[str, Any]], Optional[Checkpointer]]:
+    """Checkpoint jobs under their job id, which RunPod keeps when it hands an unfinished job to another worker."""
+    if not args.checkpoint_dir:
+        return lambda job: None
+    store = FilesystemCheckpointStore(args.checkpoint_dir)
+    return lambda job: Checkpointer(store, job["id"], job.get("input", {}), args.checkpoint_every)
+
+def enable_degradation(service, args, executor: InferenceExecutor, admission: AdmissionController):
+    """Lower the quality of image jobs while the executor's queue is deep, per `--degrade_queue_depth` and `--degrade_wait_s`."""
+    if isinstance(service, ImageGenService) and (args.degrade_queue_depth is not None or args.degrade_wait_s is not None):
+        service.degradation = QualityDegradation(
+            default_degradation_levels(args.degrade_queue_depth, args.degrade_wait_s),
+            load=lambda: (executor.queue_depth, admission.predicted_wait()),
+        )
+
+def image_batch_size(service, args) -> int:
+    """
+    Image jobs per pipeline call. `--max_batch_size` if set, else `--max_concurrency` in --concurrent mode, where
+    batches are how image jobs co-run, unless --prepare_workers or preemption co-run them, or --checkpoint_dir needs
+    them unbatched.
+    """
+    if not isinstance(service, ImageGenService):
+        return 1
+    if args.max_batch_size > 1:
+        return args.max_batch_size
+    if args.concurrent and args.prepare_workers <= 0 and args.preempt_time_slice_s is None and not args.checkpoint_dir:
+        return args.max_concurrency
+    return 1
+
+def get_job_submitter(service, args) -> Callable[..., Future]:
+    """
+    Route jobs through one GPU thread, merging compatible image jobs into batches when enabled.
+    Jobs are admitted by predicted cost when `--latency_budget_s` is set.
+    """
+    admission = AdmissionController(CostModel(service.seconds_per_work_unit), latency_budget_s=args.latency_budget_s)
+    policy = build_scheduling_policy(args.affinity_window, args.fair_share, args.tenant_weights, args.max_queue_per_tenant)
+    options_of = lambda job: RequestOptions.from_job_input(job.get("input", {}))
+    checkpointer_for = get_checkpointer_factory(args)
+    if (max_batch_size := image_batch_size(service, args)) > 1:
+        batcher = ImageGenBatcher(
+            service,
+            max_batch_size=max_batch_size,
+            max_wait_ms=args.max_batch_wait_ms,
+            max_queue_size=args.max_queue_size,
+            admission=admission,
+            policy=policy
+        )
+        enable_degradation(service, args, batcher, admission)
+        return lambda job, observer=None: batcher.submit(
+            ImageGenerationParams(**job.get("input", {})),
+            observer,
+            options_of(job).tenant,
+            checkpointer_for(job)
+        )
+
+    if args.preempt_time_slice_s is not None:
+        executor = PreemptiveExecutor(max_queue_size=args.max_queue_size, name="rp-worker", admission=admission, policy=policy, time_slice_s=args.preempt_time_slice_s)
+    else:
+        executor = InferenceExecutor(max_queue_size=args.max_queue_size, name="rp-worker", admission=admission, policy=policy)
+    enable_degradation(service, args, executor, admission)
+    scheduling_of = lambda job: dict(
+        work=service.estimate_work(job.get("input", {})),
+        affinity=service.affinity_key(job.get("input", {})),
+        tenant=options_of(job).tenant,
+        priority=options_of(job).priority
+    )
+    if isinstance(service, ImageGenService) and args.prepare_workers > 0:
+        staged = StagedImagePipeline(service, executor, prepare_workers=args.prepare_workers, encode_workers=args.prepare_workers)
+        return lambda job, observer=None: staged.submit(
+            ImageGenerationParams(**job.get("input", {})),
+            observer,
+            checkpointer_for(job),
+            **scheduling_of(job)
+        )
+    return lambda job, observer=None: executor.submit(
+        service.rp_worker_generate,
+        job,
+        observer=observer,
+        checkpointer=checkpointer_for(job),
+        **scheduling_of(job)
+    )
+
+def co_running_jobs(service, args) -> int:
+    """How many jobs the submitter of `get_job_submitter` runs at once, rather than queueing them."""
+    if (max_batch_size := image_batch_size(service, args)) > 1:
+        return max_batch_size
+    # A preempting job runs nested inside the one it paused.
+    preempting = 1 if args.preempt_time_slice_s is not None else 0
+    if isinstance(service, ImageGenService) and args.prepare_workers > 0:
+        # One job denoising while others are prepared and encoded.
+        return 1 + 2 * args.prepare_workers + preempting
+    return 1 + preempting
+
+def coalesce_image_jobs(submit_job, args) -> Callable[..., Future]:
+    """Let identical seeded image jobs share one in-flight generation, unless `--no_coalescing` is set."""
+    if args.no_coalescing:
+        return submit_job
+    flights = SingleFlight()
+    return lambda job, observer=None: flights.submit(
+        coalescing_key(ImageGenerationParams(**job.get("input", {}))),
+        observer,
+        lambda observer: submit_job(job, observer)
+    )
+
+def cache_image_results(submit_job, args, manifest) -> Callable[..., Future]:
+    """Answer seeded image jobs from the result cache when `--result_cache_mb` or `--result_cache_dir` is set."""
+    if not (args.result_cache_mb > 0 or args.result_cache_dir):
+        return submit_job
+    base_model = get_base_model_from_manifest(manifest)
+    revision = model_revision(base_model)
+    if revision is None:
+        print(f"Result cache disabled: no local snapshot of {base_model} to tell its revision")
+        return submit_job
+    cache = ResultCache(
+        result_cache_namespace(base_model, revision, manifest=manifest),
+        memory_bytes=args.result_cache_mb * 1024 ** 2,
+        disk_dir=args.result_cache_dir,
+        disk_bytes=args.result_cache_disk_mb * 1024 ** 2,
+    )
+
+    def submit(job, observer=None) -> Future:
+        job_input = job.get("input", {})
+        if RequestOptions.from_job_input(job_input).no_cache:
+            return submit_job(job, observer)
+        return cache.submit(cache.key(ImageGenerationParams(**job_input)), lambda: submit_job(job, observer))
+    return submit
+
+async def run_job(submit_job, job, max_defer_s: float = 0) -> Dict[str, Any]:
+    """Run a job to completion. RunPod cancelling the job stops it at the next denoising step."""
+    cancellation = None
+    try:
+        cancellation = CancellationToken(RequestOptions.from_job_input(job.get("input", {})).deadline_s)
+        future = await submit_with_deferral(lambda: submit_job(job, cancellation), max_defer_s)
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        if cancellation is not None:
+            cancellation.cancel()
+        raise
+    except ValidationError as e:
+        return {"error": f"Invalid input: {str(e)}"}
+    except Exception as e:
+        return {"error": str(e)}
+
+async def stream_job(submit_job, job, max_defer_s: float = 0) -> AsyncGenerator[Dict[str, Any], None]:
+    """Yield progress events from the denoising loop while the job runs, then the job's result."""
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    emit = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+    try:
+        options = RequestOptions.from_job_input(job.get("input", {}))
+        cancellation = CancellationToken(options.deadline_s)
+        observer = ObserverGroup(ProgressReporter(emit, preview_every=options.preview_every), cancellation)
+        future = await submit_with_deferral(lambda: submit_job(job, observer), max_defer_s)
+    except ValidationError as e:
+        yield {"error": f"Invalid input: {str(e)}"}
+        return
+    except Exception as e:
+        yield {"error": str(e)}
+        return
 
+    future.add_done_callback(lambda _: emit(None))
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        cancellation.cancel()
+        raise
+    try:
+        yield future.result()
+    except Exception as e:
+        yield {"error": str(e)}
 
 async def test_handler(job):
     input = job["input"]
@@ -83,6 +288,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "--rp_api_port", type=int, default=8000, help="Port to start the FastAPI server on."
     )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="Register an async handler that takes several jobs at once, scaled by free device memory.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream per-step progress events, and latent previews when the job sets `options.preview_every`.",
+    )
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Upper bound for concurrent jobs in --concurrent mode. Image jobs co-run in batches of up to this many unless --max_batch_size, --prepare_workers, --preempt_time_slice_s or --checkpoint_dir is set.")
+    parser.add_argument("--max_batch_size", type=int, default=1, help="Merge up to this many compatible image jobs into one pipeline call.")
+    parser.add_argument("--max_batch_wait_ms", type=float, default=20, help="How long a job may wait for compatible jobs to batch with.")
+    parser.add_argument("--max_queue_size", type=int, default=16, help="Jobs allowed to wait for the GPU in --concurrent mode.")
+    parser.add_argument("--latency_budget_s", type=float, default=None, help="Fail jobs whose predicted wait plus run time exceeds this many seconds.")
+    parser.add_argument("--max_defer_s", type=float, default=0, help="How long a job that doesn't fit the latency budget may wait for room first.")
+    parser.add_argument("--affinity_window", type=int, default=0, help="Let jobs sharing the loaded pipeline and LoRAs overtake the oldest job up to this many times.")
+    parser.add_argument("--fair_share", action="store_true", help="Share GPU time fairly between tenants, set per job with `input.options.tenant`.")
+    parser.add_argument("--tenant_weights", type=parse_tenant_weights, default=None, help="Relative GPU share per tenant as `tenant=weight` pairs. Unlisted tenants weigh 1.")
+    parser.add_argument("--max_queue_per_tenant", type=int, default=None, help="Jobs one tenant may have waiting in --concurrent mode.")
+    parser.add_argument("--devices", type=str, default=None, help="Run one replica per device, `auto` or a comma separated list such as `cuda:0,cuda:1`, and spread jobs over them.")
+    parser.add_argument("--checkpoint_dir", type=str, default=None, help="Save denoising progress of unbatched jobs here, so a retried job resumes where it stopped. A job with a checkpoint to resume runs unbatched.")
+    parser.add_argument("--checkpoint_every", type=int, default=5, help="Denoising steps between checkpoints.")
+    parser.add_argument("--preempt_time_slice_s", type=float, default=None, help="Let higher `input.options.priority` image jobs pause a running image job of the same pipeline, LoRAs and ControlNets at a step boundary once it has run this many seconds. Not supported for video manifests.")
+    parser.add_argument("--degrade_queue_depth", type=int, default=None, help="Cap steps, then also enable DeepCache, then also shrink and upscale images of image jobs once this many, twice and three times as many jobs are queued in --concurrent mode.")
+    parser.add_argument("--degrade_wait_s", type=float, default=None, help="Like --degrade_queue_depth, for the predicted queue wait in seconds.")
+    parser.add_argument("--no_coalescing", action="store_true", help="Run every image job, instead of letting identical seeded jobs in --concurrent and --devices mode share one in-flight generation.")
+    parser.add_argument("--result_cache_mb", type=int, default=0, help="Memory for responses of seeded image jobs in --concurrent and --devices mode, returned without generating when an identical job comes again. 0 keeps them in memory only with --result_cache_dir.")
+    parser.add_argument("--result_cache_dir", default=None, help="Also keep cached responses as files in this directory, where they survive restarts.")
+    parser.add_argument("--result_cache_disk_mb", type=int, default=1024, help="Disk space for --result_cache_dir, least recently used responses removed first.")
+    parser.add_argument("--prepare_workers", type=int, default=0, help="Threads each for preparing image jobs and encoding their results next to the GPU thread in --concurrent mode. 0 runs everything on the GPU thread.")
     # Test input
     parser.add_argument(
         "--test_input",
@@ -106,34 +342,94 @@ if __name__ == "__main__":
         print(f"Failed to load manifest file given path: {manifest_path}. Error: {e}")
 
     handler_type = get_handler_type_from_manifest(manifest)
+    if args.preempt_time_slice_s is not None and handler_type in ("wan22", "ltxv"):
+        parser.error("--preempt_time_slice_s only preempts image jobs, video jobs run to completion one at a time")
 
-    service = None
-    if handler_type == "wan22":
-        service = WanVideoGenService()
-    if handler_type == "ltxv":
-        service = LTXVideoService()
-    else: 
-        service = get_service_from_manifest(manifest)
+    # With --devices every replica builds its own service in its own process.
+    service = None if args.devices else get_service(manifest)
+
+    if args.devices:
+        if args.stream:
+            parser.error("--devices doesn't relay progress events, run it without --stream")
+        devices = list_devices() if args.devices == "auto" else args.devices.split(",")
+        is_video = handler_type in ("wan22", "ltxv")
+        pool = DevicePool(
+            functools.partial(get_service, manifest),
+            devices,
+            affinity_key=None if is_video else image_affinity_key,
+            max_queue_size=args.max_queue_size,
+        )
+        pool.wait_ready()
+        submit_job = pool.submit if is_video else cache_image_results(coalesce_image_jobs(pool.submit, args), args, manifest)
+
+        async def pool_handler(job):
+            """RunPod serverless handler that spreads jobs over the device replicas."""
+            return await run_job(submit_job, job, args.max_defer_s)
 
-    if service is not None:
+        runpod.serverless.start({
+            "handler": pool_handler,
+            "return_aggregate_stream": True,
+            # Video replicas run one job at a time, image replicas keep a few queued.
+            "concurrency_modifier": lambda current: len(devices) * (1 if is_video else args.max_concurrency)
+        })
+    elif service is not None:
         svc = service
         svc.warmup()
+        checkpointer_for = get_checkpointer_factory(args)
         def handler(job):
             """RunPod serverless handler function."""
             try:
                  # Validate input using Pydantic
                 try:
                     # Generate image
-                    return svc.rp_worker_generate(job)
+                    deadline_s = RequestOptions.from_job_input(job.get("input", {})).deadline_s
+                    return svc.rp_worker_generate(job, CancellationToken(deadline_s), checkpointer_for(job))
                 except ValidationError as e:    
                     return {"error": f"Invalid input: {str(e)}"}
             except Exception as e:
                 return {"error": str(e)}
-            
-        runpod.serverless.start({
-            "handler": handler,
-            "return_aggregate_stream": True
-        })
+
+        if args.concurrent or args.stream:
+            if image_batch_size(svc, args) > args.max_batch_size:
+                # Image jobs co-run by sharing pipeline calls. Without that, extra jobs would only queue on the GPU thread.
+                print(f"--concurrent batches up to {image_batch_size(svc, args)} image jobs")
+            submit_job = get_job_submitter(svc, args)
+            if isinstance(svc, ImageGenService):
+                submit_job = cache_image_results(coalesce_image_jobs(submit_job, args), args, manifest)
+            concurrency = VramConcurrencyController(svc, max_concurrency=min(args.max_concurrency, co_running_jobs(svc, args)))
+
+            # Jobs take device memory from their first denoising step on, not while they queue.
+            submit_tracked = lambda job, observer=None: submit_job(job, ObserverGroup(observer, concurrency.running_observer(job["id"])))
+
+            async def async_handler(job):
+                """RunPod serverless handler that lets cheap jobs share the worker."""
+                try:
+                    concurrency.job_started(job["id"], job.get("input", {}))
+                    return await run_job(submit_tracked, job, args.max_defer_s)
+                finally:
+                    concurrency.job_finished(job["id"])
+
+            async def streaming_handler(job):
+                """RunPod generator handler yielding progress while the job runs."""
+                try:
+                    concurrency.job_started(job["id"], job.get("input", {}))
+                    async for event in stream_job(submit_tracked, job, args.max_defer_s):
+                        yield event
+                finally:
+                    concurrency.job_finished(job["id"])
+
+            config = {
+                "handler": streaming_handler if args.stream else async_handler,
+                "return_aggregate_stream": True
+            }
+            if args.concurrent:
+                config["concurrency_modifier"] = concurrency
+            runpod.serverless.start(config)
+        else:
+            runpod.serverless.start({
+                "handler": handler,
+                "return_aggregate_stream": True
+            })
     else:
         runpod.serverless.start({
             "handler": test_handler,
@@ -1,9 +1,14 @@
+import asyncio
+import contextlib
 import datetime
+from dataclasses import dataclass
+import traceback
+from concurrent.futures import Future
 from enum import Enum
 import os
 import torch
 import random
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any, Tuple, Union
 from diffusers.models.controlnets.controlnet import ControlNetModel
 from PIL import Image
 from io import BytesIO
@@ -11,101 +16,289 @@ import base64
 from pydantic import ValidationError
 import runpod
 import uvicorn
-from fastapi import FastAPI, HTTPException, responses
-from pipeline_factory import PipelineFactory, SDImagePipelineFactory
+from fastapi import Depends, FastAPI, HTTPException, responses
+from pipeline_factory import PipelineFactory, SDImagePipelineFactory, model_revision
 from controlnet_factory import FluxFp16ControlNetUnionGetter,  SD15Fp16ControlNetGetter, SDXLFp16ControlNetUnionGetter
 from controlnet_params_factory import MultiModelControlnetParamsFactory, ControlnetUnionParamsFactory, ControlnetParamsFactory
+from admission import AdmissionController, CostModel
+from caching import ResultCache, result_cache_namespace
+from checkpointing import Checkpointer
+from degradation import QualityDegradation, default_degradation_levels
+from inference_executor import InferenceExecutor, QueueFullError, submit_with_deferral
+from scheduling import build_scheduling_policy, parse_tenant_weights
+from singleflight import SingleFlight, coalescing_key
 from inference_service import RPWorkerInferenceService
-from utils import get_memory_info, load_image_from_base64_or_url, print_memory_info, resolve_device
+from job_queue import JobQueue
+from metrics import metrics
+from step_hooks import CancellationToken, JobCancelledError, ObserverGroup, StepObserver, raise_if_interrupted, step_end_callback
+from utils import get_free_memory_bytes, get_memory_info, load_image_from_base64_or_url, print_memory_info, resolve_device
 from ez_diffusion_client import ImageGenerateRequest, ImageGenerationParams
-from models import OpStatus
+from models import OpStatus, RequestOptions
 # from preload import load_models_from_manifest
 
+def image_affinity_key(
+    job_input: Dict[str, Any],
+    get_pipeline_key: Callable[[ImageGenerationParams], tuple] = SDImagePipelineFactory.pipeline_key,
+) -> tuple:
+    """The pipeline, LoRAs and DeepCache setting an image job needs loaded, see `ImageGenService.affinity_key`."""
+    input_params = ImageGenerationParams(**job_input)
+    optimizations = input_params.pipeline_optimizations
+    return (
+        get_pipeline_key(input_params),
+        tuple((lora.model, lora.weight_name) for lora in input_params.loras or []),
+        (optimizations.deepcache_interval, optimizations.deepcache_branch_id) if optimizations else None,
+    )
+
+@dataclass
+class PreparedBatch:
+    """A batch with its inputs loaded and preprocessed, ready for the denoising pipeline."""
+    batch: List[ImageGenerationParams]
+    kwargs: Dict[str, Any]
+    prompts: List[str]
+    negative_prompts: Optional[List[str]]
+    # Prompt embedding kwargs when the prompts could be encoded ahead of denoising.
+    prompt_embeds: Optional[Dict[str, Any]]
+    response: Dict[str, Any]
+    previews: List[Dict[str, Any]]
+    seeds: List[int]
+    # Set when `QualityDegradation` adjusted the batch, with the size to upscale results to if it shrank them.
+    degraded: bool = False
+    upscale_to: Optional[Tuple[int, int]] = None
+
 class ImageGenService(RPWorkerInferenceService):
     def __init__(
             self, 
             pipeline_factory: PipelineFactory,
             controlnet_params_factory: ControlnetParamsFactory,
-            local_debug: bool = False
+            local_debug: bool = False,
+            degradation: Optional[QualityDegradation] = None
         ):
        self.pipeline_factory = pipeline_factory
        self.local_debug = local_debug
        self.controlnet_params_factory = controlnet_params_factory
+       self.degradation = degradation
+
+    # Rough activation footprint used to decide how many jobs may share the device.
+    JOB_MEMORY_BASE_BYTES = 512 * 1024 ** 2
+    JOB_MEMORY_BYTES_PER_MEGAPIXEL = 3 * 1024 ** 3
+    # Work is counted in megapixel-steps. VAE decode and an annotator pass each cost about as much as a few of them.
+    WORK_STEPS_PER_DECODE = 5
+    WORK_PER_PREPROCESS = 2.5
+    seconds_per_work_unit = 0.2
 
     def warmup(self):
         return super().warmup()
+
+    def estimate_job_memory(self, job_input: Dict[str, Any]) -> int:
+        dimensions = job_input.get("dimensions") or {}
+        megapixels = (dimensions.get("width") or 512) * (dimensions.get("height") or 512) / 1e6
+        controlnets = len(job_input.get("controlnets") or [])
+        return int(self.JOB_MEMORY_BASE_BYTES + self.JOB_MEMORY_BYTES_PER_MEGAPIXEL * megapixels * (1 + 0.5 * controlnets))
+
+    def estimate_work(self, job_input: Dict[str, Any]) -> float:
+        dimensions = job_input.get("dimensions") or {}
+        megapixels = (dimensions.get("width") or 512) * (dimensions.get("height") or 512) / 1e6
+        controlnets = job_input.get("controlnets") or []
+        preprocessed = sum(1 for cn in controlnets if isinstance(cn, dict) and cn.get("needs_preprocess"))
+        steps = job_input.get("inference_steps") or 50
+        return megapixels * (steps * (1 + 0.5 * len(controlnets)) + self.WORK_STEPS_PER_DECODE) + self.WORK_PER_PREPROCESS * preprocessed
     
-    def rp_worker_generate(self, job) -> Any:
+    def rp_worker_generate(self, job, observer: Optional[StepObserver] = None, checkpointer: Optional[Checkpointer] = None) -> Any:
         input = job.get("input", {})
         req = ImageGenerateRequest(input=ImageGenerationParams(**input))
-        return self.generate(req.input)
+        return self.generate(req.input, observer, checkpointer)
+
+    def affinity_key(self, job_input: Dict[str, Any]) -> Optional[tuple]:
+        return image_affinity_key(job_input, self.pipeline_factory.get_pipeline_key)
+
+    def batch_key(self, input_params: ImageGenerationParams) -> Optional[tuple]:
+        """Requests with equal keys can share one batched pipeline call. None means the request must run alone."""
+        if input_params.inpaint:
+            return None
+        if input_params.controlnets and not self.controlnet_params_factory.supports_batching:
+            return None
+
+        optimizations = input_params.pipeline_optimizations
+        return (
+            self.pipeline_factory.get_pipeline_key(input_params),
+            input_params.dimensions.width,
+            input_params.dimensions.height,
+            input_params.inference_steps,
+            input_params.guidance_scale,
+            input_params.negative_prompt is None,
+            tuple((lora.model, lora.weight_name, lora.scale) for lora in input_params.loras or []),
+            tuple((cn.processor_type, cn.needs_preprocess, cn.controlnet_conditioning_scale, cn.control_guidance_start, cn.control_guidance_end, cn.guess_mode) for cn in input_params.controlnets or []),
+            optimizations.to_json() if optimizations else None,
+        )
 
     def generate(
         self,
         input_params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        checkpointer: Optional[Checkpointer] = None,
     ) -> Dict[str, Any]:
         """Generate an image based on the provided parameters."""
+        return self.generate_batch([input_params], [observer], checkpointer)[0]
+
+    def generate_batch(
+        self,
+        batch: List[ImageGenerationParams],
+        observers: Optional[List[Optional[StepObserver]]] = None,
+        checkpointer: Optional[Checkpointer] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Generate one image per request in a single pipeline call. All requests must share the same `batch_key`.
+        A `checkpointer` saves and resumes the denoising of a single text-to-image request.
+        """
         try:
-            controlnets = input_params.controlnets
+            prepared = self.prepare_batch(batch, checkpointer)
+            images = self.denoise_batch(prepared, observers, checkpointer)
+            return self.encode_batch(prepared, images)
+        except Exception as e:
+            if self.local_debug:
+                print(f"Problem occured: {e}")
+            raise e
 
-            if input_params.seed is not None:
-                seed = input_params.seed
-            else: 
-                seed = random.getrandbits(64)
+    def prepare_batch(self, batch: List[ImageGenerationParams], checkpointer: Optional[Checkpointer] = None) -> PreparedBatch:
+        """
+        The part of `generate_batch` that doesn't need the denoising pipeline to itself: loading input images,
+        ControlNet preprocessing and, unless LoRAs have to be loaded first, prompt encoding. Under load the batch is
+        first adjusted by `degradation`, except when it resumes from a checkpoint.
+        """
+        (warnings, upscale_to) = ([], None)
+        if self.degradation is not None and not (checkpointer is not None and checkpointer.resume_state() is not None):
+            (batch, warnings, upscale_to) = self.degradation.degrade(batch)
+        input_params = batch[0]
+        kwargs = {**input_params.dimensions.to_dict(), "prompt": input_params.prompt}
+        response = {"warnings": [*warnings]}
+        (kwargs, response) = self.controlnet_params_factory.get_batch_pipeline_controlnet_params(
+            batch, kwargs, response, self.pipeline_factory.control_image_target()
+        )
 
-            generator = torch.Generator(device=resolve_device()).manual_seed(seed)
+        previews = [{} for _ in batch]
+        if input_params.image_to_image:
+            images = []
+            for (i, params) in enumerate(batch):
+                img = load_image_from_base64_or_url(params.image_to_image.starting_image.source, params.dimensions.width, params.dimensions.height)
+                buffer = BytesIO()
+                img.save(buffer, format="JPEG")
+                previews[i] = {"resized_preview": "data:image/jpeg;base64,"+ base64.b64encode(buffer.getvalue()).decode("utf-8")}
+                images.append(img)
+            (width, height) = images[0].size
+            kwargs = {"image": self.__unbatch(images), "width": width, "height": height, **kwargs}
 
-            prompt = input_params.prompt
-            kwargs = {**input_params.dimensions.to_dict(), "prompt": prompt}
-            response = {"prompt": prompt, "seed": seed, "warnings": []}
+        prompts = [self.pipeline_factory.tag_prompt(params.prompt, params.loras) for params in batch]
+        negative_prompts = None if input_params.negative_prompt is None else [params.negative_prompt for params in batch]
+        embeds = self.pipeline_factory.encode_prompts(prompts, negative_prompts, input_params.guidance_scale, input_params.loras)
 
-            (kwargs, response) = self.pipeline_factory.setup(input_params, kwargs, response)
-            (kwargs, response) = self.controlnet_params_factory.get_pipeline_controlnet_params(input_params, kwargs, response) 
+        seeds = [params.seed if params.seed is not None else random.getrandbits(64) for params in batch]
+        return PreparedBatch(
+            batch=batch,
+            kwargs=kwargs,
+            prompts=prompts,
+            negative_prompts=negative_prompts,
+            prompt_embeds=embeds,
+            response=response,
+            previews=previews,
+            seeds=seeds,
+            degraded=bool(warnings),
+            upscale_to=upscale_to,
+        )
 
-            pipe = self.pipeline_factory.get_pipeline_for_inputs(input_params)
+    def denoise_batch(
+        self,
+        prepared: PreparedBatch,
+        observers: Optional[List[Optional[StepObserver]]] = None,
+        checkpointer: Optional[Checkpointer] = None,
+        decode: bool = True,
+    ) -> Union[List[Image.Image], torch.Tensor]:
+        """
+        Run the pipeline for a batch from `prepare_batch`. A resumed checkpoint replaces `prepared.seeds`.
+        Without `decode` the final latents are returned, for `PipelineFactory.decode_latents` to finish.
+        """
+        batch = prepared.batch
+        input_params = batch[0]
+        if checkpointer is not None and (len(batch) > 1 or input_params.image_to_image or input_params.inpaint or prepared.degraded):
+            # Image-to-image and inpaint pipelines derive their starting latents from the input image.
+            # Checkpoints are matched by the request's original inputs, which a degraded run no longer follows.
+            checkpointer = None
+        resume = checkpointer.resume_state() if checkpointer is not None else None
+        if resume is not None:
+            prepared.seeds = [resume["seed"]]
 
-            print_memory_info()
+        (kwargs, prepared.response) = self.pipeline_factory.setup(input_params, prepared.kwargs, prepared.response)
+        embeds = prepared.prompt_embeds
+        if embeds is None:
+            # Prompts of requests with LoRAs can be encoded once `setup` has loaded them.
+            embeds = self.pipeline_factory.encode_prompts(prepared.prompts, prepared.negative_prompts, input_params.guidance_scale, input_params.loras)
+        if embeds is not None:
+            prompt_kwargs = {"prompt": None, "negative_prompt": None, **embeds}
+        else:
+            prompt_kwargs = {"prompt": self.__unbatch(prepared.prompts), "negative_prompt": self.__unbatch(prepared.negative_prompts) if prepared.negative_prompts else None}
 
-            if input_params.image_to_image: 
-                img = load_image_from_base64_or_url(input_params.image_to_image.starting_image.source, input_params.dimensions.width, input_params.dimensions.height)
-                (width, height) = img.size
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG")
-                img_str = "data:image/jpeg;base64,"+ base64.b64encode(buffer.getvalue()).decode("utf-8")
-                response = { "resized_preview": img_str, **response}
-                kwargs = {"image": img, "width": width, "height": height, **kwargs}
-            
-            # Generate image
+        pipe = self.pipeline_factory.get_pipeline_for_inputs(input_params)
+        # Seeded on the pipeline's own device, which is not the default one for replicas in a `DevicePool`.
+        generators = [torch.Generator(device=pipe.device).manual_seed(seed) for seed in prepared.seeds]
+
+        print_memory_info()
+
+        if checkpointer is not None:
+            checkpointer.seed = prepared.seeds[0]
+            observers = [ObserverGroup(*(observers or []), checkpointer)]
+        if resume is not None:
+            # SD pipelines scale given latents by the scheduler's `init_noise_sigma`, which is 1 for the factory's DDIM scheduler.
+            kwargs = {**kwargs, "latents": resume["latents"]}
+
+        callback = step_end_callback(observers or [], input_params.inference_steps)
+        if callback is not None:
+            kwargs = {**kwargs, "callback_on_step_end": callback, "callback_on_step_end_tensor_inputs": ["latents"]}
+
+        # Generate images
+        with checkpointer.resuming(pipe.scheduler) if checkpointer is not None else contextlib.nullcontext():
             result = pipe(
-                prompt=prompt,
-                negative_prompt=input_params.negative_prompt,
-                num_inference_steps=input_params.inference_steps,
-                guidance_scale=input_params.guidance_scale,
-                generator=generator,
-                **kwargs
+                **{
+                    **kwargs,
+                    **prompt_kwargs,
+                    "num_inference_steps": input_params.inference_steps,
+                    "guidance_scale": input_params.guidance_scale,
+                    "generator": self.__unbatch(generators),
+                    "output_type": "pil" if decode else "latent",
+                }
             )
+        raise_if_interrupted(pipe, observers or [])
+        if checkpointer is not None:
+            checkpointer.complete()
+        return result.images
 
-            image = result.images[0]
+    def encode_batch(self, prepared: PreparedBatch, images: List[Image.Image]) -> List[Dict[str, Any]]:
+        """Build the responses of a denoised batch."""
+        if prepared.upscale_to is not None:
+            images = [image.resize(prepared.upscale_to, Image.LANCZOS) for image in images]
+        return [
+            self.build_response(image, {**preview, "prompt": params.prompt, "seed": seed, "warnings": [*prepared.response["warnings"]]}, prepared.kwargs)
+            for (image, params, seed, preview) in zip(images, prepared.batch, prepared.seeds, prepared.previews)
+        ]
 
-            if self.local_debug:
-                print("Local debug enabled. Saving image to file.")
-                print(kwargs)
-                # image saved with output timestamp
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"output_{timestamp}.png"
-                image.save(filename)
-                return {"status": "success", "image": filename, **response}
-            else: 
-                # Convert to base64
-                buffer = BytesIO()
-                image.save(buffer, format="PNG")
-                img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-                return {"image": img_str, **response}
+    def __unbatch(self, values: list):
+        # Keep single requests on the exact same pipeline call they had before batching existed.
+        return values[0] if len(values) == 1 else values
 
-        except Exception as e:
-            if self.local_debug:
-                print(f"Problem occured: {e}")
-            raise e
+    def build_response(self, image: Image.Image, response: Dict[str, Any], kwargs) -> Dict[str, Any]:
+        """Attach the generated image to the response, or save it to disk in local debug mode."""
+        if self.local_debug:
+            print("Local debug enabled. Saving image to file.")
+            print(kwargs)
+            # image saved with output timestamp
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+            filename = f"output_{timestamp}.png"
+            image.save(filename)
+            return {"status": "success", "image": filename, **response}
+        else: 
+            # Convert to base64
+            buffer = BytesIO()
+            image.save(buffer, format="PNG")
+            img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
+            return {"image": img_str, **response}
 
 if __name__ == "__main__":
     import argparse
@@ -117,6 +310,50 @@ if __name__ == "__main__":
     parser.add_argument("--default_controlnet_model", default="lllyasviel/sd-controlnet-openpose")
     parser.add_argument("--model", default="stable-diffusion-v1-5/stable-diffusion-v1-5", 
                        help="Base model path or identifier")
+    parser.add_argument("--max_batch_size", default=1, type=int,
+                       help="Merge up to this many compatible requests into one pipeline call. 1 disables batching.")
+    parser.add_argument("--max_batch_wait_ms", default=20, type=float,
+                       help="How long the first request of a batch may wait for compatible requests to arrive.")
+    parser.add_argument("--max_queue_size", default=16, type=int,
+                       help="Requests allowed to wait for the GPU before new ones are rejected with 503 and Retry-After.")
+    parser.add_argument("--max_retained_jobs", default=256, type=int,
+                       help="How many finished async jobs are kept around for polling.")
+    parser.add_argument("--continuous_batching", action="store_true",
+                       help="Let text-to-image requests join and leave a running denoise batch at step boundaries. Other requests run once the batch has drained.")
+    parser.add_argument("--latency_budget_s", default=None, type=float,
+                       help="Reject requests whose predicted queue wait plus run time exceeds this many seconds.")
+    parser.add_argument("--max_defer_s", default=0, type=float,
+                       help="How long a request that doesn't fit the latency budget may wait for room before it is rejected.")
+    parser.add_argument("--affinity_window", default=0, type=int,
+                       help="Let requests sharing the loaded pipeline and LoRAs overtake the oldest request up to this many times. 0 keeps arrival order.")
+    parser.add_argument("--fair_share", action="store_true",
+                       help="Share GPU time fairly between tenants, set per request with the `tenant` option.")
+    parser.add_argument("--tenant_weights", default=None, type=parse_tenant_weights,
+                       help="Relative GPU share per tenant as `tenant=weight` pairs, e.g. `interactive=4,bulk=0.5`. Unlisted tenants weigh 1.")
+    parser.add_argument("--max_queue_per_tenant", default=None, type=int,
+                       help="Requests one tenant may have waiting before its new ones are rejected with 503.")
+    parser.add_argument("--preempt_time_slice_s", default=None, type=float,
+                       help="Let higher `priority` requests pause a running request of the same pipeline, LoRAs and ControlNets at a step boundary once it has run this many seconds. Ignored when batching.")
+    parser.add_argument("--degrade_queue_depth", default=None, type=int,
+                       help="Cap steps, then also enable DeepCache, then also shrink and upscale images once this many, twice and three times as many requests are queued. Adjustments are listed in `warnings`.")
+    parser.add_argument("--degrade_wait_s", default=None, type=float,
+                       help="Like --degrade_queue_depth, for the predicted queue wait in seconds.")
+    parser.add_argument("--prepare_workers", default=0, type=int,
+                       help="Load inputs, run annotators and encode prompts and output images on this many threads each, next to the denoising thread. 0 runs everything on the denoising thread. Ignored when batching.")
+    parser.add_argument("--no_coalescing", action="store_true",
+                       help="Run every request, instead of letting identical seeded requests share one in-flight generation.")
+    parser.add_argument("--embedding_cache_mb", default=128, type=int,
+                       help="Memory on the model's device for cached prompt embeddings, least recently used evicted first. 0 disables the cache.")
+    parser.add_argument("--embedding_cache_ttl_s", default=None, type=float,
+                       help="Drop cached prompt embeddings after this many seconds. Unset keeps them until evicted.")
+    parser.add_argument("--result_cache_mb", default=0, type=int,
+                       help="Memory for responses of seeded requests, returned without generating when an identical request comes again. 0 keeps them in memory only with --result_cache_dir.")
+    parser.add_argument("--result_cache_dir", default=None,
+                       help="Also keep cached responses as files in this directory, where they survive restarts and are shared by --prefork workers.")
+    parser.add_argument("--result_cache_disk_mb", default=1024, type=int,
+                       help="Disk space for --result_cache_dir, least recently used responses removed first.")
+    parser.add_argument("--prefork", default=1, type=int,
+                       help="Load the model once and fork this many CPU workers that share its weights and the listening port, each pinned to its own cores. `cpu_benchmark.py` finds the best count for a host.")
     
     args = parser.parse_args()
 
@@ -125,8 +362,9 @@ if __name__ == "__main__":
 
     os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
+    embedding_cache = {"embedding_cache_bytes": args.embedding_cache_mb * 1024 ** 2, "embedding_cache_ttl_s": args.embedding_cache_ttl_s}
     if args.diffusion_base_model == "sdxl":
-        pipe_wrapper = SDImagePipelineFactory(base_model=args.model, get_controlnet=SDXLFp16ControlNetUnionGetter())
+        pipe_wrapper = SDImagePipelineFactory(base_model=args.model, get_controlnet=SDXLFp16ControlNetUnionGetter(), **embedding_cache)
         controlnet_params_factory = ControlnetUnionParamsFactory()
     # if args.diffusion_base_model == "flux":
     #     pipe_wrapper = SDImagePipelineFactory(base_model=args.model, get_controlnet=FluxFp16ControlNetUnionGetter())
@@ -135,7 +373,7 @@ if __name__ == "__main__":
     #     pipe_wrapper = 
     else:
         # SD 1.5 default
-        pipe_wrapper = SDImagePipelineFactory(base_model=args.model)
+        pipe_wrapper = SDImagePipelineFactory(base_model=args.model, **embedding_cache)
         controlnet_params_factory = MultiModelControlnetParamsFactory()
 
     diff_service = ImageGenService(
@@ -144,63 +382,209 @@ if __name__ == "__main__":
         local_debug=True
     )
 
+    # Fork before the executor starts its thread, each worker gets its own.
+    listen_socket = None
+    if args.prefork > 1:
+        from prefork import pipeline_modules, prefork, share_weights
+        if resolve_device() != "cpu":
+            parser.error("--prefork only works with CPU inference, CUDA can't be used from forked workers")
+        share_weights(pipeline_modules(pipe_wrapper.base_pipeline))
+        listen_socket = prefork(args.prefork, args.host, args.port)
+
+    admission = AdmissionController(CostModel(diff_service.seconds_per_work_unit), latency_budget_s=args.latency_budget_s)
+    policy = build_scheduling_policy(args.affinity_window, args.fair_share, args.tenant_weights, args.max_queue_per_tenant)
+
+    batcher = None
+    if args.continuous_batching:
+        from continuous_batching import ContinuousBatchingEngine
+        batcher = ContinuousBatchingEngine(diff_service, max_batch_size=max(args.max_batch_size, 2), max_queue_size=args.max_queue_size, admission=admission, policy=policy)
+    elif args.max_batch_size > 1:
+        from request_batcher import ImageGenBatcher
+        batcher = ImageGenBatcher(diff_service, max_batch_size=args.max_batch_size, max_wait_ms=args.max_batch_wait_ms, max_queue_size=args.max_queue_size, admission=admission, policy=policy)
+
+    # Dedicated GPU thread shared by blocking endpoints and async jobs when batching is off.
+    if batcher is not None:
+        executor = batcher
+    elif args.preempt_time_slice_s is not None:
+        from preemption import PreemptiveExecutor
+        executor = PreemptiveExecutor(max_queue_size=args.max_queue_size, name="imagegen", admission=admission, policy=policy, time_slice_s=args.preempt_time_slice_s)
+    else:
+        executor = InferenceExecutor(max_queue_size=args.max_queue_size, name="imagegen", admission=admission, policy=policy)
+    if args.degrade_queue_depth is not None or args.degrade_wait_s is not None:
+        diff_service.degradation = QualityDegradation(
+            default_degradation_levels(args.degrade_queue_depth, args.degrade_wait_s),
+            load=lambda: (executor.queue_depth, admission.predicted_wait()),
+        )
+    staged = None
+    if batcher is None and args.prepare_workers > 0:
+        from staged_pipeline import StagedImagePipeline
+        staged = StagedImagePipeline(diff_service, executor, prepare_workers=args.prepare_workers, encode_workers=args.prepare_workers)
+
+    flights = SingleFlight()
+    result_cache = None
+    if args.result_cache_mb > 0 or args.result_cache_dir:
+        revision = model_revision(args.model)
+        if revision is None:
+            print(f"Result cache disabled: no local snapshot of {args.model} to tell its revision")
+        else:
+            result_cache = ResultCache(
+                result_cache_namespace(args.model, revision, pipeline=args.diffusion_base_model, fp16=pipe_wrapper.use_fp16),
+                memory_bytes=args.result_cache_mb * 1024 ** 2,
+                disk_dir=args.result_cache_dir,
+                disk_bytes=args.result_cache_disk_mb * 1024 ** 2,
+            )
+
+    def submit_generation(
+        params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        options: Optional[RequestOptions] = None,
+    ) -> Future:
+        key = coalescing_key(params) if not args.no_coalescing else None
+        start = lambda: flights.submit(key, observer, lambda observer: submit_uncoalesced(params, observer, options))
+        if result_cache is None or (options and options.no_cache):
+            return start()
+        return result_cache.submit(result_cache.key(params), start)
+
+    def submit_uncoalesced(
+        params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        options: Optional[RequestOptions] = None,
+    ) -> Future:
+        tenant = options.tenant if options else None
+        if batcher is not None:
+            return batcher.submit(params, observer, tenant)
+        scheduling = dict(
+            work=diff_service.estimate_work(params.to_dict()),
+            affinity=diff_service.affinity_key(params.to_dict()),
+            tenant=tenant,
+            priority=options.priority if options else 0
+        )
+        if staged is not None:
+            return staged.submit(params, observer, **scheduling)
+        return executor.submit(diff_service.generate, params, observer=observer, **scheduling)
+
+    def queue_full_exception(e: QueueFullError) -> HTTPException:
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    async def run_generation(params: ImageGenerationParams, options: RequestOptions) -> Dict[str, Any]:
+        cancellation = CancellationToken(options.deadline_s)
+        try:
+            future = await submit_with_deferral(lambda: submit_generation(params, cancellation, options), args.max_defer_s)
+        except QueueFullError as e:
+            raise queue_full_exception(e)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The caller went away. Stop denoising for nobody.
+            cancellation.cancel()
+            raise
+        except JobCancelledError as e:
+            raise HTTPException(status_code=504, detail=str(e))
+
+    job_queue = JobQueue(submit_generation, max_retained_jobs=args.max_retained_jobs)
+
     @app.post("/image-to-image")
-    async def image_to_image(request: ImageGenerateRequest):
+    async def image_to_image(request: ImageGenerateRequest, options: RequestOptions = Depends()):
         """Generate an image from text prompt."""
         try:
             if not request.input.image_to_image:
                 raise HTTPException(status_code=422, detail="Input field `image_to_image` is required.")
 
-            result = diff_service.generate(
-                input_params=request.input,
-            )
+            result = await run_generation(request.input, options)
         
             if "error" in result:
                 raise HTTPException(status_code=500, detail=result["error"])
             
             return result
         
+        except HTTPException:
+            raise
         except Exception as e:
-            print(str(e.with_traceback()))
+            traceback.print_exc()
             raise HTTPException(status_code=500, detail=str(e))
         
     @app.post("/inpaint")
-    async def inpaint(request: ImageGenerateRequest):
+    async def inpaint(request: ImageGenerateRequest, options: RequestOptions = Depends()):
         """Generate an image from text prompt."""
         try:
             if not request.input.inpaint:
                 raise HTTPException(status_code=422, detail="Input field `inpaint` is required.")
 
-            result = diff_service.generate(
-                input_params=request.input,
-            )
+            result = await run_generation(request.input, options)
         
             if "error" in result:
                 raise HTTPException(status_code=500, detail=result["error"])
             
             return result
         
+        except HTTPException:
+            raise
         except Exception as e:
-            print(str(e.with_traceback()))
+            traceback.print_exc()
             raise HTTPException(status_code=500, detail=str(e))
 
     @app.post("/text-to-image")
-    async def generate_image(request: ImageGenerateRequest):
+    async def generate_image(request: ImageGenerateRequest, options: RequestOptions = Depends()):
         """Generate an image from text prompt."""
         try:
-            result = diff_service.generate(
-                input_params=request.input,
-            )
+            result = await run_generation(request.input, options)
         
             if "error" in result:
                 raise HTTPException(status_code=500, detail=result["error"])
             
             return result
         
+        except HTTPException:
+            raise
         except Exception as e:
-            print(str(e.with_traceback()))
+            traceback.print_exc()
             raise HTTPException(status_code=500, detail=str(e))
         
+    @app.post("/jobs", status_code=202)
+    async def submit_job(request: ImageGenerateRequest, options: RequestOptions = Depends()):
+        """Queue an image generation and return its job id immediately."""
+        try:
+            job = await submit_with_deferral(lambda: job_queue.submit(request.input, options), args.max_defer_s)
+        except QueueFullError as e:
+            raise queue_full_exception(e)
+        return job.to_response()
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        """Get the status, and once finished the result, of a queued generation."""
+        job = job_queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job `{job_id}`.")
+        return job.to_response()
+
+    @app.delete("/jobs/{job_id}")
+    async def cancel_job(job_id: str):
+        """Cancel a queued generation, or stop a running one at its next denoising step."""
+        job = job_queue.cancel(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job `{job_id}`.")
+        return job.to_response()
+
+    @app.get("/health")
+    async def health():
+        """Liveness check that stays responsive while inference runs. `predicted_wait_s` lets clients route elsewhere."""
+        return {"status": "ok", "queue_depth": executor.queue_depth, "predicted_wait_s": round(admission.predicted_wait(), 2)}
+
+    @app.get("/worker-status")
+    async def worker_status():
+        """Warm pipelines, LoRAs and load of this worker, polled by `router.py` to pick a worker per request."""
+        return {
+            **pipe_wrapper.warm_state(),
+            "queue_depth": executor.queue_depth,
+            "predicted_wait_s": round(admission.predicted_wait(), 2),
+            "free_memory_bytes": get_free_memory_bytes(),
+        }
+
+    @app.get("/metrics")
+    async def get_metrics():
+        """Serving counters, such as GPU-seconds reclaimed from cancelled and expired requests."""
+        return metrics.snapshot()
+
     @app.get("/memory-info")
     async def mem_info():
         """Get memory information."""
@@ -208,5 +592,8 @@ if __name__ == "__main__":
 
     
     print(f"Starting local development server on {args.host}:{args.port}")
-    uvicorn.run(app, host=args.host, port=args.port)
+    if listen_socket is not None:
+        uvicorn.run(app, fd=listen_socket.fileno())
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
 
@@ -0,0 +1,210 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+from admission import Admission, AdmissionController, AdmissionRejected
+from metrics import metrics
+from scheduling import FifoPolicy, SchedulingPolicy
+from step_hooks import JobCancelledError
+
+
+class QueueFullError(Exception):
+    """Raised by `submit` when the executor's queue is full. `retry_after` is a wait estimate in seconds."""
+
+    def __init__(self, retry_after: int, message: Optional[str] = None):
+        super().__init__(message or f"Inference queue is full. Retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+@dataclass
+class WorkItem:
+    fn: Callable
+    args: tuple = ()
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    # A `StepObserver` passed as the `observer` kwarg is also checked for cancellation before the item starts.
+    # Items with equal keys may be executed together by subclasses. None means the item always runs alone.
+    key: Optional[tuple] = None
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Service-estimated cost, see `RPWorkerInferenceService.estimate_work`.
+    work: float = 0.0
+    admission: Optional[Admission] = None
+    # Items with equal affinity reuse the same loaded pipeline and adapters, see `AffinityPolicy`.
+    affinity: Optional[tuple] = None
+    # Who the GPU time is charged to, see `FairSharePolicy`.
+    tenant: Optional[str] = None
+    # Higher priority items may pause lower priority ones at step boundaries, see `PreemptiveExecutor`.
+    priority: int = 0
+    # Not started before this future is done, e.g. while its inputs are still being prepared elsewhere.
+    after: Optional[Future] = None
+
+
+class InferenceExecutor:
+    """
+    Runs inference work on one dedicated thread behind a bounded queue, so callers on an event loop
+    only ever wait on futures. Subclasses change how queued items are grouped and executed by
+    overriding `_next_items` and `_execute`. With an `AdmissionController`, items are also admitted
+    by their predicted cost instead of by queue length alone. The `SchedulingPolicy` picks which
+    pending item runs next, first come first served by default.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 16,
+        name: str = "inference",
+        admission: Optional[AdmissionController] = None,
+        policy: Optional[SchedulingPolicy] = None,
+    ):
+        self.max_queue_size = max_queue_size
+        self.admission = admission
+        self.policy = policy or FifoPolicy()
+        self._pending: List[WorkItem] = []
+        self._in_flight = 0
+        # Moving average of the wall time one item takes, used for Retry-After estimates.
+        self._avg_item_s: Optional[float] = None
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending) + self._in_flight
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to drain."""
+        if self.admission is not None:
+            return max(1, math.ceil(self.admission.predicted_wait()))
+        return max(1, math.ceil(self.queue_depth * (self._avg_item_s or 1.0)))
+
+    def submit(
+        self,
+        fn: Callable,
+        *args,
+        work: float = 0.0,
+        affinity: Optional[tuple] = None,
+        tenant: Optional[str] = None,
+        priority: int = 0,
+        after: Optional[Future] = None,
+        **kwargs
+    ) -> Future:
+        """Queue `fn(*args, **kwargs)`. `work`, `affinity`, `tenant`, `priority` and `after` are used for admission and scheduling, see `WorkItem`."""
+        return self._enqueue(WorkItem(fn=fn, args=args, kwargs=kwargs, work=work, affinity=affinity, tenant=tenant, priority=priority, after=after))
+
+    def _enqueue(self, item: WorkItem) -> Future:
+        with self._cond:
+            if len(self._pending) >= self.max_queue_size:
+                raise QueueFullError(self.retry_after())
+            if not self.policy.accepts(item, self._pending):
+                retry_after = self.retry_after()
+                raise QueueFullError(retry_after, f"Too many queued requests for this tenant. Retry after {retry_after}s.")
+            if self.admission is not None:
+                try:
+                    item.admission = self.admission.admit(item.work)
+                except AdmissionRejected as e:
+                    metrics.increment("jobs_rejected_by_admission")
+                    raise QueueFullError(e.retry_after, str(e))
+            self._pending.append(item)
+            self._cond.notify()
+        if item.after is not None:
+            item.after.add_done_callback(lambda _: self.__wake())
+        return item.future
+
+    def __wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _ready(self) -> List[WorkItem]:
+        """Pending items that may start now, oldest first."""
+        return [item for item in self._pending if item.after is None or item.after.done()]
+
+    def _next_items(self) -> List[WorkItem]:
+        """Block until work is available and take the next group of items to execute."""
+        with self._cond:
+            while not (ready := self._ready()):
+                self._cond.wait()
+            item = ready[self.policy.select(ready)]
+            self._pending.remove(item)
+            return [item]
+
+    def _begin(self, item: WorkItem) -> bool:
+        """Mark the item as running. Items cancelled or past their deadline while queued are dropped instead."""
+        if not item.future.set_running_or_notify_cancel():
+            metrics.increment("jobs_dropped_from_queue")
+            self._release([item])
+            return False
+
+        observer = item.kwargs.get("observer")
+        reason = observer.stop_reason() if observer is not None else None
+        if reason:
+            item.future.set_exception(JobCancelledError(reason))
+            metrics.increment("jobs_dropped_from_queue")
+            self._release([item])
+            return False
+
+        if item.admission is not None:
+            self.admission.start(item.admission)
+        return True
+
+    def _execute(self, items: List[WorkItem]):
+        for item in items:
+            try:
+                item.future.set_result(item.fn(*item.args, **item.kwargs))
+            except Exception as e:
+                item.future.set_exception(e)
+
+    def _record_duration(self, seconds: float, n_items: int):
+        per_item = seconds / max(1, n_items)
+        self._avg_item_s = per_item if self._avg_item_s is None else 0.8 * self._avg_item_s + 0.2 * per_item
+
+    def _release(self, items: List[WorkItem], seconds: Optional[float] = None):
+        """
+        Settle finished or dropped items with the scheduling policy and the admission controller.
+        `seconds` is the wall time the items took together, split by their estimated work.
+        """
+        total_work = sum(item.work for item in items)
+        for item in items:
+            share = None
+            if seconds is not None:
+                share = seconds * (item.work / total_work if total_work > 0 else 1 / len(items))
+            with self._cond:
+                self.policy.record(item, share or 0.0)
+
+            if item.admission is not None:
+                # Only successful runs calibrate the cost model.
+                succeeded = item.future.done() and not item.future.cancelled() and item.future.exception() is None
+                self.admission.release(item.admission, share if succeeded else None)
+
+    def _run(self):
+        while True:
+            items = [item for item in self._next_items() if self._begin(item)]
+            if not items:
+                continue
+
+            self._in_flight = len(items)
+            start = time.monotonic()
+            try:
+                self._execute(items)
+            finally:
+                elapsed = time.monotonic() - start
+                self._record_duration(elapsed, len(items))
+                self._release(items, elapsed)
+                self._in_flight = 0
+
+
+T = TypeVar("T")
+
+
+async def submit_with_deferral(submit: Callable[[], T], max_defer_s: float = 0) -> T:
+    """Call `submit`, waiting out `QueueFullError` for up to `max_defer_s` seconds before passing it on."""
+    deadline = time.monotonic() + max_defer_s
+    while True:
+        try:
+            return submit()
+        except QueueFullError as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+            await asyncio.sleep(min(e.retry_after, remaining, 1.0))
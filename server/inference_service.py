@@ -7,10 +7,31 @@ class InferenceService(ABC):
         pass
 
 class RPWorkerInferenceService(InferenceService):
+    # Jobs of exclusive services never share a worker with other jobs.
+    exclusive: bool = False
+    # Starting guess for how many seconds one `estimate_work` unit takes, until real jobs have been measured.
+    seconds_per_work_unit: float = 1.0
+
     @abstractmethod
     def warmup(self): 
         pass
 
+    def estimate_job_memory(self, job_input: Dict[str, Any]) -> int:
+        """Approximate device memory, in bytes, that one job needs on top of the loaded weights."""
+        return 2 * 1024 ** 3
+
+    def estimate_work(self, job_input: Dict[str, Any]) -> float:
+        """Relative cost of one job, in service specific units that the admission cost model turns into seconds."""
+        return 1.0
+
+    def affinity_key(self, job_input: Dict[str, Any]) -> Optional[tuple]:
+        """Jobs with equal keys run on the same loaded pipeline state, so running them back to back avoids swaps."""
+        return None
+
     @abstractmethod
-    def rp_worker_generate(self, job) -> Any:
+    def rp_worker_generate(self, job, observer=None, checkpointer=None) -> Any:
+        """
+        Run one RunPod job. `observer` is a `StepObserver` fed from the denoising loop, when given.
+        A `Checkpointer` saves the job's denoising progress and resumes it from an earlier attempt's checkpoint.
+        """
         pass
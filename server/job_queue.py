@@ -0,0 +1,93 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+from ez_diffusion_client import ImageGenerationParams
+from models import OpStatus, RequestOptions
+from step_hooks import CancellationToken, JobCancelledError, ObserverGroup, ProgressReporter, StepObserver
+
+
+@dataclass
+class Job:
+    job_id: str
+    input: ImageGenerationParams
+    future: Future
+    cancellation: CancellationToken
+    # Latest step event from the denoising loop while the job runs.
+    progress: Dict[str, Any] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def status(self) -> OpStatus:
+        if not self.future.done():
+            return OpStatus.IN_PROGRESS if self.future.running() else OpStatus.QUEUED
+        if self.future.cancelled() or isinstance(self.future.exception(), JobCancelledError):
+            return OpStatus.CANCELLED
+        if self.future.exception() is not None:
+            return OpStatus.FAILURE
+        return OpStatus.SUCCESS
+
+    def to_response(self) -> Dict[str, Any]:
+        """Shape the job like `ImageGenerationResponse` from the OpenAPI spec."""
+        status = self.status
+        response: Dict[str, Any] = {"job_id": self.job_id, "status": status.value, "input": self.input.to_dict()}
+        if status is OpStatus.SUCCESS:
+            result = {**self.future.result()}
+            response = {**result, **response, "result": {"source": result.pop("image", None)}}
+            response.pop("image", None)
+        elif status is OpStatus.IN_PROGRESS and self.progress:
+            response["progress"] = {**self.progress}
+        elif status is OpStatus.CANCELLED:
+            response["error"] = "Job stopped: cancelled" if self.future.cancelled() else str(self.future.exception())
+        elif status is OpStatus.FAILURE:
+            response["error"] = str(self.future.exception())
+        return response
+
+
+class JobQueue:
+    """
+    In-process registry for submit-and-poll generation. `submit` returns immediately with a job id
+    while the work runs through the given `submit_generation` function, and finished jobs are kept
+    around for polling until `max_retained_jobs` newer jobs have been submitted.
+    """
+
+    def __init__(
+        self,
+        submit_generation: Callable[[ImageGenerationParams, Optional[StepObserver], Optional[RequestOptions]], Future],
+        max_retained_jobs: int = 256,
+    ):
+        self.submit_generation = submit_generation
+        self.max_retained_jobs = max_retained_jobs
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, params: ImageGenerationParams, options: Optional[RequestOptions] = None) -> Job:
+        options = options or RequestOptions()
+        progress: Dict[str, Any] = {}
+        cancellation = CancellationToken(options.deadline_s)
+        observer = ObserverGroup(ProgressReporter(progress.update, preview_every=options.preview_every), cancellation)
+        future = self.submit_generation(params, observer, options)
+        job = Job(job_id=str(uuid.uuid4()), input=params, future=future, cancellation=cancellation, progress=progress)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self.__evict()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel a queued job outright, or stop a running one at its next step boundary."""
+        job = self.get(job_id)
+        if job is not None and not job.future.cancel():
+            job.cancellation.cancel()
+        return job
+
+    def __evict(self):
+        finished = [job_id for (job_id, job) in self._jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_retained_jobs)]:
+            del self._jobs[job_id]
@@ -1,3 +1,4 @@
+import contextlib
 from huggingface_hub import hf_hub_download
 import torch
 from diffusers import LTXImageToVideoPipeline, LTXPipeline, LTXConditionPipeline, LTXLatentUpsamplePipeline
@@ -13,15 +14,23 @@ from typing import List, Optional, Dict, Any
 import numpy as np
 from transformers import T5EncoderModel
 from inference_service import RPWorkerInferenceService
+from checkpointing import Checkpointer
+from step_hooks import ObserverGroup, StepObserver, raise_if_interrupted, step_end_callback
 from utils import get_memory_info, load_image_from_base64_or_url, print_memory_info, resolve_device
 from pathlib import Path
 
 class LTXVideoService(RPWorkerInferenceService):
+    # Video jobs take most of the device, so they always run alone.
+    exclusive = True
+    # Work is counted in megapixel-frame-steps.
+    seconds_per_work_unit = 0.25
+
     def __init__(
         self,
-        local_debug: bool = False
+        local_debug: bool = False,
+        device: Optional[str] = None
     ):
-        onload_device = torch.device("cuda")
+        onload_device = torch.device(device or "cuda")
         offload_device = torch.device("cpu")
         self.local_debug = local_debug
 
@@ -46,12 +55,18 @@ class LTXVideoService(RPWorkerInferenceService):
         # self.pipe.vae.enable_tiling()
         pass
 
-    def rp_worker_generate(self, job) -> Any:
-        return self.generate(job.get("input"))
+    def estimate_work(self, job_input: Dict[str, Any]) -> float:
+        megapixels = (job_input.get("width") or 720) * (job_input.get("height") or 480) / 1e6
+        return megapixels * (job_input.get("num_frames") or 81) * (job_input.get("num_inference_steps") or 30)
+
+    def rp_worker_generate(self, job, observer: Optional[StepObserver] = None, checkpointer: Optional[Checkpointer] = None) -> Any:
+        return self.generate(job.get("input"), observer, checkpointer)
 
     def generate(
         self,
         input_params: Dict[str, Any],
+        observer: Optional[StepObserver] = None,
+        checkpointer: Optional[Checkpointer] = None,
     ) -> Dict[str, Any]:
         try:
             p = {**input_params}
@@ -69,16 +84,24 @@ class LTXVideoService(RPWorkerInferenceService):
 
             image = load_image(start_image)
 
-            video = self.pipe(
-                prompt=prompt,
-                image=image,
-                negative_prompt=negative_prompt,
-                height=height,
-                width=width,
-                num_frames=num_frames,
-                guidance_scale=guidance_scale,
-                num_inference_steps=num_inference_steps,
-            ).frames[0]
+            resume = checkpointer.resume_state() if checkpointer is not None else None
+            with checkpointer.resuming(self.pipe.scheduler) if checkpointer is not None else contextlib.nullcontext():
+                video = self.pipe(
+                    prompt=prompt,
+                    image=image,
+                    negative_prompt=negative_prompt,
+                    height=height,
+                    width=width,
+                    num_frames=num_frames,
+                    guidance_scale=guidance_scale,
+                    num_inference_steps=num_inference_steps,
+                    latents=resume["latents"] if resume is not None else None,
+                    callback_on_step_end=step_end_callback([ObserverGroup(observer, checkpointer)], num_inference_steps),
+                    callback_on_step_end_tensor_inputs=["latents"],
+                ).frames[0]
+            raise_if_interrupted(self.pipe, [observer])
+            if checkpointer is not None:
+                checkpointer.complete()
             export_to_video(video, filename, fps=fps)
 
             if self.local_debug: 
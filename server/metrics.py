@@ -0,0 +1,22 @@
+import threading
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """Process-wide counters for serving behaviour. Safe to update from the inference threads."""
+
+    def __init__(self):
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = Metrics()
@@ -1,4 +1,5 @@
 from .opresult import *
+from .request_options import RequestOptions
 
 # 0 -- openpose
 # 1 -- depth
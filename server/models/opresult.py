@@ -4,8 +4,11 @@ from typing import Any
 
 class OpStatus(Enum):
     PENDING = "PENDING"
+    QUEUED = "QUEUED"
+    IN_PROGRESS = "IN_PROGRESS"
     SUCCESS = "SUCCESS"
     FAILURE = "FAILURE"
+    CANCELLED = "CANCELLED"
 
 @dataclass
 class OpResult:
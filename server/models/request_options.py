@@ -0,0 +1,14 @@
+from typing import Any, Dict, Optional
+from pydantic import BaseModel, Field
+
+class RequestOptions(BaseModel):
+    """Serving options that travel next to the generation params. RunPod jobs carry them as `input.options`."""
+    preview_every: Optional[int] = Field(default=None, ge=1, description="Attach a latent preview to every Nth progress event")
+    deadline_s: Optional[float] = Field(default=None, gt=0, description="Stop the request at the next step boundary once this many seconds have passed since it was received")
+    tenant: Optional[str] = Field(default=None, max_length=64, description="Who the request's GPU time is charged to when the worker shares it fairly between tenants")
+    no_cache: bool = Field(default=False, description="Generate the image even when the result cache holds it, and leave the result out of the cache")
+    priority: int = Field(default=0, ge=0, le=10, description="Requests with a higher priority may pause a running lower priority request for the same pipeline, LoRAs and ControlNets at a step boundary when the worker preempts")
+
+    @classmethod
+    def from_job_input(cls, job_input: Dict[str, Any]) -> "RequestOptions":
+        return cls(**(job_input.get("options") or {}))
@@ -1,10 +1,14 @@
 from abc import ABC, abstractmethod
+import copy
 import os
-from typing import Any, Callable, Dict, List, Optional, Generic, TypeVar
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Generic, Tuple, TypeVar
 from jinja2 import pass_context
 from regex import R
 import torch
 from attr import dataclass
+from PIL import Image
 from pydantic import NonNegativeFloat
 from diffusers import (
     AutoPipelineForText2Image,
@@ -16,6 +20,8 @@ from diffusers import (
     DiffusionPipeline,
     FluxControlNetModel
 )
+from caching import BoundedCache, sizeof_tensors
+from metrics import metrics
 from models import OpResult, OpStatus, PipeType
 from utils import resolve_device
 from dataclasses import dataclass
@@ -23,13 +29,73 @@ from ez_diffusion_client import LoraParams, ImageGenerationParams, ControlNetPar
 from functools import lru_cache
 from DeepCache import DeepCacheSDHelper
 from controlnet_factory import ControlNetFactory, SD15Fp16ControlNetGetter, SDXLFp16ControlNetUnionGetter
+from collections import OrderedDict
+
+PIPELINE_CACHE_SIZE = 6
+
+
+def model_revision(base_model: str) -> Optional[str]:
+    """The snapshot `base_model` loads from: the Hub commit it was downloaded at, or the local directory. None if it isn't downloaded."""
+    if os.path.isdir(base_model):
+        return os.path.realpath(base_model)
+    try:
+        return os.path.basename(DiffusionPipeline.download(base_model, local_files_only=True))
+    except Exception:
+        return None
+
+
+def pipeline_key_to_json(key: tuple) -> List[str]:
+    """A pipeline key as plain strings, the form workers advertise it in."""
+    return [getattr(part, "value", part) for part in key]
 
 
 class PipelineFactory(ABC):
+    # Whether `decode_latents` can finish `output_type="latent"` pipeline calls.
+    decodes_latents = False
+
     @abstractmethod
     def get_pipeline_for_inputs(self, params: ImageGenerationParams) -> Callable:
         pass
 
+    @abstractmethod
+    def get_pipeline_key(self, params: ImageGenerationParams) -> tuple:
+        pass
+
+    def warm_state(self) -> Dict[str, Any]:
+        """What is loaded right now, so a router can send requests where nothing has to be loaded for them."""
+        return {}
+
+    def encode_prompts(
+        self,
+        prompts: List[str],
+        negative_prompts: Optional[List[str]],
+        guidance_scale: float,
+        loras: Optional[List[LoraParams]],
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Prompt embedding kwargs for the pipeline call, computed ahead of it on another thread.
+        None leaves prompt encoding to the pipeline call.
+        """
+        return None
+
+    def control_image_target(self) -> Optional[Tuple[torch.device, torch.dtype, int]]:
+        """
+        Device, dtype and VAE scale factor of the pipelines, to hand them ControlNet guide images as the tensors
+        they would make of them. None hands them images.
+        """
+        return None
+
+    def decode_latents(self, latents: torch.Tensor) -> List[Image.Image]:
+        """Turn the latents of an `output_type="latent"` pipeline call into the images the call would have returned."""
+        raise NotImplementedError
+
+    def tag_prompt(self, prompt: str, loras: Optional[List[LoraParams]]) -> str:
+        """Append the trigger tags of the given LoRAs to the prompt."""
+        for lora in loras or []:
+            if lora.tag is not None:
+                prompt = f"{prompt}, {lora.tag}"
+        return prompt
+
     def load_loras(self, pipeline, loras: List[LoraParams]) -> OpResult:
         """Load LoRA weights into the pipeline."""
         for lora in loras:
@@ -60,13 +126,19 @@ class PipelineFactory(ABC):
         pass
 
 class SDImagePipelineFactory(PipelineFactory):
+    decodes_latents = True
+
     def __init__(
         self, 
         base_model: str,
         use_fp16: bool = True,
-        get_controlnet: ControlNetFactory = SD15Fp16ControlNetGetter()
+        get_controlnet: ControlNetFactory = SD15Fp16ControlNetGetter(),
+        device: Optional[str] = None,
+        embedding_cache_bytes: int = 128 * 1024 ** 2,
+        embedding_cache_ttl_s: Optional[float] = None,
     ):
-        self.device = resolve_device()
+        self.device = device or resolve_device()
+        self.base_model = base_model
         self.use_fp16 = use_fp16
         self.get_controlnet = get_controlnet
         self.base_pipeline = AutoPipelineForText2Image.from_pretrained(
@@ -76,12 +148,28 @@ class SDImagePipelineFactory(PipelineFactory):
             **self.__resolve_pipeline_precision()
         ).to(self.device)
         self.deepcache_helper = DeepCacheSDHelper(pipe=self.base_pipeline)
+        # What is currently applied to the shared base pipeline, so `setup` only swaps when a request needs something else.
+        self._loaded_loras: tuple = ()
+        self._deepcache_params: Optional[tuple] = None
+        self._avg_lora_swap_s: Optional[float] = None
+        # Held while LoRAs are swapped and while prompts are encoded outside the pipeline call.
+        self._adapter_lock = threading.Lock()
+        # Prompt embeddings by model, text encoder LoRAs and text. Repeated prompts and shared negative prompts skip the text encoders.
+        self.embedding_cache = BoundedCache("embedding", embedding_cache_bytes, sizeof_tensors, ttl_s=embedding_cache_ttl_s)
+        # Keys of the pipelines `__get_pipeline` holds, least recently used first.
+        self._warm_pipelines: OrderedDict = OrderedDict()
+        self._avg_pipeline_build_s: Optional[float] = None
+        self._upcast_vae = None
+        self._upcast_vae_lock = threading.Lock()
         self.base_pipeline.scheduler = DDIMScheduler.from_config(self.base_pipeline.scheduler.config)
 
         # check env var DO_TORCH_COMPILE 
         if os.getenv("DO_TORCH_COMPILE") and torch.cuda.is_available(): 
             self.base_pipeline.unet = torch.compile(self.base_pipeline.unet, mode="reduce-overhead", fullgraph=True)
 
+    def control_image_target(self) -> Optional[Tuple[torch.device, torch.dtype, int]]:
+        return (self.base_pipeline.device, self.base_pipeline.dtype, self.base_pipeline.vae_scale_factor)
+
     def __resolve_pipeline_precision(self):
         if self.use_fp16:
             return {"torch_dtype": torch.float16, "variant": "fp16"}
@@ -89,32 +177,142 @@ class SDImagePipelineFactory(PipelineFactory):
             return {}
         
     def setup(self, input: ImageGenerationParams, pipekwargs, response):
+        deepcache_params = None
         if input.pipeline_optimizations:
              # Optimizations
             if input.pipeline_optimizations.deepcache_branch_id and input.pipeline_optimizations.deepcache_interval:
-                self.deepcache_helper.set_params(
-                    cache_interval=input.pipeline_optimizations.deepcache_interval,
-                    cache_branch_id=input.pipeline_optimizations.deepcache_branch_id,
-                )
-                self.deepcache_helper.enable()
+                deepcache_params = (input.pipeline_optimizations.deepcache_interval, input.pipeline_optimizations.deepcache_branch_id)
+        self.__apply_deepcache(deepcache_params)
 
         loras = input.loras
+        res = self.__apply_loras(loras or [])
         if loras and len(loras) > 0:
-            prompt = pipekwargs.prompt
-            res = self.load_loras(self.base_pipeline, loras)
-            if (res.status is OpStatus.FAILURE):
-                response = {**response, "warnings": [*response.warnings, res]}
-            for lora in loras:
-                if lora.tag is not None:
-                    prompt += f"{prompt}, {lora.tag}"
+            prompt = self.tag_prompt(pipekwargs["prompt"], loras)
+            if (res is not None and res.status is OpStatus.FAILURE):
+                response = {**response, "warnings": [*response["warnings"], res]}
             pipekwargs = { **pipekwargs, "prompt": prompt, "cross_attention_kwargs": {"scale": loras[0].scale}}
         return (pipekwargs, response)    
     
+    def encode_prompts(self, prompts, negative_prompts, guidance_scale, loras):
+        with self._adapter_lock:
+            # LoRAs patch the text encoders too, so prompts are only encoded while the request's own LoRAs are loaded.
+            if tuple((lora.model, lora.weight_name) for lora in loras or []) != self._loaded_loras:
+                return None
+            lora_scale = loras[0].scale if loras else None
+            encoded = self.__encode_texts(prompts, lora_scale)
+            if guidance_scale > 1 and not (negative_prompts is None and getattr(self.base_pipeline.config, "force_zeros_for_empty_prompt", False)):
+                negative = self.__encode_texts(negative_prompts or [""] * len(prompts), lora_scale)
+            elif guidance_scale > 1:
+                # SDXL leaves unset negative prompts at zero instead of encoding "".
+                negative = [tuple(torch.zeros_like(t) if t is not None else None for t in row) for row in encoded]
+            else:
+                negative = None
+
+        def stack(rows: List[tuple], i: int):
+            return torch.cat([row[i] for row in rows]) if rows[0][i] is not None else None
+
+        embeds = {"prompt_embeds": stack(encoded, 0), "pooled_prompt_embeds": stack(encoded, 1)}
+        if negative is not None:
+            embeds.update(negative_prompt_embeds=stack(negative, 0), negative_pooled_prompt_embeds=stack(negative, 1))
+        return {name: value for (name, value) in embeds.items() if value is not None}
+
+    def __encode_texts(self, texts: List[str], lora_scale: Optional[float]) -> List[tuple]:
+        """(embeddings, pooled embeddings or None) of each text, encoding only those missing from the cache."""
+        encoders = [getattr(self.base_pipeline, name, None) for name in ("text_encoder", "text_encoder_2")]
+        # Only LoRAs that patched a text encoder change the embeddings.
+        lora_key = (self._loaded_loras, lora_scale) if any(getattr(e, "peft_config", None) for e in encoders) else ()
+        keys = [(self.base_model, lora_key, text) for text in texts]
+        found = {key: self.embedding_cache.get(key) for key in dict.fromkeys(keys)}
+        missing = [key for (key, value) in found.items() if value is None]
+        if missing:
+            with torch.no_grad():
+                embeds = self.base_pipeline.encode_prompt(
+                    prompt=[text for (_, _, text) in missing],
+                    device=self.base_pipeline.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False,
+                    lora_scale=lora_scale,
+                )
+            # SD returns the embeddings and negative ones, SDXL also the pooled embeddings after those.
+            pooled = embeds[2] if len(embeds) > 2 else None
+            for (i, key) in enumerate(missing):
+                # Cloned so the cache doesn't keep the whole batch alive through a view.
+                found[key] = (embeds[0][i:i + 1].clone(), pooled[i:i + 1].clone() if pooled is not None else None)
+                self.embedding_cache.put(key, found[key])
+        return [found[key] for key in keys]
+
+    def __decoding_vae(self):
+        vae = self.base_pipeline.vae
+        # SDXL pipelines decode in float32 when the VAE asks for it, by casting the shared VAE back and forth.
+        # That would race with pipelines running on the other thread, so decoding gets a float32 copy instead.
+        if not (hasattr(self.base_pipeline, "text_encoder_2") and self.use_fp16 and vae.config.force_upcast):
+            return vae
+        with self._upcast_vae_lock:
+            if self._upcast_vae is None:
+                self._upcast_vae = copy.deepcopy(vae).to(dtype=torch.float32)
+        return self._upcast_vae
+
+    def decode_latents(self, latents):
+        vae = self.__decoding_vae()
+        latents = latents.to(vae.device, vae.dtype)
+        config = vae.config
+        if getattr(config, "latents_mean", None) is not None and getattr(config, "latents_std", None) is not None:
+            mean = torch.tensor(config.latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            std = torch.tensor(config.latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            latents = latents * std / config.scaling_factor + mean
+        else:
+            latents = latents / config.scaling_factor
+        with torch.no_grad():
+            image = vae.decode(latents, return_dict=False)[0]
+        if getattr(self.base_pipeline, "watermark", None) is not None:
+            image = self.base_pipeline.watermark.apply_watermark(image)
+        return self.base_pipeline.image_processor.postprocess(image, output_type="pil")
+
     def cleanup(self):
-        self.unload_loras(self.base_pipeline)
-        self.deepcache_helper.disable()
+        """Restore the plain base pipeline."""
+        self.__apply_loras([])
+        self.__apply_deepcache(None)
+
+    def __apply_deepcache(self, params: Optional[tuple]):
+        if params == self._deepcache_params:
+            return
+        if self._deepcache_params is not None:
+            self.deepcache_helper.disable()
+        if params is not None:
+            (interval, branch_id) = params
+            self.deepcache_helper.set_params(cache_interval=interval, cache_branch_id=branch_id)
+            self.deepcache_helper.enable()
+        self._deepcache_params = params
+
+    def __apply_loras(self, loras: List[LoraParams]) -> Optional[OpResult]:
+        """Load the given LoRA set unless it is already loaded. Returns the load result when loading happened."""
+        key = tuple((lora.model, lora.weight_name) for lora in loras)
+        if key == self._loaded_loras:
+            if key:
+                metrics.increment("lora_swaps_avoided")
+                metrics.increment("lora_swap_seconds_saved", self._avg_lora_swap_s or 0)
+            return None
+
+        start = time.monotonic()
+        with self._adapter_lock:
+            if self._loaded_loras:
+                self.unload_loras(self.base_pipeline)
+            self._loaded_loras = ()
+            res = None
+            if loras:
+                res = self.load_loras(self.base_pipeline, loras)
+                if res.status is OpStatus.SUCCESS:
+                    self._loaded_loras = key
+                else:
+                    self.unload_loras(self.base_pipeline)
+
+        elapsed = time.monotonic() - start
+        self._avg_lora_swap_s = elapsed if self._avg_lora_swap_s is None else 0.8 * self._avg_lora_swap_s + 0.2 * elapsed
+        metrics.increment("lora_swaps")
+        metrics.increment("lora_swap_seconds", elapsed)
+        return res
     
-    @lru_cache(maxsize=6)
+    @lru_cache(maxsize=PIPELINE_CACHE_SIZE)
     def __get_pipeline(self, pipetype: PipeType, *controlnet_models: CNProcessorType):
         cn_models = [self.get_controlnet(cn_type = controlnet) for controlnet in controlnet_models]
 
@@ -147,7 +345,12 @@ class SDImagePipelineFactory(PipelineFactory):
                 **kwargs
             ).to(self.device)  
 
-    def get_pipeline_for_inputs(self, params: ImageGenerationParams) -> Callable:
+    def get_pipeline_key(self, params: ImageGenerationParams) -> tuple:
+        return self.pipeline_key(params)
+
+    @staticmethod
+    def pipeline_key(params: ImageGenerationParams) -> tuple:
+        """`get_pipeline_key` without a loaded factory, for processes that only route requests."""
         if params.image_to_image:
             pipetype = PipeType.IMAGE2IMAGE
         elif params.inpaint:
@@ -159,5 +362,31 @@ class SDImagePipelineFactory(PipelineFactory):
             cn_model_names = [controlnet.processor_type for controlnet in params.controlnets]
         else:
             cn_model_names = []
-        
-        return self.__get_pipeline(pipetype, *cn_model_names)
\ No newline at end of file
+
+        return (pipetype, *cn_model_names)
+
+    def get_pipeline_for_inputs(self, params: ImageGenerationParams) -> Callable:
+        misses = self.__get_pipeline.cache_info().misses
+        start = time.monotonic()
+        key = self.get_pipeline_key(params)
+        pipe = self.__get_pipeline(*key)
+        if self.__get_pipeline.cache_info().misses > misses:
+            elapsed = time.monotonic() - start
+            self._avg_pipeline_build_s = elapsed if self._avg_pipeline_build_s is None else 0.8 * self._avg_pipeline_build_s + 0.2 * elapsed
+            metrics.increment("pipeline_builds")
+            metrics.increment("pipeline_build_seconds", elapsed)
+        self._warm_pipelines[key] = True
+        self._warm_pipelines.move_to_end(key)
+        while len(self._warm_pipelines) > PIPELINE_CACHE_SIZE:
+            self._warm_pipelines.popitem(last=False)
+        return pipe
+
+    def warm_state(self) -> Dict[str, Any]:
+        return {
+            "base_model": self.base_model,
+            "pipelines": [pipeline_key_to_json(key) for key in self._warm_pipelines],
+            "loras": [list(lora) for lora in self._loaded_loras],
+            "deepcache": list(self._deepcache_params) if self._deepcache_params else None,
+            "avg_pipeline_build_s": self._avg_pipeline_build_s,
+            "avg_lora_swap_s": self._avg_lora_swap_s,
+        }
\ No newline at end of file
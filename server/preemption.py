@@ -0,0 +1,133 @@
+import copy
+import time
+from typing import Any, Dict, List, Optional
+import torch
+from admission import AdmissionController
+from inference_executor import InferenceExecutor, WorkItem
+from metrics import metrics
+from scheduling import SchedulingPolicy
+from step_hooks import ObserverGroup, StepObserver
+
+
+def snapshot_pipeline_state(pipe) -> Dict[str, Any]:
+    """Copy the per-call state a diffusers pipeline and its scheduler keep on themselves."""
+    return {
+        "attributes": {name: value for (name, value) in vars(pipe).items() if not isinstance(value, torch.nn.Module)},
+        "scheduler": copy.deepcopy(vars(pipe.scheduler)),
+    }
+
+
+def restore_pipeline_state(pipe, state: Dict[str, Any]):
+    # Bypasses `DiffusionPipeline.__setattr__`, which would also rewrite the pipeline config.
+    vars(pipe).update(state["attributes"])
+    vars(pipe.scheduler).update(state["scheduler"])
+
+
+class PreemptionPoint(StepObserver):
+    """Gives the executor a chance to run higher priority items at each step boundary of a running item."""
+
+    def __init__(self, executor: "PreemptiveExecutor", item: WorkItem):
+        self.executor = executor
+        self.item = item
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        self.executor._preempt(self.item, pipe, step, total_steps)
+
+
+class PreemptiveExecutor(InferenceExecutor):
+    """
+    Lets short, higher priority items interleave with long running ones of the same pipeline. Once a running item has had
+    `time_slice_s` seconds on the GPU, queued items with a higher `WorkItem.priority` run at its next
+    denoising step boundary, nested inside its step-end callback. The paused item's latents stay where
+    they are and the pipeline and scheduler state it keeps on itself is restored before it resumes.
+
+    Only items with the same affinity as the running one can preempt it, so the pipeline never has to
+    swap adapters under a paused call. It is meant for image items: a worker serves a single model
+    family, so image requests never preempt video ones, and video workers don't use it. Both items'
+    activations are on the device while the preempting one runs. Preempting items are not preempted in turn.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 16,
+        name: str = "inference",
+        admission: Optional[AdmissionController] = None,
+        policy: Optional[SchedulingPolicy] = None,
+        time_slice_s: float = 5.0,
+    ):
+        self.time_slice_s = time_slice_s
+        self._preempting = False
+        self._slice_started = time.monotonic()
+        # Seconds the running item spent paused, kept out of its measured runtime.
+        self._paused_s = 0.0
+        super().__init__(max_queue_size=max_queue_size, name=name, admission=admission, policy=policy)
+
+    def _next_items(self) -> List[WorkItem]:
+        with self._cond:
+            while not (ready := self._ready()):
+                self._cond.wait()
+            top = max(item.priority for item in ready)
+            candidates = [item for item in ready if item.priority == top]
+            item = candidates[self.policy.select(candidates)]
+            self._pending.remove(item)
+            return [item]
+
+    def _execute(self, items: List[WorkItem]):
+        for item in items:
+            item.kwargs["observer"] = ObserverGroup(item.kwargs.get("observer"), PreemptionPoint(self, item))
+            self._slice_started = time.monotonic()
+            self._paused_s = 0.0
+        super()._execute(items)
+
+    def _release(self, items: List[WorkItem], seconds: Optional[float] = None):
+        if seconds is not None and not self._preempting:
+            seconds = max(0.0, seconds - self._paused_s)
+            self._paused_s = 0.0
+        super()._release(items, seconds)
+
+    def _take_preempting(self, running: WorkItem) -> Optional[WorkItem]:
+        with self._cond:
+            eligible = [
+                item for item in self._ready()
+                if item.priority > running.priority and item.affinity == running.affinity
+            ]
+            if not eligible:
+                return None
+            item = max(eligible, key=lambda item: item.priority)
+            self._pending.remove(item)
+            return item
+
+    def _preempt(self, running: WorkItem, pipe, step: int, total_steps: int):
+        if self._preempting or time.monotonic() - self._slice_started < self.time_slice_s:
+            return
+        item = self._take_preempting(running)
+        if item is None:
+            return
+
+        paused_at = time.monotonic()
+        state = snapshot_pipeline_state(pipe)
+        overhead = time.monotonic() - paused_at
+        print(f"{self.__class__.__name__}: pausing request after step {step + 1}/{total_steps} for a priority {item.priority} request")
+        self._preempting = True
+        try:
+            while item is not None:
+                metrics.increment("preemptions")
+                if self._begin(item):
+                    start = time.monotonic()
+                    try:
+                        super()._execute([item])
+                    finally:
+                        elapsed = time.monotonic() - start
+                        self._record_duration(elapsed, 1)
+                        self._release([item], elapsed)
+                item = self._take_preempting(running)
+        finally:
+            self._preempting = False
+            restore_start = time.monotonic()
+            restore_pipeline_state(pipe, state)
+            now = time.monotonic()
+            overhead += now - restore_start
+            self._paused_s += now - paused_at
+            self._slice_started = now
+            metrics.increment("preemption_overhead_seconds", overhead)
+            metrics.increment("preempted_seconds", now - paused_at)
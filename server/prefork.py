@@ -0,0 +1,101 @@
+import os
+import signal
+import socket
+import sys
+from typing import Dict, Iterable, List
+import torch
+
+
+def share_weights(modules: Iterable[torch.nn.Module]):
+    """
+    Move the parameters and buffers of `modules` into shared memory. Forked workers then map the same
+    pages instead of copying them on write, which a page holding both a tensor and touched allocator
+    metadata would otherwise trigger.
+    """
+    for module in modules:
+        module.share_memory()
+
+
+def pipeline_modules(pipe) -> Iterable[torch.nn.Module]:
+    return [component for component in pipe.components.values() if isinstance(component, torch.nn.Module)]
+
+
+def partition_cores(num_workers: int) -> List[List[int]]:
+    """Split the cores this process may run on into `num_workers` disjoint sets of near equal size."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    (size, extra) = divmod(len(cores), num_workers)
+    starts = [i * size + min(i, extra) for i in range(num_workers + 1)]
+    return [cores[starts[i]:starts[i + 1]] for i in range(num_workers)]
+
+
+def pin_to_cores(cores: List[int]):
+    """Keep this process and its intra-op thread pool on `cores`."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def prefork(num_workers: int, host: str, port: int) -> socket.socket:
+    """
+    Bind the listening socket and fork `num_workers` worker processes that all accept on it. Returns the
+    socket in each worker. The parent stays behind to supervise: it replaces workers that crash and
+    forwards SIGINT and SIGTERM to the others, and exits once they are gone.
+
+    Each worker is pinned to its own share of the cores, see `partition_cores`. A single pipeline call
+    scales poorly across many cores, so several pinned workers get more images out of a host than one
+    worker using all of them. Every worker has its own pipeline objects, so LoRA and DeepCache settings
+    of one don't affect the others. Fusing LoRAs would write into the shared weights and must be avoided.
+
+    Call it after the models are loaded and before any threads or inference run. Threads don't survive
+    the fork, and CUDA can't be used from a forked child, so this is for CPU workers only.
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    partitions = partition_cores(num_workers)
+
+    def fork_worker(index: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            pin_to_cores(partitions[index])
+            print(f"Prefork worker {index} started with pid {os.getpid()} on cores {partitions[index]}")
+        return pid
+
+    workers: Dict[int, int] = {}
+    for index in range(num_workers):
+        if (pid := fork_worker(index)) == 0:
+            return sock
+        workers[pid] = index
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while workers:
+        try:
+            (pid, status) = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"Prefork worker {index} exited with code {os.waitstatus_to_exitcode(status)}, restarting it")
+        if (pid := fork_worker(index)) == 0:
+            return sock
+        workers[pid] = index
+    sock.close()
+    sys.exit(0)
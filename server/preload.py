@@ -55,6 +55,18 @@ def load_models_from_manifest(config):
                 except Exception as e:
                     print(f"Failed to load LoRA {fullpath}: {e}")
 
+    if 'annotators' in config and config['annotators']:
+        from controlnet_params_factory import ANNOTATOR_ALIASES, load_annotator
+        for annotator_config in config['annotators']:
+            processor = annotator_config.get('processor')
+            if processor:
+                try:
+                    print(f"Loading annotator: {processor}")
+                    load_annotator(ANNOTATOR_ALIASES.get(processor, (processor, {}))[0])
+                    print(f"Loaded annotator: {processor}")
+                except Exception as e:
+                    print(f"Failed to load annotator {processor}: {e}")
+
 
 if __name__ == "__main__":
     import os
@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+from ez_diffusion_client import ImageGenerationParams
+from admission import AdmissionController
+from checkpointing import Checkpointer
+from imagegen_service import ImageGenService
+from inference_executor import InferenceExecutor, WorkItem
+from scheduling import SchedulingPolicy
+from step_hooks import StepObserver
+
+
+class ImageGenBatcher(InferenceExecutor):
+    """
+    Sits in front of `ImageGenService.generate` and merges requests that arrive within a short
+    window into one batched pipeline call, as long as they share the same `ImageGenService.batch_key`.
+    Every request keeps its own seed through per-sample generators. A request's `checkpointer` is used when
+    it runs alone, and a request with a checkpoint to resume always does.
+    """
+
+    def __init__(
+        self,
+        service: ImageGenService,
+        max_batch_size: int = 4,
+        max_wait_ms: float = 20,
+        max_queue_size: int = 16,
+        admission: Optional[AdmissionController] = None,
+        policy: Optional[SchedulingPolicy] = None,
+    ):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        super().__init__(max_queue_size=max_queue_size, name="imagegen-batcher", admission=admission, policy=policy)
+
+    def submit(
+        self,
+        params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        tenant: Optional[str] = None,
+        checkpointer: Optional[Checkpointer] = None,
+    ) -> "Future[Dict[str, Any]]":
+        resumes = checkpointer is not None and checkpointer.resume_state() is not None
+        return self._enqueue(WorkItem(
+            fn=self.service.generate,
+            args=(params,),
+            kwargs={"observer": observer, "checkpointer": checkpointer},
+            key=None if resumes else self.service.batch_key(params),
+            work=self.service.estimate_work(params.to_dict()),
+            affinity=self.service.affinity_key(params.to_dict()),
+            tenant=tenant
+        ))
+
+    def _next_items(self) -> List[WorkItem]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            # Only this thread removes items, so the head stays put while we wait for company.
+            head = self._pending[self.policy.select(self._pending)]
+            if head.key is None:
+                self._pending.remove(head)
+                return [head]
+
+            deadline = head.enqueued_at + self.max_wait_s
+            while True:
+                batch = [item for item in self._pending if item.key == head.key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            for item in batch:
+                self._pending.remove(item)
+            return batch
+
+    def _execute(self, items: List[WorkItem]):
+        print(f"{self.__class__.__name__}: running batch of {len(items)}")
+        try:
+            results = self.service.generate_batch(
+                [item.args[0] for item in items],
+                [item.kwargs.get("observer") for item in items],
+                items[0].kwargs.get("checkpointer") if len(items) == 1 else None
+            )
+            for (item, result) in zip(items, results):
+                item.future.set_result(result)
+        except Exception as e:
+            for item in items:
+                item.future.set_exception(e)
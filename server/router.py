@@ -0,0 +1,265 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from ez_diffusion_client import ImageGenerationParams
+from metrics import metrics
+from pipeline_factory import SDImagePipelineFactory, pipeline_key_to_json
+
+
+@dataclass(eq=False)
+class WorkerState:
+    url: str
+    # Last `/worker-status` response, empty until the first successful poll.
+    status: Dict[str, Any] = field(default_factory=dict)
+    healthy: bool = False
+    # Requests routed here that haven't returned yet.
+    in_flight: int = 0
+    # Moving average of proxied request latency.
+    avg_request_s: Optional[float] = None
+
+
+class WorkerUnreachableError(OSError):
+    """A forward failed before the worker got the request, so it can safely go to another worker."""
+
+
+class AffinityRouter:
+    """
+    Picks a worker per request from what the workers advertise on `/worker-status`. A worker's cost for a
+    request is its predicted queue wait plus the time it would spend building a pipeline or swapping LoRAs
+    it doesn't have warm, and the cheapest worker serving the requested base model wins. Requests that need
+    a pipeline built go to workers with at least `min_free_memory_bytes` free while there are any.
+    """
+
+    # Assumed until a worker has reported its own build and swap times.
+    DEFAULT_PIPELINE_BUILD_S = 10.0
+    DEFAULT_LORA_SWAP_S = 3.0
+
+    def __init__(
+        self,
+        worker_urls: List[str],
+        poll_interval_s: float = 2.0,
+        timeout_s: float = 300.0,
+        min_free_memory_bytes: int = 2 * 1024 ** 3,
+    ):
+        self.workers = [WorkerState(url=url.rstrip("/")) for url in worker_urls]
+        self.poll_interval_s = poll_interval_s
+        self.timeout_s = timeout_s
+        self.min_free_memory_bytes = min_free_memory_bytes
+        # Which worker holds each async job, so polling and cancelling reach the right one.
+        self._job_workers: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.refresh()
+        threading.Thread(target=self.__poll, name="router-poll", daemon=True).start()
+
+    def refresh(self):
+        for worker in self.workers:
+            try:
+                with urllib.request.urlopen(f"{worker.url}/worker-status", timeout=self.poll_interval_s) as response:
+                    (worker.status, worker.healthy) = (json.loads(response.read()), True)
+            except (urllib.error.URLError, OSError, ValueError):
+                worker.healthy = False
+
+    def __poll(self):
+        while True:
+            time.sleep(self.poll_interval_s)
+            self.refresh()
+
+    @staticmethod
+    def is_warm(worker: WorkerState, params: ImageGenerationParams) -> bool:
+        """Whether `worker` has the pipeline for `params` built."""
+        return pipeline_key_to_json(SDImagePipelineFactory.pipeline_key(params)) in worker.status.get("pipelines", [])
+
+    def has_headroom(self, worker: WorkerState) -> bool:
+        """Whether `worker` has memory to build another pipeline. Workers that don't report free memory are assumed to."""
+        free = worker.status.get("free_memory_bytes")
+        return free is None or free >= self.min_free_memory_bytes
+
+    def cost(self, worker: WorkerState, params: ImageGenerationParams) -> float:
+        """Predicted seconds before `worker` could start denoising `params`."""
+        status = worker.status
+        wait = max(status.get("predicted_wait_s") or 0.0, worker.in_flight * (worker.avg_request_s or 0.0))
+        if not self.is_warm(worker, params):
+            wait += status.get("avg_pipeline_build_s") or self.DEFAULT_PIPELINE_BUILD_S
+        loras = [[lora.model, lora.weight_name] for lora in params.loras or []]
+        if loras != status.get("loras", []):
+            wait += status.get("avg_lora_swap_s") or self.DEFAULT_LORA_SWAP_S
+        return wait
+
+    def choose(self, params: ImageGenerationParams, exclude: Tuple[WorkerState, ...] = ()) -> Optional[WorkerState]:
+        candidates = [
+            worker for worker in self.workers
+            if worker.healthy and worker not in exclude
+            and (params.base_model is None or worker.status.get("base_model") == params.base_model)
+        ]
+        if not candidates:
+            return None
+        # A worker short on memory would have to evict warm pipelines to build one, or fail to. It only gets
+        # such a request when every worker is short.
+        roomy = [worker for worker in candidates if self.is_warm(worker, params) or self.has_headroom(worker)]
+        return min(roomy or candidates, key=lambda worker: (self.cost(worker, params), worker.in_flight))
+
+    def forward(self, worker: WorkerState, method: str, path: str, body: Optional[bytes] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Send a request to `worker` and return its status code, headers and body. Raises `WorkerUnreachableError`
+        if the request couldn't be sent. Once it was, failures are answered like a gateway would: 504 when the
+        worker didn't reply within `timeout_s`, 502 when the connection broke.
+        """
+        request = urllib.request.Request(
+            f"{worker.url}{path}",
+            data=body,
+            method=method,
+            headers={"Content-Type": "application/json"} if body is not None else {},
+        )
+        with self._lock:
+            worker.in_flight += 1
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                return (response.status, dict(response.headers), response.read())
+        except urllib.error.HTTPError as e:
+            return (e.code, dict(e.headers), e.read())
+        except urllib.error.URLError as e:
+            # urlopen wraps errors in connecting and sending, not those waiting for the response.
+            raise WorkerUnreachableError(f"{worker.url} unreachable: {e.reason}") from e
+        except TimeoutError:
+            return (504, {}, json.dumps({"detail": f"Worker {worker.url} didn't respond within {self.timeout_s}s."}).encode("utf-8"))
+        except OSError as e:
+            return (502, {}, json.dumps({"detail": f"Connection to worker {worker.url} failed: {e}"}).encode("utf-8"))
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                worker.in_flight -= 1
+                worker.avg_request_s = elapsed if worker.avg_request_s is None else 0.8 * worker.avg_request_s + 0.2 * elapsed
+
+    def route(self, params: ImageGenerationParams, path: str, body: bytes) -> Optional[Tuple[WorkerState, int, Dict[str, str], bytes]]:
+        """
+        Forward a generation request to the best worker, moving on to the next one if it can't be reached. A
+        request a worker got is never sent again, it may be running there.
+        """
+        tried: Tuple[WorkerState, ...] = ()
+        while (worker := self.choose(params, tried)) is not None:
+            metrics.increment("router_warm_routes" if self.is_warm(worker, params) else "router_cold_routes")
+            try:
+                return (worker, *self.forward(worker, "POST", path, body))
+            except WorkerUnreachableError as e:
+                print(f"{self.__class__.__name__}: {worker.url} unreachable, trying the next worker: {e}")
+                worker.healthy = False
+                tried = (*tried, worker)
+        return None
+
+    def remember_job(self, job_id: str, worker: WorkerState, max_jobs: int = 10000):
+        with self._lock:
+            self._job_workers[job_id] = worker
+            while len(self._job_workers) > max_jobs:
+                self._job_workers.popitem(last=False)
+
+    def job_worker(self, job_id: str) -> Optional[WorkerState]:
+        with self._lock:
+            return self._job_workers.get(job_id)
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import uvicorn
+    from fastapi import FastAPI, HTTPException, Request, Response
+    from pydantic import ValidationError
+    from ez_diffusion_client import ImageGenerateRequest
+
+    parser = argparse.ArgumentParser(description="Route image requests to the worker that has their pipelines and LoRAs warm")
+    parser.add_argument("--host", default="0.0.0.0", help="Host for the router")
+    parser.add_argument("--port", default=8080, type=int, help="Port for the router")
+    parser.add_argument("--workers", required=True, help="Comma separated base urls of `imagegen_service.py` workers.")
+    parser.add_argument("--poll_interval_s", default=2.0, type=float, help="How often workers are asked for their warm state and load.")
+    parser.add_argument("--timeout_s", default=300.0, type=float, help="How long to wait for a worker to respond. Requests that take longer get a 504 and are not sent elsewhere.")
+    parser.add_argument("--min_free_memory_mb", default=2048, type=int, help="Free device memory a worker needs to be sent a request whose pipeline it must build, while any worker has it.")
+    parser.add_argument("--max_generations", default=64, type=int, help="Generation requests forwarded at once. More wait in the router.")
+    args = parser.parse_args()
+
+    router = AffinityRouter(
+        args.workers.split(","),
+        poll_interval_s=args.poll_interval_s,
+        timeout_s=args.timeout_s,
+        min_free_memory_bytes=args.min_free_memory_mb * 1024 ** 2,
+    )
+    # Forwards block a thread until the worker responds, for a generation up to `timeout_s`. Job polls and
+    # cancels get threads of their own so they don't wait behind the generations they refer to.
+    generation_forwards = ThreadPoolExecutor(args.max_generations, thread_name_prefix="forward-generation")
+    job_forwards = ThreadPoolExecutor(8, thread_name_prefix="forward-job")
+    app = FastAPI(title="SDXL Worker Router", description="Routes SDXL Image Generation API requests to warm workers")
+
+    def worker_response(status: int, headers: Dict[str, str], body: bytes) -> Response:
+        passed = {name: value for (name, value) in headers.items() if name.lower() == "retry-after"}
+        return Response(content=body, status_code=status, headers=passed, media_type="application/json")
+
+    async def route_generation(request: Request) -> Tuple[WorkerState, int, Dict[str, str], bytes]:
+        body = await request.body()
+        try:
+            params = ImageGenerateRequest(**json.loads(body)).input
+        except (ValueError, ValidationError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        routed = await asyncio.get_running_loop().run_in_executor(generation_forwards, router.route, params, path, body)
+        if routed is None:
+            raise HTTPException(status_code=503, detail=f"No worker available for base model `{params.base_model}`." if params.base_model else "No worker available.")
+        return routed
+
+    @app.post("/text-to-image")
+    @app.post("/image-to-image")
+    @app.post("/inpaint")
+    async def generate(request: Request):
+        """Forward a blocking generation to the best worker."""
+        (_, status, headers, body) = await route_generation(request)
+        return worker_response(status, headers, body)
+
+    @app.post("/jobs", status_code=202)
+    async def submit_job(request: Request):
+        """Queue a generation on the best worker and remember where it went."""
+        (worker, status, headers, body) = await route_generation(request)
+        if status == 202:
+            router.remember_job(json.loads(body)["job_id"], worker)
+        return worker_response(status, headers, body)
+
+    async def forward_job(method: str, job_id: str) -> Response:
+        worker = router.job_worker(job_id)
+        if worker is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job `{job_id}`.")
+        try:
+            return worker_response(*await asyncio.get_running_loop().run_in_executor(job_forwards, router.forward, worker, method, f"/jobs/{job_id}"))
+        except WorkerUnreachableError:
+            raise HTTPException(status_code=502, detail=f"Worker holding job `{job_id}` is unreachable.")
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        """Get the status, and once finished the result, of a queued generation."""
+        return await forward_job("GET", job_id)
+
+    @app.delete("/jobs/{job_id}")
+    async def cancel_job(job_id: str):
+        """Cancel a queued generation on the worker that holds it."""
+        return await forward_job("DELETE", job_id)
+
+    @app.get("/health")
+    async def health():
+        """Router liveness with the last known state of every worker."""
+        return {
+            "status": "ok" if any(worker.healthy for worker in router.workers) else "degraded",
+            "workers": [
+                {"url": worker.url, "healthy": worker.healthy, "in_flight": worker.in_flight, **worker.status}
+                for worker in router.workers
+            ],
+        }
+
+    @app.get("/metrics")
+    async def get_metrics():
+        """Routing counters, such as how many requests found their pipeline warm."""
+        return metrics.snapshot()
+
+    print(f"Routing to {len(router.workers)} workers on {args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port)
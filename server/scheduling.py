@@ -0,0 +1,138 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+from metrics import metrics
+
+DEFAULT_TENANT = "default"
+
+
+class SchedulingPolicy(ABC):
+    """Decides which pending item an `InferenceExecutor` runs next."""
+
+    @abstractmethod
+    def select(self, pending: List) -> int:
+        """Index into the non-empty `pending` list of `WorkItem`s, oldest first, of the item to run next."""
+        pass
+
+    def accepts(self, item, pending: List) -> bool:
+        """Whether `item` may join the queue next to the `pending` items."""
+        return True
+
+    def record(self, item, seconds: float):
+        """Called once per selected or dropped item with the GPU-seconds it took, 0 if it never ran."""
+        pass
+
+
+class FifoPolicy(SchedulingPolicy):
+    def select(self, pending: List) -> int:
+        return 0
+
+
+class AffinityPolicy(SchedulingPolicy):
+    """
+    Prefers items with the same `WorkItem.affinity` as the item that ran last, so requests sharing a
+    pipeline and LoRA set run back to back instead of swapping adapters in and out. The oldest pending
+    item can be passed over at most `fairness_window` times before it runs regardless.
+    """
+
+    def __init__(self, fairness_window: int = 4):
+        self.fairness_window = fairness_window
+        self._last_affinity = None
+        self._head = None
+        self._head_bypassed = 0
+
+    def select(self, pending: List) -> int:
+        head = pending[0]
+        if head is not self._head:
+            (self._head, self._head_bypassed) = (head, 0)
+
+        index = 0
+        if head.affinity != self._last_affinity and self._head_bypassed < self.fairness_window:
+            index = next((i for (i, item) in enumerate(pending) if item.affinity == self._last_affinity), 0)
+            if index:
+                self._head_bypassed += 1
+                metrics.increment("affinity_reorders")
+
+        self._last_affinity = pending[index].affinity
+        return index
+
+
+class FairSharePolicy(SchedulingPolicy):
+    """
+    Weighted fair sharing of GPU time across tenants. Every tenant is charged the GPU-seconds its
+    requests take, divided by its weight, and the backlogged tenant with the least charge runs next.
+    A tenant that went idle rejoins at the charge of the least served backlogged tenant, so idling
+    doesn't bank credit. `within` orders the requests of one tenant, first come first served by default.
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        max_pending_per_tenant: Optional[int] = None,
+        within: Optional[SchedulingPolicy] = None,
+    ):
+        self.weights = weights or {}
+        self.max_pending_per_tenant = max_pending_per_tenant
+        self.within = within or FifoPolicy()
+        self._charge: Dict[str, float] = {}
+        # Predicted seconds already charged at selection, settled against the measured time in `record`.
+        self._precharged: Dict[int, float] = {}
+
+    def __tenant(self, item) -> str:
+        return item.tenant or DEFAULT_TENANT
+
+    def __weight(self, tenant: str) -> float:
+        return self.weights.get(tenant, 1.0)
+
+    def accepts(self, item, pending: List) -> bool:
+        tenant = self.__tenant(item)
+        queued = [self.__tenant(other) for other in pending]
+        if self.max_pending_per_tenant is not None and queued.count(tenant) >= self.max_pending_per_tenant:
+            metrics.increment(f"tenant_queue_full.{tenant}")
+            return False
+        if tenant not in queued:
+            backlogged = [self._charge.get(other, 0.0) for other in set(queued)]
+            self._charge[tenant] = max([self._charge.get(tenant, 0.0), *([min(backlogged)] if backlogged else [])])
+        return True
+
+    def select(self, pending: List) -> int:
+        by_tenant: Dict[str, List[int]] = {}
+        for (i, item) in enumerate(pending):
+            by_tenant.setdefault(self.__tenant(item), []).append(i)
+        tenant = min(by_tenant, key=lambda t: self._charge.get(t, 0.0))
+        indices = by_tenant[tenant]
+        index = indices[self.within.select([pending[i] for i in indices])]
+
+        item = pending[index]
+        predicted = item.admission.predicted_s if item.admission is not None else 0.0
+        self._precharged[id(item)] = predicted
+        self._charge[tenant] = self._charge.get(tenant, 0.0) + predicted / self.__weight(tenant)
+        return index
+
+    def record(self, item, seconds: float):
+        tenant = self.__tenant(item)
+        precharged = self._precharged.pop(id(item), 0.0)
+        self._charge[tenant] = self._charge.get(tenant, 0.0) + (seconds - precharged) / self.__weight(tenant)
+        metrics.increment(f"tenant_gpu_seconds.{tenant}", seconds)
+
+
+def parse_tenant_weights(spec: Optional[str]) -> Dict[str, float]:
+    """Parse `tenant=weight` pairs separated by commas, e.g. `interactive=4,bulk=0.5`."""
+    weights = {}
+    for pair in (spec or "").split(","):
+        if pair.strip():
+            (tenant, weight) = pair.split("=")
+            weights[tenant.strip()] = float(weight)
+    return weights
+
+
+def build_scheduling_policy(
+    affinity_window: int = 0,
+    fair_share: bool = False,
+    tenant_weights: Optional[Dict[str, float]] = None,
+    max_pending_per_tenant: Optional[int] = None,
+) -> SchedulingPolicy:
+    """Policy for the command line flags shared by the FastAPI server and the RunPod handler."""
+    policy = AffinityPolicy(affinity_window) if affinity_window > 0 else FifoPolicy()
+    if fair_share:
+        policy = FairSharePolicy(tenant_weights, max_pending_per_tenant, within=policy)
+    return policy
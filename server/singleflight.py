@@ -0,0 +1,102 @@
+import copy
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+import torch
+from caching import canonical_hash
+from ez_diffusion_client import ImageGenerationParams
+from metrics import metrics
+from step_hooks import JobCancelledError, StepObserver
+
+
+class _Flight(StepObserver):
+    """Observer of a shared computation. Reports steps to every waiter and stops once all of them have stopped."""
+
+    def __init__(self):
+        self.waiters: List[tuple] = []
+        self.lock = threading.Lock()
+
+    def join(self, observer: Optional[StepObserver]) -> Future:
+        future: Future = Future()
+        with self.lock:
+            self.waiters.append((future, observer))
+        return future
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        with self.lock:
+            waiters = [(future, observer) for (future, observer) in self.waiters if not future.done()]
+        for (future, observer) in waiters:
+            # Waiters show as running from the first denoising step. Ones cancelled before that drop out here.
+            if not future.running() and not future.set_running_or_notify_cancel():
+                continue
+            if observer is not None:
+                observer.on_step_end(pipe, step, total_steps, latents)
+
+    def stop_reason(self) -> Optional[str]:
+        with self.lock:
+            waiters = list(self.waiters)
+        reasons = [
+            "cancelled" if future.cancelled() else (observer.stop_reason() if observer is not None else None)
+            for (future, observer) in waiters
+        ]
+        if reasons and all(reasons):
+            return reasons[0]
+        return None
+
+    def settle(self, result: Future):
+        with self.lock:
+            waiters = list(self.waiters)
+        for (future, observer) in waiters:
+            if future.done() or (not future.running() and not future.set_running_or_notify_cancel()):
+                continue
+            reason = observer.stop_reason() if observer is not None else None
+            if result.cancelled() or reason:
+                future.set_exception(JobCancelledError(reason or "cancelled"))
+            elif result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                # Each waiter gets its own response dict.
+                future.set_result(copy.copy(result.result()))
+
+
+class SingleFlight:
+    """
+    Runs requests with the same key once at a time. A request arriving while an identical one is in
+    flight waits for that computation instead of starting its own. Every request gets its own future
+    and keeps its own progress events, cancellation and deadline: the shared computation only stops
+    once every request waiting on it has stopped.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Optional[str], observer: Optional[StepObserver], start: Callable[[Optional[StepObserver]], Future]) -> Future:
+        """
+        The result of `start(observer)`, shared with in-flight requests under the same `key`.
+        Requests without a key always start their own computation. Errors raised by `start` are passed on.
+        """
+        if key is None:
+            return start(observer)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                metrics.increment("coalesced_requests")
+                return flight.join(observer)
+            flight = _Flight()
+            future = flight.join(observer)
+            result = start(flight)
+            self._flights[key] = flight
+        result.add_done_callback(lambda result: self.__land(key, flight, result))
+        return future
+
+    def __land(self, key: str, flight: _Flight, result: Future):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.settle(result)
+
+
+def coalescing_key(params: ImageGenerationParams) -> Optional[str]:
+    """Requests are only shared when they are seeded, unseeded ones are expected to differ."""
+    return canonical_hash(params) if params.seed is not None else None
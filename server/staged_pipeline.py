@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+import torch
+from ez_diffusion_client import ImageGenerationParams
+from checkpointing import Checkpointer
+from imagegen_service import ImageGenService, PreparedBatch
+from inference_executor import InferenceExecutor
+from metrics import metrics
+from step_hooks import JobCancelledError, StepObserver
+
+
+class StagedImagePipeline:
+    """
+    Runs image requests in three stages, so the executor's thread only ever denoises. A pool of
+    `prepare_workers` threads loads input images, runs ControlNet annotators and encodes prompts
+    (`ImageGenService.prepare_batch`), the executor picks requests up once they are prepared, and a
+    pool of `encode_workers` threads turns the final latents into response images (`decode_latents`
+    and `encode_batch`) while the executor already denoises the next request. On CUDA, decoding runs
+    on its own stream so it overlaps with the next request's denoising on the GPU too.
+
+    Requests join the executor's queue as soon as they are submitted, so admission, queue limits,
+    scheduling and preemption work as without staging.
+    """
+
+    def __init__(self, service: ImageGenService, executor: InferenceExecutor, prepare_workers: int = 2, encode_workers: int = 2):
+        self.service = service
+        self.executor = executor
+        self.prepare_pool = ThreadPoolExecutor(prepare_workers, thread_name_prefix="prepare")
+        self.encode_pool = ThreadPoolExecutor(encode_workers, thread_name_prefix="encode")
+        # Factories that can't decode outside the pipeline call keep decoding on the executor's thread.
+        self.decode_separately = service.pipeline_factory.decodes_latents
+        self._decode_streams: Dict[torch.device, Any] = {}
+
+    def submit(
+        self,
+        params: ImageGenerationParams,
+        observer: Optional[StepObserver] = None,
+        checkpointer: Optional[Checkpointer] = None,
+        **scheduling
+    ) -> Future:
+        """Queue a request. `scheduling` is passed on to `InferenceExecutor.submit`. Raises `QueueFullError` like it."""
+        result: Future = Future()
+        prepared: Future = Future()
+        denoised = self.executor.submit(self.__denoise, result, prepared, observer=observer, checkpointer=checkpointer, after=prepared, **scheduling)
+        # The result only starts running with denoising, until then cancelling it drops the queued request.
+        result.add_done_callback(lambda f: f.cancelled() and denoised.cancel())
+        denoised.add_done_callback(lambda f: self.__finish(result, prepared, f))
+        self.prepare_pool.submit(self.__prepare, prepared, params, observer, checkpointer)
+        return result
+
+    def __prepare(self, prepared: Future, params: ImageGenerationParams, observer: Optional[StepObserver], checkpointer: Optional[Checkpointer]):
+        reason = observer.stop_reason() if observer is not None else None
+        try:
+            if reason:
+                raise JobCancelledError(reason)
+            start = time.monotonic()
+            prepared.set_result(self.service.prepare_batch([params], checkpointer))
+            metrics.increment("staged_prepare_seconds", time.monotonic() - start)
+        except Exception as e:
+            prepared.set_exception(e)
+
+    def __denoise(
+        self,
+        result: Future,
+        prepared: Future,
+        observer: Optional[StepObserver] = None,
+        checkpointer: Optional[Checkpointer] = None,
+    ):
+        if not result.set_running_or_notify_cancel():
+            raise JobCancelledError("cancelled")
+        output = self.service.denoise_batch(prepared.result(), [observer], checkpointer, decode=not self.decode_separately)
+        if isinstance(output, torch.Tensor) and output.is_cuda:
+            # Marks where the latents are final on the executor's stream, for the decode stream to wait on.
+            done = torch.cuda.Event()
+            done.record(torch.cuda.current_stream(output.device))
+            return (output, done)
+        return (output, None)
+
+    def __finish(self, result: Future, prepared: Future, denoised: Future):
+        if denoised.cancelled():
+            return
+        if denoised.exception() is not None:
+            self.__settle(result, exception=denoised.exception())
+        else:
+            self.encode_pool.submit(self.__encode, result, prepared.result(), *denoised.result())
+
+    def __decode(self, latents: torch.Tensor, done):
+        if done is None:
+            return self.service.pipeline_factory.decode_latents(latents)
+        stream = self._decode_streams.get(latents.device)
+        if stream is None:
+            stream = self._decode_streams.setdefault(latents.device, torch.cuda.Stream(latents.device))
+        with torch.cuda.stream(stream):
+            stream.wait_event(done)
+            # The executor's stream may reuse the latents' memory once it's freed there.
+            latents.record_stream(stream)
+            return self.service.pipeline_factory.decode_latents(latents)
+
+    def __encode(self, result: Future, prepared: PreparedBatch, output, done):
+        try:
+            start = time.monotonic()
+            if isinstance(output, torch.Tensor):
+                output = self.__decode(output, done)
+                metrics.increment("staged_decode_seconds", time.monotonic() - start)
+            response = self.service.encode_batch(prepared, output)[0]
+            metrics.increment("staged_encode_seconds", time.monotonic() - start)
+            self.__settle(result, value=response)
+        except Exception as e:
+            self.__settle(result, exception=e)
+
+    def __settle(self, result: Future, value: Optional[Dict[str, Any]] = None, exception: Optional[BaseException] = None):
+        try:
+            if exception is not None:
+                result.set_exception(exception)
+            else:
+                result.set_result(value)
+        except InvalidStateError:
+            # Cancelled while its executor item was finishing.
+            pass
@@ -0,0 +1,127 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional
+import torch
+from metrics import metrics
+from utils import latents_to_preview
+
+
+class JobCancelledError(Exception):
+    """Raised for a request that was cancelled or ran past its deadline before it finished."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Job stopped: {reason}")
+        self.reason = reason
+
+
+class StepObserver(ABC):
+    """Follows one request through the denoising loop. Fed from the pipeline's step-end callback."""
+
+    @abstractmethod
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        pass
+
+    def stop_reason(self) -> Optional[str]:
+        """Why the request should stop at the next step boundary, or None to keep denoising."""
+        return None
+
+
+class ProgressReporter(StepObserver):
+    """Emits a progress event after every step, with a low resolution latent preview every `preview_every` steps."""
+
+    def __init__(
+        self,
+        emit: Callable[[Dict[str, Any]], None],
+        preview_every: Optional[int] = None,
+        preview_size: int = 64,
+    ):
+        self.emit = emit
+        self.preview_every = preview_every
+        self.preview_size = preview_size
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        event: Dict[str, Any] = {"status": "IN_PROGRESS", "step": step + 1, "total_steps": total_steps}
+        if self.preview_every and (step + 1) % self.preview_every == 0:
+            preview = latents_to_preview(latents, is_sdxl=hasattr(pipe, "text_encoder_2"), size=self.preview_size)
+            if preview is not None:
+                event["preview"] = preview
+        self.emit(event)
+
+
+class CancellationToken(StepObserver):
+    """Stops its request once `cancel` is called or `deadline_s` seconds after creation."""
+
+    def __init__(self, deadline_s: Optional[float] = None):
+        self.deadline = time.monotonic() + deadline_s if deadline_s else None
+        self._reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if self._reason is None:
+            self._reason = reason
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        pass
+
+    def stop_reason(self) -> Optional[str]:
+        if self._reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self._reason = "deadline exceeded"
+        return self._reason
+
+
+class ObserverGroup(StepObserver):
+    """Lets several observers follow the same request."""
+
+    def __init__(self, *observers: Optional[StepObserver]):
+        self.observers = [observer for observer in observers if observer is not None]
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        for observer in self.observers:
+            observer.on_step_end(pipe, step, total_steps, latents)
+
+    def stop_reason(self) -> Optional[str]:
+        return next((reason for reason in (observer.stop_reason() for observer in self.observers) if reason), None)
+
+
+def record_interrupt(remaining_steps: int, step_seconds: float):
+    """Count the denoising work skipped by stopping a request early."""
+    metrics.increment("denoise_interrupts")
+    metrics.increment("gpu_seconds_reclaimed", max(0, remaining_steps) * step_seconds)
+
+
+def raise_if_interrupted(pipe, observers: List[Optional[StepObserver]]):
+    """Fail the pipeline call with `JobCancelledError` if a step-end callback interrupted it."""
+    if getattr(pipe, "_interrupt", False):
+        reason = next((observer.stop_reason() for observer in observers if observer is not None), None)
+        raise JobCancelledError(reason or "interrupted")
+
+
+def step_end_callback(observers: List[Optional[StepObserver]], total_steps: int) -> Optional[Callable]:
+    """
+    Build a `callback_on_step_end` that hands each observer the latents of its own sample in the batch,
+    and sets the pipeline's interrupt flag once all of them ask to stop.
+    """
+    if not any(observers):
+        return None
+    started = time.monotonic()
+    first_step_end: Optional[float] = None
+
+    def callback(pipe, step: int, timestep, callback_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal first_step_end
+        now = time.monotonic()
+        # The first step also carries prompt encoding, so later steps are timed from its end.
+        step_seconds = (now - first_step_end) / step if step else now - started
+        first_step_end = first_step_end or now
+        latents = callback_kwargs["latents"]
+        total = getattr(pipe, "num_timesteps", total_steps)
+        for (i, observer) in enumerate(observers):
+            if observer is not None:
+                observer.on_step_end(pipe, step, total, latents[i:i + 1])
+
+        # A shared pipeline call can only stop once every request in it wants to stop.
+        if all(observer is not None and observer.stop_reason() for observer in observers):
+            print(f"Interrupting denoising after step {step + 1}/{total}: {observers[0].stop_reason()}")
+            record_interrupt(total - step - 1, step_seconds)
+            pipe._interrupt = True
+        return callback_kwargs
+
+    return callback
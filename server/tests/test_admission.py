@@ -0,0 +1,55 @@
+import threading
+import time
+import pytest
+from admission import AdmissionController, AdmissionRejected, CostModel
+from inference_executor import InferenceExecutor, QueueFullError
+from metrics import metrics
+
+
+def test_requests_past_the_latency_budget_are_rejected():
+    admission = AdmissionController(CostModel(seconds_per_unit=2.0), latency_budget_s=10)
+    # An idle worker takes a request larger than the whole budget, it has to run somewhere.
+    first = admission.admit(8)
+    assert admission.predicted_wait() == 16
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit(1)
+    # 16s of committed work plus 2s of its own is 8s over the budget.
+    assert rejected.value.retry_after == 8
+
+    admission.release(first)
+    assert admission.predicted_wait() == 0
+    admission.admit(4)
+
+
+def test_measured_runs_calibrate_the_cost_model():
+    cost_model = CostModel(seconds_per_unit=1.0, smoothing=0.5)
+    admission = AdmissionController(cost_model)
+    admission.release(admission.admit(10), seconds=30)
+    assert cost_model.seconds_per_unit == 2.0
+    # Dropped work isn't measured.
+    admission.release(admission.admit(10))
+    assert cost_model.seconds_per_unit == 2.0
+
+
+def test_executor_turns_rejections_into_queue_full_errors():
+    admission = AdmissionController(CostModel(seconds_per_unit=1.0), latency_budget_s=5)
+    executor = InferenceExecutor(max_queue_size=16, admission=admission)
+    (started, release) = (threading.Event(), threading.Event())
+    running = executor.submit(lambda: (started.set(), release.wait(10)), work=4)
+    assert started.wait(10)
+
+    rejections = metrics.snapshot().get("jobs_rejected_by_admission", 0)
+    with pytest.raises(QueueFullError) as rejected:
+        executor.submit(lambda: "rejected", work=3)
+    assert rejected.value.retry_after == 2
+    assert "latency budget" in str(rejected.value)
+    assert metrics.snapshot()["jobs_rejected_by_admission"] == rejections + 1
+
+    release.set()
+    running.result(10)
+    # The executor releases the admission right after settling the future.
+    deadline = time.monotonic() + 10
+    while admission.predicted_wait() > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert executor.submit(lambda: "admitted", work=3).result(10) == "admitted"
@@ -0,0 +1,110 @@
+import time
+from concurrent.futures import Future
+import torch
+from caching import BoundedCache, ResultCache, sizeof_tensors
+from ez_diffusion_client import ImageGenerationParams
+from metrics import metrics
+
+
+def tensor(n_bytes: int) -> torch.Tensor:
+    return torch.zeros(n_bytes, dtype=torch.uint8)
+
+
+def test_least_recently_used_entries_are_evicted_by_bytes():
+    cache = BoundedCache("test_lru", 100, sizeof_tensors)
+    evictions = metrics.snapshot().get("test_lru_cache_evictions", 0)
+    cache.put("a", tensor(40))
+    cache.put("b", tensor(40))
+    assert cache.get("a") is not None
+
+    cache.put("c", tensor(40))
+    assert ("a" in cache, "b" in cache, "c" in cache) == (True, False, True)
+    assert cache.bytes == 80
+    assert metrics.snapshot()["test_lru_cache_evictions"] == evictions + 1
+
+    # Replacing an entry frees its old size first.
+    cache.put("c", tensor(60))
+    assert (len(cache), cache.bytes) == (2, 100)
+
+
+def test_values_larger_than_the_cache_are_not_stored():
+    cache = BoundedCache("test_oversized", 100, sizeof_tensors)
+    cache.put("a", tensor(40))
+    cache.put("huge", tensor(101))
+    assert ("a" in cache, "huge" in cache) == (True, False)
+
+
+def test_expired_entries_are_missing():
+    cache = BoundedCache("test_ttl", 100, sizeof_tensors, ttl_s=0.05)
+    cache.put("a", tensor(40))
+    assert cache.get("a") is not None
+    time.sleep(0.1)
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert (len(cache), cache.bytes) == (0, 0)
+
+
+def params(**kwargs) -> ImageGenerationParams:
+    return ImageGenerationParams(prompt="a cat", dimensions={"width": 64, "height": 64}, **kwargs)
+
+
+def generation(response: dict) -> "Future":
+    future = Future()
+    future.set_result(response)
+    return future
+
+
+def test_only_reproducible_requests_have_a_result_key():
+    cache = ResultCache({"revision": "a"}, memory_bytes=1024)
+    assert cache.key(params(seed=1, guidance_scale=7)) == cache.key(params(seed=1, guidance_scale=7.0))
+    assert cache.key(params(seed=1)) != ResultCache({"revision": "b"}, memory_bytes=1024).key(params(seed=1))
+    assert cache.key(params()) is None
+    assert cache.key(params(seed=1, image_to_image={"starting_image": {"source": "https://example.com/cat.png"}})) is None
+
+
+def test_results_are_served_from_memory_until_evicted():
+    cache = ResultCache({"revision": "a"}, memory_bytes=48)
+    starts = []
+
+    def start(response: dict):
+        def run():
+            starts.append(response)
+            return generation(response)
+        return run
+
+    (cat, dog) = (cache.key(params(seed=1)), cache.key(params(seed=2)))
+
+    assert cache.submit(cat, start({"image": "cat", "warnings": []})).result() == {"image": "cat", "warnings": []}
+    served = cache.submit(cat, start({"image": "other"})).result()
+    assert served == {"image": "cat", "warnings": []}
+    served["warnings"].append("changed by the caller")
+    assert cache.get(cat) == {"image": "cat", "warnings": []}
+    assert len(starts) == 1
+
+    # Two 32 byte responses don't fit in 48 bytes, the least recently used one goes.
+    cache.submit(dog, start({"image": "dog", "warnings": []}))
+    assert (cache.get(cat), cache.get(dog)) == (None, {"image": "dog", "warnings": []})
+
+
+def test_degraded_and_failed_results_are_not_cached():
+    cache = ResultCache({"revision": "a"}, memory_bytes=1024)
+    key = cache.key(params(seed=1))
+    cache.submit(key, lambda: generation({"image": "cat", "warnings": ["Quality lowered under load"]}))
+    failed = Future()
+    failed.set_exception(RuntimeError("out of memory"))
+    cache.submit(key, lambda: failed)
+    assert cache.get(key) is None
+
+
+def test_disk_results_outlive_the_process_within_their_bound(tmp_path):
+    first = ResultCache({"revision": "a"}, memory_bytes=1024, disk_dir=str(tmp_path), disk_bytes=40)
+    (cat, dog, mouse) = (first.key(params(seed=seed)) for seed in (1, 2, 3))
+    first.put(cat, {"image": "cat"})
+
+    restarted = ResultCache({"revision": "a"}, memory_bytes=1024, disk_dir=str(tmp_path), disk_bytes=40)
+    assert restarted.get(cat) == {"image": "cat"}
+
+    # Three 16 to 18 byte files don't fit in 40 bytes, the least recently used one goes.
+    restarted.put(dog, {"image": "dog"})
+    restarted.put(mouse, {"image": "mouse"})
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([f"{dog}.json", f"{mouse}.json"])
@@ -0,0 +1,88 @@
+import torch
+from checkpointing import Checkpointer, FilesystemCheckpointStore
+from step_hooks import StepObserver
+
+
+class StubScheduler:
+    """Index based like Euler: looks its sigma up by a step index it finds from the first timestep."""
+    order = 1
+
+    def set_timesteps(self, num_inference_steps: int):
+        self.timesteps = torch.arange(num_inference_steps - 1, -1, -1) * 50
+        self.sigmas = self.timesteps.float() / 1000
+        self._step_index = None
+
+    def step(self, latents: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
+        if self._step_index is None:
+            self._step_index = int((self.timesteps == t).nonzero()[0])
+        sigma = self.sigmas[self._step_index]
+        self._step_index += 1
+        return latents * 0.9 + sigma
+
+
+class StubPipe:
+    def __init__(self):
+        self.scheduler = StubScheduler()
+        self.ran = []
+
+    def __call__(self, num_inference_steps: int, latents: torch.Tensor, observers):
+        self.scheduler.set_timesteps(num_inference_steps)
+        timesteps = self.scheduler.timesteps
+        for (i, t) in enumerate(timesteps):
+            self.ran.append((int(t), float(self.scheduler.sigmas[self.scheduler._step_index or 0])))
+            latents = self.scheduler.step(latents, t)
+            for observer in observers:
+                observer.on_step_end(self, i, len(timesteps), latents)
+        return latents
+
+
+class Killed(Exception):
+    pass
+
+
+class KillAfter(StepObserver):
+    def __init__(self, checkpointer: Checkpointer, step: int):
+        self.checkpointer = checkpointer
+        self.step = step
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        if self.checkpointer.completed_steps + step + 1 == self.step:
+            raise Killed()
+
+
+def run(store, kill_at=None) -> tuple:
+    """One worker's attempt at the job, as `ImageGenService.denoise_batch` drives the checkpointer."""
+    pipe = StubPipe()
+    checkpointer = Checkpointer(store, "job", {"prompt": "a cat"}, every_n_steps=5)
+    resume = checkpointer.resume_state()
+    latents = resume["latents"] if resume is not None else torch.zeros(1, 4, 2, 2)
+    observers = [checkpointer] + ([KillAfter(checkpointer, kill_at)] if kill_at else [])
+    with checkpointer.resuming(pipe.scheduler):
+        try:
+            latents = pipe(20, latents, observers)
+        except Killed:
+            return (pipe.ran, None)
+    checkpointer.complete()
+    return (pipe.ran, latents)
+
+
+def test_resuming_twice_runs_every_step_once(tmp_path):
+    (expected_steps, expected) = run(FilesystemCheckpointStore(str(tmp_path / "uninterrupted")))
+
+    store = FilesystemCheckpointStore(str(tmp_path / "killed"))
+    (first, _) = run(store, kill_at=7)
+    (second, _) = run(store, kill_at=12)
+    (third, latents) = run(store)
+
+    # Steps after the last checkpoint rerun, the rest must line up with the uninterrupted run.
+    assert first[:5] + second[:5] + third == expected_steps
+    assert torch.allclose(latents, expected)
+    assert store.load("job") is None
+
+
+def test_checkpoint_of_other_inputs_is_ignored(tmp_path):
+    store = FilesystemCheckpointStore(str(tmp_path))
+    run(store, kill_at=7)
+    checkpointer = Checkpointer(store, "job", {"prompt": "a dog"})
+    assert checkpointer.resume_state() is None
+    assert checkpointer.completed_steps == 0
@@ -0,0 +1,61 @@
+import threading
+from types import SimpleNamespace
+from continuous_batching import ContinuousBatchingEngine
+from inference_executor import WorkItem
+from scheduling import FairSharePolicy, FifoPolicy
+
+SQUARE = (512, 512)
+
+
+def engine(policy=None, max_batch_size: int = 4) -> ContinuousBatchingEngine:
+    """The engine's admission state, without a pipeline or a thread running it."""
+    engine = ContinuousBatchingEngine.__new__(ContinuousBatchingEngine)
+    engine.policy = policy or FifoPolicy()
+    engine.max_batch_size = max_batch_size
+    engine._pending = []
+    engine._active = []
+    engine._cond = threading.Condition()
+    return engine
+
+
+def request(key=SQUARE, tenant=None) -> WorkItem:
+    return WorkItem(fn=None, key=key, tenant=tenant)
+
+
+def running(item: WorkItem):
+    return SimpleNamespace(request=item)
+
+
+def test_unbatchable_requests_wait_for_the_batch_to_drain():
+    batching = engine()
+    batching._active = [running(request())]
+    unbatchable = request(key=None)
+    later = request()
+    batching._pending = [unbatchable, later]
+
+    # Nothing joins while the older unbatchable request waits, and it doesn't run beside the batch.
+    assert batching._take_admissible() == []
+    batching._active = []
+    assert batching._take_admissible() == [unbatchable]
+    assert batching._take_admissible() == [later]
+
+
+def test_requests_join_the_running_batch_at_its_resolution():
+    batching = engine(max_batch_size=3)
+    batching._active = [running(request())]
+    joining = [request(), request()]
+    batching._pending = [*joining, request()]
+    assert batching._take_admissible() == joining
+
+
+def test_batches_follow_the_fair_share_policy():
+    policy = FairSharePolicy()
+    batching = engine(policy, max_batch_size=2)
+    for tenant in ("bulk", "bulk", "bulk", "interactive"):
+        item = request(tenant=tenant)
+        assert policy.accepts(item, batching._pending)
+        batching._pending.append(item)
+    policy.record(request(tenant="bulk"), 10.0)
+
+    first = batching._take_admissible()
+    assert [item.tenant for item in first] == ["interactive", "bulk"]
@@ -0,0 +1,43 @@
+import queue
+import threading
+import pytest
+from device_pool import DevicePool, DeviceWorker
+from inference_executor import QueueFullError
+
+
+def pool(devices, max_queue_size: int) -> DevicePool:
+    """A pool of ready replicas that only queue the jobs sent to them, without processes behind them."""
+    pool = DevicePool.__new__(DevicePool)
+    pool.affinity_key = lambda job_input: job_input.get("model")
+    pool.max_queue_size = max_queue_size
+    pool.cold_penalty = 0.5
+    pool._next_key = 0
+    pool._avg_job_s = None
+    pool._lock = threading.Lock()
+    pool.workers = [DeviceWorker(device=device, process=None, requests=queue.Queue(), responses=queue.Queue()) for device in devices]
+    for worker in pool.workers:
+        worker.ready.set()
+    return pool
+
+
+def test_replicas_queue_at_most_max_queue_size_jobs():
+    replicas = pool(["cpu"], max_queue_size=2)
+    replicas.submit({"input": {}})
+    replicas.submit({"input": {}})
+    with pytest.raises(QueueFullError):
+        replicas.submit({"input": {}})
+    assert len(replicas.workers[0].in_flight) == 2
+
+
+def test_jobs_prefer_warm_replicas_until_they_are_full():
+    replicas = pool(["cuda:0", "cuda:1"], max_queue_size=2)
+    replicas.cold_penalty = 5
+    (warm, cold) = replicas.workers
+    warm.last_affinity = "sdxl"
+    cold.last_affinity = "sd15"
+    replicas.submit({"input": {"model": "sdxl"}})
+    replicas.submit({"input": {"model": "sdxl"}})
+    # The warm replica is full, the cold one takes the job instead of it being rejected.
+    replicas.submit({"input": {"model": "sdxl"}})
+    assert (len(warm.in_flight), len(cold.in_flight)) == (2, 1)
+    assert warm.requests.qsize() == 2
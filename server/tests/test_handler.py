@@ -0,0 +1,80 @@
+import argparse
+import os
+import pytest
+import torch
+from checkpointing import Checkpointer
+from handler import co_running_jobs, get_job_submitter, image_batch_size
+from imagegen_service import ImageGenService
+from test_checkpointing import Killed, StubPipe
+
+
+class StubPipelineFactory:
+    def get_pipeline_key(self, params) -> tuple:
+        return ("stub",)
+
+
+class StubImageService(ImageGenService):
+    """Denoises with `StubPipe`, checkpointing like `ImageGenService.denoise_batch`, and can be killed at a step."""
+
+    def __init__(self):
+        super().__init__(StubPipelineFactory(), controlnet_params_factory=None)
+        self.kill_at = None
+        self.batches = []
+
+    def generate_batch(self, batch, observers=None, checkpointer=None):
+        self.batches.append(len(batch))
+        pipe = StubPipe()
+        resume = checkpointer.resume_state() if checkpointer is not None else None
+        latents = resume["latents"] if resume is not None else torch.zeros(len(batch), 4, 2, 2)
+        kill = self.kill_at
+
+        class KillAt:
+            def on_step_end(self, pipe, step, total_steps, latents):
+                if kill is not None and checkpointer.completed_steps + step + 1 == kill:
+                    raise Killed()
+
+        if checkpointer is None:
+            return [{"latents": latents} for latents in pipe(20, latents, [])]
+        with checkpointer.resuming(pipe.scheduler):
+            latents = pipe(20, latents, [checkpointer, KillAt()])
+        checkpointer.complete()
+        return [{"latents": latents[0], "ran": len(pipe.ran)}]
+
+
+def handler_args(**overrides) -> argparse.Namespace:
+    """The flags of handler.py at their defaults."""
+    defaults = dict(
+        concurrent=False, max_concurrency=4, max_batch_size=1, max_batch_wait_ms=20, max_queue_size=16,
+        latency_budget_s=None, affinity_window=0, fair_share=False, tenant_weights=None, max_queue_per_tenant=None,
+        checkpoint_dir=None, checkpoint_every=5, preempt_time_slice_s=None, prepare_workers=0,
+        degrade_queue_depth=None, degrade_wait_s=None,
+    )
+    return argparse.Namespace(**{**defaults, **overrides})
+
+
+JOB = {"id": "job-1", "input": {"prompt": "a cat", "dimensions": {"width": 64, "height": 64}}}
+
+
+def test_concurrent_mode_batches_without_changing_the_flags():
+    args = handler_args(concurrent=True)
+    assert (image_batch_size(StubImageService(), args), co_running_jobs(StubImageService(), args)) == (4, 4)
+    assert args.max_batch_size == 1
+
+
+@pytest.mark.parametrize("flags", [dict(), dict(max_batch_size=4)], ids=["auto", "batching"])
+def test_concurrent_mode_checkpoints_jobs(tmp_path, flags):
+    service = StubImageService()
+    args = handler_args(concurrent=True, checkpoint_dir=str(tmp_path), **flags)
+    submit = get_job_submitter(service, args)
+
+    service.kill_at = 7
+    with pytest.raises(Killed):
+        submit(JOB).result(10)
+    assert os.listdir(tmp_path)
+
+    service.kill_at = None
+    result = submit(JOB).result(10)
+    # Resumed from the checkpoint after step 5 instead of starting over.
+    assert result["ran"] == 15
+    assert not os.listdir(tmp_path)
+    assert service.batches == [1, 1]
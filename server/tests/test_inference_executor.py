@@ -0,0 +1,38 @@
+import threading
+import pytest
+from inference_executor import InferenceExecutor, QueueFullError
+
+
+def blocked_executor(max_queue_size: int, **kwargs) -> tuple:
+    """An executor whose thread is busy until the returned event is set."""
+    executor = InferenceExecutor(max_queue_size=max_queue_size, **kwargs)
+    (started, release) = (threading.Event(), threading.Event())
+    executor.submit(lambda: (started.set(), release.wait(10)))
+    assert started.wait(10)
+    return (executor, release)
+
+
+def test_full_queue_is_rejected_with_a_retry_after():
+    (executor, release) = blocked_executor(max_queue_size=2)
+    queued = [executor.submit(lambda i=i: i) for i in range(2)]
+
+    with pytest.raises(QueueFullError) as rejected:
+        executor.submit(lambda: "rejected")
+    # One running and two queued items of about a second each.
+    assert rejected.value.retry_after == 3
+    assert "Retry after 3s" in str(rejected.value)
+
+    release.set()
+    assert [future.result(10) for future in queued] == [0, 1]
+    assert executor.submit(lambda: "accepted").result(10) == "accepted"
+
+
+def test_cancelled_items_never_run():
+    (executor, release) = blocked_executor(max_queue_size=2)
+    ran = []
+    cancelled = executor.submit(lambda: ran.append("cancelled"))
+    assert cancelled.cancel()
+
+    release.set()
+    executor.submit(lambda: ran.append("next")).result(10)
+    assert ran == ["next"]
@@ -0,0 +1,75 @@
+import hashlib
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from PIL import Image
+import utils
+
+
+def png(color: str) -> bytes:
+    encoded = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(encoded, "PNG")
+    return encoded.getvalue()
+
+
+@pytest.fixture
+def image_server():
+    """Serves one PNG with an ETag, honouring If-None-Match, and records the requests it gets."""
+    state = {"body": png("red"), "etag": True, "requests": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            etag = f'"{hashlib.md5(state["body"]).hexdigest()}"'
+            state["requests"].append(self.headers.get("If-None-Match"))
+            if state["etag"] and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            if state["etag"]:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(state["body"])))
+            self.end_headers()
+            self.wfile.write(state["body"])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    utils.input_image_cache.clear()
+    utils.url_validators.clear()
+    yield (f"http://127.0.0.1:{server.server_address[1]}/guide.png", state)
+    server.shutdown()
+
+
+def load(url: str) -> tuple:
+    return utils.load_image_from_base64_or_url(url, 16, 16).getpixel((0, 0))
+
+
+def test_urls_are_revalidated_in_one_round_trip(image_server):
+    (url, state) = image_server
+    assert load(url) == (255, 0, 0)
+    assert load(url) == (255, 0, 0)
+    state["body"] = png("blue")
+    assert load(url) == (0, 0, 255)
+    # The first request is unconditional, every later one revalidates the last response.
+    assert len(state["requests"]) == 3 and state["requests"][0] is None and all(state["requests"][1:])
+
+
+def test_urls_without_validators_are_keyed_by_content(image_server):
+    (url, state) = image_server
+    state["etag"] = False
+    assert load(url) == (255, 0, 0)
+    state["body"] = png("green")
+    assert load(url) == (0, 128, 0)
+    assert len(state["requests"]) == 2
+
+
+def test_evicted_images_are_downloaded_again(image_server):
+    (url, state) = image_server
+    assert load(url) == (255, 0, 0)
+    utils.input_image_cache.clear()
+    assert load(url) == (255, 0, 0)
+    assert state["requests"] == [None, None]
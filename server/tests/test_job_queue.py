@@ -0,0 +1,81 @@
+import threading
+import time
+import pytest
+import torch
+from ez_diffusion_client import ImageGenerationParams
+from inference_executor import InferenceExecutor
+from job_queue import JobQueue
+from metrics import metrics
+from models import OpStatus, RequestOptions
+from step_hooks import JobCancelledError, raise_if_interrupted, step_end_callback
+
+
+class StubDenoiser:
+    """Denoises like a diffusers pipeline: the step-end callback may set `_interrupt`, which skips the remaining steps."""
+
+    def __init__(self, step_s: float = 0.02):
+        self.step_s = step_s
+        self.steps_run = 0
+        self.running = threading.Event()
+
+    def generate(self, params: ImageGenerationParams, observer=None):
+        self._interrupt = False
+        callback = step_end_callback([observer], params.inference_steps)
+        latents = torch.zeros(1, 4, 8, 8)
+        self.running.set()
+        for step in range(params.inference_steps):
+            if self._interrupt:
+                continue
+            time.sleep(self.step_s)
+            self.steps_run += 1
+            callback(self, step, step, {"latents": latents})
+        raise_if_interrupted(self, [observer])
+        return {"image": "cat", "seed": params.seed}
+
+
+PARAMS = ImageGenerationParams(prompt="a cat", dimensions={"width": 64, "height": 64}, inference_steps=50, seed=1)
+
+
+def job_queue(denoiser: StubDenoiser) -> JobQueue:
+    executor = InferenceExecutor()
+    return JobQueue(lambda params, observer, options: executor.submit(denoiser.generate, params, observer=observer))
+
+
+def test_running_jobs_stop_at_the_next_step_when_cancelled():
+    (denoiser, interrupts) = (StubDenoiser(), metrics.snapshot().get("denoise_interrupts", 0))
+    jobs = job_queue(denoiser)
+    job = jobs.submit(PARAMS)
+    assert denoiser.running.wait(10)
+
+    assert jobs.cancel(job.job_id) is job
+    with pytest.raises(JobCancelledError, match="cancelled"):
+        job.future.result(10)
+    assert denoiser.steps_run < PARAMS.inference_steps
+    assert job.to_response()["status"] == OpStatus.CANCELLED.value
+    assert job.to_response()["error"] == "Job stopped: cancelled"
+    assert metrics.snapshot()["denoise_interrupts"] == interrupts + 1
+
+
+def test_queued_jobs_are_cancelled_without_running():
+    denoiser = StubDenoiser()
+    jobs = job_queue(denoiser)
+    running = jobs.submit(PARAMS)
+    queued = jobs.submit(PARAMS)
+    assert denoiser.running.wait(10)
+
+    jobs.cancel(queued.job_id)
+    assert queued.future.cancelled()
+    assert queued.to_response()["status"] == OpStatus.CANCELLED.value
+    assert running.future.result(10) == {"image": "cat", "seed": 1}
+    assert denoiser.steps_run == PARAMS.inference_steps
+    assert jobs.cancel("unknown") is None
+
+
+def test_jobs_past_their_deadline_stop():
+    denoiser = StubDenoiser()
+    job = job_queue(denoiser).submit(PARAMS, RequestOptions(deadline_s=0.1))
+    # The endpoints answer this error with a 504.
+    with pytest.raises(JobCancelledError, match="deadline exceeded"):
+        job.future.result(10)
+    assert denoiser.steps_run < PARAMS.inference_steps
+    assert job.to_response()["error"] == "Job stopped: deadline exceeded"
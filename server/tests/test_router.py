@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from ez_diffusion_client import ImageGenerationParams
+from pipeline_factory import SDImagePipelineFactory, pipeline_key_to_json
+from router import AffinityRouter
+
+LORA = {"model": "lora/pixel", "weight_name": "pixel.safetensors", "scale": 1.0}
+CANNY = {"processor_type": "canny", "guide_image": {"source": "data:image/png;base64,"}}
+
+
+def params(**kwargs) -> ImageGenerationParams:
+    return ImageGenerationParams(prompt="a cat", dimensions={"width": 64, "height": 64}, **kwargs)
+
+
+def warm(*requests: ImageGenerationParams) -> list:
+    return [pipeline_key_to_json(SDImagePipelineFactory.pipeline_key(request)) for request in requests]
+
+
+def stub_worker(name: str, status: dict, delay_s: float = 0.0) -> ThreadingHTTPServer:
+    """A worker that advertises `status` and answers generations with its name after `delay_s`. Counts them in `server.generations`."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code: int, body: dict):
+            encoded = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def do_GET(self):
+            self.reply(200, status)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            server.generations += 1
+            time.sleep(delay_s)
+            self.reply(200, {"worker": name})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.generations = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def router():
+    workers = [
+        stub_worker("plain", {"base_model": "sd15", "pipelines": warm(params()), "loras": [], "predicted_wait_s": 1.0}),
+        stub_worker("controlnet", {"base_model": "sd15", "pipelines": warm(params(controlnets=[CANNY])), "loras": [], "predicted_wait_s": 2.0}),
+        stub_worker("lora", {"base_model": "sd15", "pipelines": warm(params()), "loras": [[LORA["model"], LORA["weight_name"]]], "predicted_wait_s": 2.0}),
+        stub_worker("sdxl", {"base_model": "sdxl", "pipelines": [], "loras": []}),
+    ]
+    urls = [f"http://127.0.0.1:{worker.server_address[1]}" for worker in workers]
+    # A worker that is down, which routing has to skip.
+    yield AffinityRouter([*urls, "http://127.0.0.1:9"], poll_interval_s=3600)
+    for worker in workers:
+        worker.shutdown()
+
+
+def url(worker: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{worker.server_address[1]}"
+
+
+def routed_to(router: AffinityRouter, request: ImageGenerationParams) -> str:
+    (_, status, _, body) = router.route(request, "/text-to-image", json.dumps({"input": request.to_dict()}).encode("utf-8"))
+    assert status == 200
+    return json.loads(body)["worker"]
+
+
+def test_requests_go_to_workers_with_their_state_warm(router):
+    assert routed_to(router, params()) == "plain"
+    assert routed_to(router, params(controlnets=[CANNY])) == "controlnet"
+    assert routed_to(router, params(loras=[LORA])) == "lora"
+    assert routed_to(router, params(base_model="sdxl")) == "sdxl"
+
+
+def test_unknown_base_model_and_down_workers_get_no_route(router):
+    assert router.route(params(base_model="flux"), "/text-to-image", b"{}") is None
+    assert [worker.healthy for worker in router.workers] == [True, True, True, True, False]
+
+
+def test_requests_a_worker_got_are_not_sent_again():
+    slow = stub_worker("slow", {"base_model": "sd15", "pipelines": warm(params()), "loras": []}, delay_s=1.0)
+    other = stub_worker("other", {"base_model": "sd15", "pipelines": [], "loras": []})
+    router = AffinityRouter([url(slow), url(other)], poll_interval_s=3600, timeout_s=0.2)
+    (worker, status, _, _) = router.route(params(), "/text-to-image", b"{}")
+    assert (worker.url, status) == (url(slow), 504)
+    assert (slow.generations, other.generations) == (1, 0)
+    assert all(worker.healthy for worker in router.workers)
+    for server in (slow, other):
+        server.shutdown()
+
+
+def test_unreachable_workers_are_failed_over():
+    preferred = stub_worker("preferred", {"base_model": "sd15", "pipelines": warm(params()), "loras": []})
+    other = stub_worker("other", {"base_model": "sd15", "pipelines": [], "loras": []})
+    router = AffinityRouter([url(preferred), url(other)], poll_interval_s=3600)
+    # Gone since the last poll.
+    preferred.shutdown()
+    preferred.server_close()
+    assert routed_to(router, params()) == "other"
+    assert [worker.healthy for worker in router.workers] == [False, True]
+    other.shutdown()
+
+
+def test_pipeline_builds_avoid_workers_short_on_memory():
+    status = {"base_model": "sd15", "pipelines": [], "loras": [], "predicted_wait_s": 0.0}
+    short = stub_worker("short", {**status, "free_memory_bytes": 1024 ** 3})
+    roomy = stub_worker("roomy", {**status, "free_memory_bytes": 8 * 1024 ** 3, "predicted_wait_s": 5.0})
+    router = AffinityRouter([url(short), url(roomy)], poll_interval_s=3600)
+    assert routed_to(router, params()) == "roomy"
+    # Where the pipeline is warm nothing has to fit.
+    short_worker = next(worker for worker in router.workers if worker.url == url(short))
+    short_worker.status["pipelines"] = warm(params())
+    assert routed_to(router, params()) == "short"
+    for server in (short, roomy):
+        server.shutdown()
@@ -0,0 +1,51 @@
+from collections import Counter
+import pytest
+from inference_executor import QueueFullError, WorkItem
+from scheduling import FairSharePolicy, parse_tenant_weights
+from test_inference_executor import blocked_executor
+
+
+def enqueue(policy: FairSharePolicy, pending: list, tenant: str, count: int = 1):
+    for _ in range(count):
+        item = WorkItem(fn=None, tenant=tenant)
+        assert policy.accepts(item, pending)
+        pending.append(item)
+
+
+def serve(policy: FairSharePolicy, pending: list, count: int) -> list:
+    """Run `count` pending items of one GPU-second each, returning their tenants in order."""
+    served = []
+    for _ in range(count):
+        item = pending.pop(policy.select(pending))
+        policy.record(item, 1.0)
+        served.append(item.tenant)
+    return served
+
+
+def test_gpu_time_is_shared_by_weight():
+    policy = FairSharePolicy(parse_tenant_weights("interactive=2, bulk=1"))
+    pending = []
+    enqueue(policy, pending, "bulk", 12)
+    enqueue(policy, pending, "interactive", 12)
+    assert Counter(serve(policy, pending, 12)) == {"interactive": 8, "bulk": 4}
+
+
+def test_idle_tenants_dont_bank_credit():
+    policy = FairSharePolicy()
+    pending = []
+    enqueue(policy, pending, "a", 8)
+    assert serve(policy, pending, 5) == ["a"] * 5
+
+    # b rejoins level with a instead of running its whole backlog first.
+    enqueue(policy, pending, "b", 3)
+    assert serve(policy, pending, 4) == ["a", "b", "a", "b"]
+
+
+def test_tenants_over_their_queue_share_are_rejected():
+    (executor, release) = blocked_executor(max_queue_size=16, policy=FairSharePolicy(max_pending_per_tenant=1))
+    executor.submit(lambda: "a", tenant="a")
+    with pytest.raises(QueueFullError) as rejected:
+        executor.submit(lambda: "a", tenant="a")
+    assert "Too many queued requests for this tenant" in str(rejected.value)
+    assert executor.submit(lambda: "b", tenant="b")
+    release.set()
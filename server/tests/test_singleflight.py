@@ -0,0 +1,74 @@
+from concurrent.futures import Future
+import pytest
+from singleflight import SingleFlight
+from step_hooks import CancellationToken, JobCancelledError
+
+
+class StubGeneration:
+    """Stands in for the executor: records each started computation and the observer it was started with."""
+
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, observer) -> Future:
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.started.append((future, observer))
+        return future
+
+
+def test_identical_requests_share_one_computation():
+    (flights, generation) = (SingleFlight(), StubGeneration())
+    first = flights.submit("seeded-cat", None, generation)
+    second = flights.submit("seeded-cat", None, generation)
+    other = flights.submit("seeded-dog", None, generation)
+    assert len(generation.started) == 2
+
+    generation.started[0][0].set_result({"image": "cat"})
+    assert first.result(1) == second.result(1) == {"image": "cat"}
+    # Every request gets its own response dict to add to.
+    assert first.result() is not second.result()
+    assert not other.done()
+
+    # Once it landed, the next identical request starts over.
+    flights.submit("seeded-cat", None, generation)
+    assert len(generation.started) == 3
+
+
+def test_requests_without_a_key_are_not_shared():
+    (flights, generation) = (SingleFlight(), StubGeneration())
+    flights.submit(None, None, generation)
+    flights.submit(None, None, generation)
+    assert len(generation.started) == 2
+
+
+def test_shared_computation_stops_once_every_request_stopped():
+    (flights, generation) = (SingleFlight(), StubGeneration())
+    (cancelled, expired) = (CancellationToken(), CancellationToken())
+    first = flights.submit("seeded-cat", cancelled, generation)
+    second = flights.submit("seeded-cat", expired, generation)
+    (computation, shared_observer) = generation.started[0]
+
+    cancelled.cancel()
+    assert shared_observer.stop_reason() is None
+    expired.cancel("deadline exceeded")
+    assert shared_observer.stop_reason() == "cancelled"
+
+    computation.set_exception(JobCancelledError("cancelled"))
+    with pytest.raises(JobCancelledError, match="cancelled"):
+        first.result(1)
+    with pytest.raises(JobCancelledError, match="deadline exceeded"):
+        second.result(1)
+
+
+def test_a_cancelled_request_leaves_the_others_their_result():
+    (flights, generation) = (SingleFlight(), StubGeneration())
+    cancellation = CancellationToken()
+    first = flights.submit("seeded-cat", cancellation, generation)
+    second = flights.submit("seeded-cat", None, generation)
+
+    cancellation.cancel()
+    generation.started[0][0].set_result({"image": "cat"})
+    with pytest.raises(JobCancelledError):
+        first.result(1)
+    assert second.result(1) == {"image": "cat"}
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+import pytest
+import torch
+import wan_videogen_service
+from checkpointing import Checkpointer, FilesystemCheckpointStore
+from step_hooks import StepObserver
+from test_checkpointing import Killed, StubScheduler
+from wan_videogen_service import WanVideoGenService
+
+
+class StubWanPipe:
+    """Calls back at every step like `WanPipeline` and returns the step count as the frames."""
+
+    def __init__(self):
+        self.scheduler = StubScheduler()
+        self._interrupt = False
+
+    def __call__(self, num_inference_steps, latents=None, callback_on_step_end=None, **kwargs):
+        self.scheduler.set_timesteps(num_inference_steps)
+        latents = latents if latents is not None else torch.zeros(1, 4, 2, 2)
+        for (i, t) in enumerate(self.scheduler.timesteps):
+            latents = self.scheduler.step(latents, t)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, i, t, {"latents": latents})
+        return SimpleNamespace(frames=[[len(self.scheduler.timesteps)]])
+
+
+class KillAt(StepObserver):
+    def __init__(self, checkpointer: Checkpointer, step: int):
+        (self.checkpointer, self.step) = (checkpointer, step)
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        if self.checkpointer.completed_steps + step + 1 == self.step:
+            raise Killed()
+
+
+JOB = {"prompt": "a cat", "height": 64, "width": 64, "num_frames": 5, "num_inference_steps": 20, "guidance_scale": 5.0, "filename": "cat.mp4"}
+
+
+def test_killed_video_jobs_resume_and_export(tmp_path, monkeypatch):
+    exported = []
+    monkeypatch.setattr(wan_videogen_service, "export_to_video", lambda video, filename, fps: exported.append((video, filename, fps)))
+    service = WanVideoGenService.__new__(WanVideoGenService)
+    (service.local_debug, service.pipe) = (True, StubWanPipe())
+    store = FilesystemCheckpointStore(str(tmp_path))
+
+    checkpointer = Checkpointer(store, "job", JOB, every_n_steps=5)
+    with pytest.raises(Killed):
+        service.generate(JOB, KillAt(checkpointer, 7), checkpointer)
+    assert store.load("job") is not None
+
+    result = service.generate(JOB, None, Checkpointer(store, "job", JOB, every_n_steps=5))
+    assert result == {"status": "success", "video": "cat.mp4"}
+    # Resumed after the 5 checkpointed steps.
+    assert exported == [([15], "cat.mp4", 24)]
+    assert store.load("job") is None
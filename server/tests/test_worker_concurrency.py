@@ -0,0 +1,36 @@
+import torch
+import worker_concurrency
+from imagegen_service import ImageGenService
+from worker_concurrency import VramConcurrencyController
+
+GB = 1024 ** 3
+
+
+class StubService:
+    exclusive = False
+
+    def estimate_job_memory(self, job_input) -> int:
+        return 2 * GB
+
+
+def test_queued_jobs_dont_raise_the_limit(monkeypatch):
+    monkeypatch.setattr(worker_concurrency, "get_free_memory_bytes", lambda: 5 * GB)
+    controller = VramConcurrencyController(StubService(), max_concurrency=8, memory_headroom=0)
+    assert controller(1) == 2
+    for job_id in ("a", "b", "c"):
+        controller.job_started(job_id, {})
+    assert controller(3) == 2
+
+    # A running job's memory is already missing from the free memory, so it is counted back in.
+    controller.running_observer("a").on_step_end(None, 0, 10, torch.zeros(1))
+    monkeypatch.setattr(worker_concurrency, "get_free_memory_bytes", lambda: 3 * GB)
+    assert controller(3) == 2
+    controller.job_finished("a")
+    assert controller._running_bytes == {}
+
+
+def test_estimates_tolerate_missing_dimensions():
+    service = ImageGenService.__new__(ImageGenService)
+    job_input = {"dimensions": {"width": None}, "inference_steps": None, "controlnets": [None]}
+    assert service.estimate_job_memory(job_input) > 0
+    assert service.estimate_work(job_input) > 0
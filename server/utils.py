@@ -1,10 +1,17 @@
 from functools import lru_cache
+from typing import Callable
 from ez_diffusion_client import ImageGenerationParams, ImageInput
 import torch
 import base64
+import hashlib
+import os
+import urllib.error
+import urllib.request
 from diffusers.utils import load_image as hf_load_image
+from diffusers.utils.constants import DIFFUSERS_REQUEST_TIMEOUT
 from io import BytesIO
 from PIL import Image
+from caching import BoundedCache, sizeof_image
 
 def resolve_device():
     if torch.cuda.is_available():
@@ -13,6 +20,12 @@ def resolve_device():
         return "mps"
     else:
         return "cpu"
+
+def list_devices() -> list[str]:
+    """Every device a pipeline replica can be placed on. Falls back to the single `resolve_device()` device."""
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return [resolve_device()]
     
 def bytes_to_megabytes(bytes):
     return bytes / 1024 / 1024
@@ -32,10 +45,48 @@ def get_memory_info():
             Current driver allocated memory: {bytes_to_megabytes(torch.mps.driver_allocated_memory())} MB (total GPU memory allocated by Metal driver for the process in bytes)
         '''
 
+def get_free_memory_bytes() -> int | None:
+    """Device memory still available for new work, counting memory cached but unused by the torch allocator. None if unknown."""
+    if torch.cuda.is_available():
+        (free, _) = torch.cuda.mem_get_info()
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    elif torch.backends.mps.is_available():
+        return torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+    return None
+
+# Linear projections from latent channels to RGB, cheap enough to run on every step.
+SD15_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+
+def latents_to_preview(latents: torch.Tensor, is_sdxl: bool = False, size: int = 64) -> str | None:
+    """Approximate a JPEG data url from SD/SDXL latents without running the VAE. None for other latent layouts."""
+    if latents.ndim != 4 or latents.shape[1] != 4:
+        return None
+    factors = torch.tensor(SDXL_LATENT_RGB_FACTORS if is_sdxl else SD15_LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum("chw,cr->hwr", latents[0].float(), factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().cpu().numpy()
+    img = Image.fromarray(rgb)
+    img.thumbnail((size, size))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=70)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+
 def print_memory_info():
     print(get_memory_info())
 
-def __loadim(image: str):
+def __loadim(image: str, content: bytes | None = None):
+    if content is not None:
+        return hf_load_image(Image.open(BytesIO(content)))
     if image.startswith("data:image"):
         try: 
             return Image.open(BytesIO(base64.b64decode(image.split(",")[1])))
@@ -45,8 +96,47 @@ def __loadim(image: str):
     else:
         return hf_load_image(image)
 
-def load_image_from_base64_or_url(image: str, resizedWidth: int | None = None, resizedHeight: int | None = None):
-    img = __loadim(image)
+# Decoded and resized input images by content and target size. Editing sessions send the same image over and over.
+input_image_cache = BoundedCache("input_image", int(os.getenv("INPUT_IMAGE_CACHE_MB", "256")) * 1024 ** 2, sizeof_image)
+# URL -> (conditional request headers, key) of its last response, to revalidate it instead of downloading it again.
+url_validators = BoundedCache("url_validator", 4 * 1024 ** 2, lambda entry: 1024)
+
+def fetch_input_image(image: str, is_cached: Callable[[str], bool] = lambda key: False) -> tuple[str | None, bytes | None]:
+    """
+    What identifies the content of an input image, and its bytes when they had to be read to tell. The
+    key is None when nothing identifies it. URLs take a single GET: when the content of their last
+    response is still cached, as told by `is_cached(key)`, a conditional GET revalidates it, otherwise
+    the body is downloaded and keyed by the validator of the same response, or by its hash.
+    """
+    if image.startswith("data:image"):
+        return (hashlib.sha256(image.encode("utf-8")).hexdigest(), None)
+    if image.startswith(("http://", "https://")):
+        known = url_validators.get(image)
+        revalidate = known is not None and is_cached(known[1])
+        request = urllib.request.Request(image, headers=known[0] if revalidate else {})
+        try:
+            with urllib.request.urlopen(request, timeout=DIFFUSERS_REQUEST_TIMEOUT) as response:
+                (headers, content) = (response.headers, response.read())
+        except urllib.error.HTTPError as e:
+            if revalidate and e.code == 304:
+                return (known[1], None)
+            raise
+        if etag := headers.get("ETag"):
+            (conditional, key) = ({"If-None-Match": etag}, f"{image}#{etag}")
+        elif last_modified := headers.get("Last-Modified"):
+            (conditional, key) = ({"If-Modified-Since": last_modified}, f"{image}#{last_modified}")
+        else:
+            (conditional, key) = (None, f"{image}#sha256:{hashlib.sha256(content).hexdigest()}")
+        if conditional:
+            url_validators.put(image, (conditional, key))
+        return (key, content)
+    try:
+        stat = os.stat(image)
+    except OSError:
+        return (None, None)
+    return (f"{os.path.realpath(image)}#{stat.st_mtime_ns}:{stat.st_size}", None)
+
+def __resize(img, resizedWidth: int | None, resizedHeight: int | None):
     if resizedWidth and resizedHeight:
         return img.resize((resizedWidth, resizedHeight))
     if resizedWidth:
@@ -59,6 +149,26 @@ def load_image_from_base64_or_url(image: str, resizedWidth: int | None = None, r
         return img.resize((int(width * scale), height))
     else:
         return img
-    
-    
-            
\ No newline at end of file
+
+def load_image_from_base64_or_url(
+    image: str,
+    resizedWidth: int | None = None,
+    resizedHeight: int | None = None,
+    fetched: tuple[str | None, bytes | None] | None = None,
+):
+    """
+    Load a data URL, URL or file path as an image resized to the given size. Repeated images come from
+    `input_image_cache`, keyed by `fetch_input_image`, whose result callers that already have it pass as `fetched`.
+    """
+    (key, content) = fetched or fetch_input_image(image, lambda key: (key, resizedWidth, resizedHeight) in input_image_cache)
+    cached = input_image_cache.get((key, resizedWidth, resizedHeight)) if key is not None else None
+    if cached is None:
+        if content is None and image.startswith(("http://", "https://")):
+            # Revalidated, but evicted since.
+            (key, content) = fetch_input_image(image)
+        cached = __resize(__loadim(image, content), resizedWidth, resizedHeight)
+        cached.load()
+        if key is not None:
+            input_image_cache.put((key, resizedWidth, resizedHeight), cached)
+    # Callers get their own copy to modify.
+    return cached.copy()
@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 from enum import Enum
 import os
@@ -6,30 +7,45 @@ import random
 from typing import List, Optional, Dict, Any
 import numpy as np
 from inference_service import RPWorkerInferenceService
+from checkpointing import Checkpointer
+from step_hooks import ObserverGroup, StepObserver, raise_if_interrupted, step_end_callback
 from utils import get_memory_info, load_image_from_base64_or_url, print_memory_info, resolve_device
 from diffusers import WanPipeline, AutoencoderKLWan, WanTransformer3DModel, UniPCMultistepScheduler
 from diffusers.utils import export_to_video, load_image
 
 class WanVideoGenService(RPWorkerInferenceService):
+    # Video jobs take most of the device, so they always run alone.
+    exclusive = True
+    # Work is counted in megapixel-frame-steps.
+    seconds_per_work_unit = 0.1
+
     def __init__(
         self,
-        local_debug: bool = False
+        local_debug: bool = False,
+        device: Optional[str] = None
     ):
         self.local_debug = local_debug
+        self.device = device or resolve_device()
         dtype = torch.bfloat16
         model_id = "Wan-AI/Wan2.2-TI2V-5B-Diffusers"
         vae = AutoencoderKLWan.from_pretrained(model_id, subfolder="vae", torch_dtype=torch.float32)
         self.pipe = WanPipeline.from_pretrained(model_id, vae=vae, torch_dtype=dtype)
 
     def warmup(self): 
-        self.pipe.to(resolve_device())
+        self.pipe.to(self.device)
+
+    def estimate_work(self, job_input: Dict[str, Any]) -> float:
+        megapixels = (job_input.get("width") or 1280) * (job_input.get("height") or 704) / 1e6
+        return megapixels * (job_input.get("num_frames") or 121) * (job_input.get("num_inference_steps") or 50)
 
-    def rp_worker_generate(self, job) -> Any:
-        return self.generate(job.get("input"))
+    def rp_worker_generate(self, job, observer: Optional[StepObserver] = None, checkpointer: Optional[Checkpointer] = None) -> Any:
+        return self.generate(job.get("input"), observer, checkpointer)
 
     def generate(
         self,
         input_params: Dict[str, Any],
+        observer: Optional[StepObserver] = None,
+        checkpointer: Optional[Checkpointer] = None,
     ) -> Dict[str, Any]:
         try:
             p = {**input_params}
@@ -39,18 +55,33 @@ class WanVideoGenService(RPWorkerInferenceService):
             num_frames = p.pop("num_frames")
             num_inference_steps = p.pop("num_inference_steps")
             guidance_scale = p.pop("guidance_scale")
+            fps = p.get("fps", 24)
+            filename = p.get("filename", f"{prompt[:72]}_{datetime.datetime.now()}.mp4")
             negative_prompt = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走"
 
-            self.pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                height=height,
-                width=width,
-                num_frames=num_frames,
-                guidance_scale=guidance_scale,
-                num_inference_steps=num_inference_steps,
-            ).frames[0]
-            return {"status": "success", "image": filename, **response}
+            resume = checkpointer.resume_state() if checkpointer is not None else None
+            with checkpointer.resuming(self.pipe.scheduler) if checkpointer is not None else contextlib.nullcontext():
+                video = self.pipe(
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    height=height,
+                    width=width,
+                    num_frames=num_frames,
+                    guidance_scale=guidance_scale,
+                    num_inference_steps=num_inference_steps,
+                    latents=resume["latents"] if resume is not None else None,
+                    callback_on_step_end=step_end_callback([ObserverGroup(observer, checkpointer)], num_inference_steps),
+                    callback_on_step_end_tensor_inputs=["latents"],
+                ).frames[0]
+            raise_if_interrupted(self.pipe, [observer])
+            if checkpointer is not None:
+                checkpointer.complete()
+            export_to_video(video, filename, fps=fps)
+
+            if self.local_debug:
+                return {"status": "success", "video": filename}
+            else:
+                return {"status": "success"}
         except KeyError as e:
             if self.local_debug:
                 print(f"KeyError: {str(e)}")
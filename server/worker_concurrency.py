@@ -0,0 +1,82 @@
+import threading
+from typing import Any, Dict
+import torch
+from inference_service import RPWorkerInferenceService
+from step_hooks import StepObserver
+from utils import bytes_to_megabytes, get_free_memory_bytes
+
+
+class _RunningObserver(StepObserver):
+    """Tells the controller when a job starts denoising, which is when it starts taking device memory."""
+
+    def __init__(self, controller: "VramConcurrencyController", job_id: str):
+        self.controller = controller
+        self.job_id = job_id
+
+    def on_step_end(self, pipe, step: int, total_steps: int, latents: torch.Tensor):
+        self.controller.job_running(self.job_id)
+
+
+class VramConcurrencyController:
+    """
+    RunPod `concurrency_modifier` that scales how many jobs a worker takes at once from measured
+    free device memory and the service's per-job memory estimates. Exclusive services always get `exclusive_concurrency`.
+    `max_concurrency` should not exceed the jobs the worker actually runs at once, anything beyond that only
+    queues on this worker while idle workers could take it.
+    """
+
+    def __init__(
+        self,
+        service: RPWorkerInferenceService,
+        max_concurrency: int = 4,
+        memory_headroom: float = 0.1,
+        exclusive_concurrency: int = 1,
+    ):
+        self.service = service
+        self.max_concurrency = max_concurrency
+        self.memory_headroom = memory_headroom
+        self.exclusive_concurrency = exclusive_concurrency
+        self._estimates: Dict[str, int] = {}
+        # Estimates of the jobs that started denoising. Queued jobs haven't taken any memory yet.
+        self._running_bytes: Dict[str, int] = {}
+        # Moving average of recent job estimates, so the next job is sized like the current traffic.
+        self._avg_job_bytes = float(service.estimate_job_memory({}))
+        self._lock = threading.Lock()
+
+    def job_started(self, job_id: str, job_input: Dict[str, Any]):
+        estimate = self.service.estimate_job_memory(job_input)
+        with self._lock:
+            self._estimates[job_id] = estimate
+            self._avg_job_bytes = 0.8 * self._avg_job_bytes + 0.2 * estimate
+
+    def job_running(self, job_id: str):
+        with self._lock:
+            if job_id in self._estimates:
+                self._running_bytes[job_id] = self._estimates[job_id]
+
+    def running_observer(self, job_id: str) -> StepObserver:
+        """Observer to pass along with the job, so its memory counts once it runs."""
+        return _RunningObserver(self, job_id)
+
+    def job_finished(self, job_id: str):
+        with self._lock:
+            self._estimates.pop(job_id, None)
+            self._running_bytes.pop(job_id, None)
+
+    def __call__(self, current_concurrency: int) -> int:
+        if self.service.exclusive:
+            return self.exclusive_concurrency
+
+        free = get_free_memory_bytes()
+        if free is None:
+            return current_concurrency
+
+        with self._lock:
+            # Running jobs are counted back in, since part of their footprint is already missing from `free`.
+            budget = free * (1 - self.memory_headroom) + sum(self._running_bytes.values())
+            allowed = int(budget // self._avg_job_bytes)
+
+        allowed = max(1, min(self.max_concurrency, allowed))
+        if allowed != current_concurrency:
+            print(f"{self.__class__.__name__}: concurrency {current_concurrency} -> {allowed} ({bytes_to_megabytes(free):.0f} MB free)")
+        return allowed